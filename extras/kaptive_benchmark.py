@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+Kaptive - benchmark suite
+
+Builds reproducible synthetic assemblies by embedding loci from Kaptive databases into random (or locus-like)
+backgrounds, with controlled fragmentation, mutations and truncations, then times each stage of Kaptive on them:
+loading the database, parsing the assemblies, the typing pipeline (gene pass, locus pass, gene evaluation), parsing
+the JSON results and formatting each output. Results are written as JSON, including the typing call for every
+assembly, so the suite also works as a correctness corpus: calls are checked against the embedded loci and can be
+compared with the results of a previous run (--compare) to make sure a speed-up doesn't change any typing calls.
+
+Example:
+    python extras/kaptive_benchmark.py -o before.json
+    # make changes
+    python extras/kaptive_benchmark.py -o after.json --compare before.json
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import sys
+import os
+import json
+import random
+import argparse
+import platform
+from glob import glob
+from time import perf_counter
+from statistics import mean, median
+from tempfile import TemporaryDirectory
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Use this copy of Kaptive
+
+from kaptive.version import __version__
+from kaptive.log import log, quit_with_error
+from kaptive.database import load_database, Database
+from kaptive.assembly import typing_pipeline, parse_result, assembly_from_records
+from kaptive.typing import TypingResult, _TRANSLATIONS
+from kaptive.utils import parse_fasta
+from kaptive import trace
+
+# Constants -----------------------------------------------------------------------------------------------------------
+_DATABASES = sorted(glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                      'reference_database', '*.gbk')))
+_PIPELINE_STAGES = {  # Trace spans recorded by the typing pipeline and the names they are reported as
+    'parse assembly': 'parse_assembly', 'align genes': 'gene_pass', 'score loci': 'score_loci',
+    'align loci': 'locus_pass', 'reconstruct locus': 'gene_evaluation', 'compare translation': 'compare_translation',
+    'confidence': 'confidence', 'typing_pipeline': 'typing_pipeline'
+}
+_FORMATS = ('tsv', 'json', 'fna', 'ffn', 'faa', 'png')
+_CALL_FIELDS = ('best_match', 'phenotype', 'confidence', 'problems', 'percent_identity', 'percent_coverage')
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def parse_args(a):
+    parser = argparse.ArgumentParser(description='Kaptive benchmark suite',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('databases', nargs='*', default=_DATABASES, metavar='db',
+                        help='Kaptive database paths or keywords (default: all in reference_database)')
+    parser.add_argument('-o', '--out', type=argparse.FileType('wt'), default=sys.stdout, metavar='',
+                        help='JSON file to write results to (default: stdout)')
+    parser.add_argument('-n', '--assemblies', type=int, default=10, metavar='',
+                        help='Number of synthetic assemblies per database (default: %(default)s)')
+    parser.add_argument('-r', '--repeats', type=int, default=3, metavar='',
+                        help='Number of times to type each set of assemblies (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, metavar='',
+                        help='Random seed, the same seed always builds the same assemblies (default: %(default)s)')
+    parser.add_argument('--background', choices=('random', 'loci'), default='random',
+                        help='Background sequence the loci are embedded in (default: %(default)s)\n'
+                             '  random: uniformly random sequence\n'
+                             '  loci: mutated fragments of other loci in the database, so other loci align too')
+    parser.add_argument('--background-size', type=int, default=200_000, metavar='',
+                        help='Length of the background sequence (default: %(default)s)')
+    parser.add_argument('--max-contigs', type=int, default=20, metavar='',
+                        help='Maximum number of contigs per assembly (default: %(default)s)')
+    parser.add_argument('--max-mutation-rate', type=float, default=0.03, metavar='',
+                        help='Maximum per-base mutation rate of the embedded locus (default: %(default)s)')
+    parser.add_argument('--truncation-rate', type=float, default=0.2, metavar='',
+                        help='Proportion of assemblies with a deletion in the locus (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int, default=1, metavar='',
+                        help='Number of alignment threads (default: %(default)s)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Type the assemblies from in-memory contigs, as kaptive.api.Typer does')
+    parser.add_argument('--compare', type=argparse.FileType('rt'), metavar='',
+                        help='Results of a previous run to compare typing calls with\n'
+                             'Exits with status 1 if any calls differ')
+    parser.add_argument('-d', '--outdir', metavar='',
+                        help='Directory to keep the synthetic assemblies in (default: temporary directory)')
+    parser.add_argument('-V', '--verbose', action='store_true', help='Print progress to stderr')
+    return parser.parse_args(a)
+
+
+def mutate(seq: str, rate: float, rng: random.Random) -> str:
+    """Substitutes each base with a random different base at the given rate"""
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() < rate:
+            seq[i] = rng.choice('ACGT'.replace(seq[i].upper(), ''))
+    return ''.join(seq)
+
+
+def reverse_complement(seq: str) -> str:
+    return seq[::-1].translate(str.maketrans('ACGTacgtNn', 'TGCAtgcaNn'))
+
+
+def background(db: Database, size: int, kind: str, rng: random.Random, exclude: str) -> str:
+    """Returns a random background, or one made of mutated fragments of other loci in the database"""
+    if kind == 'random' or len(db.loci) < 2:
+        return ''.join(rng.choices('ACGT', k=size))
+    seq, others = [], [i for i in db.loci.values() if i.name != exclude]
+    while sum(map(len, seq)) < size:
+        locus = str(rng.choice(others).seq)
+        start = rng.randrange(0, max(1, len(locus) - 2000))
+        seq.append(mutate(locus[start:start + rng.randint(500, 2000)], 0.15, rng))  # Diverged homologue
+        seq.append(''.join(rng.choices('ACGT', k=rng.randint(1000, 10000))))
+    return ''.join(seq)[:size]
+
+
+def build_assemblies(db: Database, outdir: str, args: argparse.Namespace, rng: random.Random) -> list[dict]:
+    """Writes synthetic assemblies to the output directory and returns a description of each one"""
+    specs, loci = [], [i for i in db.loci.values() if not i.name.startswith('Extra')]
+    for n in range(args.assemblies):
+        locus = rng.choice(loci)
+        spec = {'assembly': f'{db.name}_{n}', 'expected_locus': locus.name, 'strand': rng.choice('+-'),
+                'mutation_rate': round(rng.uniform(0, args.max_mutation_rate), 4), 'truncation': None,
+                'contigs': rng.randint(1, args.max_contigs)}
+        seq = mutate(str(locus.seq), spec['mutation_rate'], rng)
+        if rng.random() < args.truncation_rate:  # Delete part of the locus
+            start = rng.randrange(0, len(seq) // 2)
+            spec['truncation'] = [start, (end := start + rng.randint(100, len(seq) // 4))]
+            seq = seq[:start] + seq[end:]
+        seq = seq if spec['strand'] == '+' else reverse_complement(seq)
+        bg = background(db, args.background_size, args.background, rng, locus.name)
+        genome = bg[:(mid := rng.randrange(len(bg)))] + seq + bg[mid:]
+        cuts = sorted(rng.sample(range(1, len(genome)), spec['contigs'] - 1))
+        with open(file := os.path.join(outdir, f"{spec['assembly']}.fasta"), 'wt') as f:
+            for i, (start, end) in enumerate(zip([0] + cuts, cuts + [len(genome)])):
+                f.write(f'>contig_{i + 1}\n{genome[start:end]}\n')
+        specs.append(spec | {'file': file})
+    return specs
+
+
+def summarise(times: list[float]) -> dict:
+    """Returns summary statistics of a list of times in seconds, in milliseconds"""
+    return {'n': len(times), 'total_ms': sum(times) * 1000, 'mean_ms': mean(times) * 1000,
+            'median_ms': median(times) * 1000, 'min_ms': min(times) * 1000, 'max_ms': max(times) * 1000}
+
+
+def timed(times: defaultdict, key: str, func, *args, **kwargs):
+    """Calls the function, adds the time taken to times[key] and returns the result"""
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    times[key].append(perf_counter() - start)
+    return result
+
+
+def benchmark(db_arg: str, outdir: str, args: argparse.Namespace) -> tuple[str, dict, list[dict]]:
+    """Benchmarks a database and returns the database name, timings and typing calls"""
+    times = defaultdict(list)
+    timed(times, 'load_database_uncached', load_database, db_arg)
+    for _ in range(args.repeats):
+        db = timed(times, 'load_database', load_database, db_arg, cache=True)
+    log(f'Building {args.assemblies} assemblies for {db.name}', verbose=args.verbose)
+    specs = build_assemblies(db, outdir, args, random.Random(f'{args.seed}{db.name}'))
+
+    calls = {}
+    for repeat in range(args.repeats):
+        _TRANSLATIONS.clear()  # Each repeat starts with an empty cache so they take the same time
+        for spec in specs:
+            trace.pop_events()
+            assembly = spec['file']
+            if args.in_memory:  # Parsed outside of the typing pipeline, as in-memory assemblies are
+                with open(spec['file']) as f:
+                    assembly = assembly_from_records(spec['assembly'], parse_fasta(f.read()))
+            result = typing_pipeline(assembly, db, args.threads)
+            for event in trace.pop_events():  # Collect the time of each stage from the trace
+                if event['ph'] == 'X' and (stage := _PIPELINE_STAGES.get(event['name'])):
+                    times[stage].append(event['dur'] / 1e6)
+            if not result:
+                calls[spec['assembly']] = spec | {'best_match': None, 'correct': False}
+                continue
+            line = timed(times, 'format_json', result.format, 'json')
+            for fmt in _FORMATS:
+                if fmt != 'json':
+                    timed(times, f'format_{fmt}', result.format, fmt)
+            timed(times, 'parse_result', parse_result, line, db)
+            timed(times, 'from_dict', TypingResult.from_dict, json.loads(line), db)
+            if repeat == 0:
+                call = json.loads(line)
+                calls[spec['assembly']] = spec | {i: call[i] for i in _CALL_FIELDS} | {
+                    'correct': call['best_match'] == spec['expected_locus']}
+        log(f'Finished repeat {repeat + 1} of {args.repeats} for {db.name}', verbose=args.verbose)
+    return db.name, {k: summarise(v) for k, v in times.items()}, [
+        {k: v for k, v in i.items() if k != 'file'} for i in calls.values()]
+
+
+def compare(calls: list[dict], previous: list[dict]) -> list[dict]:
+    """Returns the calls that differ from the previous run"""
+    previous = {i['assembly']: i for i in previous}
+    return [{'assembly': i['assembly']} | {k: [previous.get(i['assembly'], {}).get(k), i.get(k)] for k in _CALL_FIELDS
+                                           if previous.get(i['assembly'], {}).get(k) != i.get(k)}
+            for i in calls if any(previous.get(i['assembly'], {}).get(k) != i.get(k) for k in _CALL_FIELDS)]
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if not args.databases:
+        quit_with_error('No databases found')
+    trace.enable()
+    results = {
+        'kaptive_version': __version__, 'python': platform.python_version(), 'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k not in {'out', 'compare', 'outdir', 'verbose'}},
+        'timings': {}, 'calls': []
+    }
+    with TemporaryDirectory() as tmpdir:
+        outdir = args.outdir or tmpdir
+        os.makedirs(outdir, exist_ok=True)
+        for db_arg in args.databases:
+            db_name, results['timings'][db_name], calls = benchmark(db_arg, outdir, args)
+            results['calls'].extend(calls)
+
+    results['correct'] = sum(i['correct'] for i in results['calls'])
+    log(f"{results['correct']} / {len(results['calls'])} assemblies typed as the embedded locus", verbose=True)
+    if args.compare:
+        results['changed_calls'] = compare(results['calls'], json.load(args.compare)['calls'])
+        log(f"{len(results['changed_calls'])} typing calls differ from {args.compare.name}", verbose=True)
+    json.dump(results, args.out, indent=2)
+    args.out.write('\n')
+    if results.get('changed_calls'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
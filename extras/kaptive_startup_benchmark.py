@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+Kaptive - startup benchmark
+
+Times the fixed cost of each Kaptive command, i.e. what every per-sample call from a workflow manager pays before
+any real work is done: starting Python, importing the modules the command needs, loading the database from the cache
+and (for assembly) starting minimap2. Each command is run on a tiny input in a new process and the median wall time
+is compared with a target. The modules imported by each command are also recorded with `python -X importtime`, and
+commands fail if they import a heavy module they don't need (e.g. matplotlib when not plotting).
+
+Example:
+    python extras/kaptive_startup_benchmark.py -o startup.json
+    python extras/kaptive_startup_benchmark.py --target version=50 --target convert=250
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import sys
+import os
+import json
+import argparse
+import platform
+import subprocess
+from compileall import compile_dir
+from time import perf_counter
+from statistics import median
+from tempfile import TemporaryDirectory
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)  # Use this copy of Kaptive
+
+from kaptive.version import __version__
+from kaptive.log import log
+
+# Constants -----------------------------------------------------------------------------------------------------------
+_RUN = f'import sys; sys.path.insert(0, {_ROOT!r}); from kaptive.__main__ import main; main()'
+_TARGETS_MS = {'version': 80, 'extract': 300, 'convert': 250, 'assembly': 400}  # Median wall times with kpsc_o
+_HEAVY_MODULES = ('numpy', 'matplotlib', 'dna_features_viewer', 'Bio.SeqIO', 'Bio.Align', 'Bio.Seq')
+_ALLOWED_MODULES = {  # Heavy modules each command is allowed to import
+    'version': set(), 'extract': {'Bio.Seq'}, 'convert': {'Bio.Seq'}, 'assembly': {'Bio.Seq', 'numpy'}
+}
+_TINY_ASSEMBLY = '>contig_1\nACGTACGTACGTAAAAAAAAAAAAAAAAAAAAACCCCCCCCCCCCTTTTTTTTTTTTGGGGGGGG\n'
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def parse_args(a):
+    parser = argparse.ArgumentParser(description='Kaptive startup benchmark',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('db', nargs='?', default='kpsc_o',
+                        help='Kaptive database path or keyword (default: %(default)s)')
+    parser.add_argument('-o', '--out', type=argparse.FileType('wt'), default=sys.stdout, metavar='',
+                        help='JSON file to write results to (default: stdout)')
+    parser.add_argument('-r', '--repeats', type=int, default=10, metavar='',
+                        help='Number of times to run each command (default: %(default)s)')
+    parser.add_argument('--target', action='append', default=[], metavar='',
+                        help='Median wall time target of a command in ms, as command=ms (e.g. version=50)\n'
+                             f'Defaults: {", ".join(f"{k}={v}" for k, v in _TARGETS_MS.items())}')
+    parser.add_argument('-V', '--verbose', action='store_true', help='Print progress to stderr')
+    return parser.parse_args(a)
+
+
+def commands(db: str, tmpdir: str) -> dict[str, list[str]]:
+    """Returns the arguments of each command, run on tiny inputs in the temporary directory"""
+    with open(assembly := os.path.join(tmpdir, 'tiny.fasta'), 'wt') as f:
+        f.write(_TINY_ASSEMBLY)
+    open(results := os.path.join(tmpdir, 'empty.json'), 'wt').close()
+    return {
+        'version': ['--version'],
+        'extract': ['extract', db, '--fna', os.path.join(tmpdir, 'loci.fna')],
+        'convert': ['convert', db, results, '-t', os.path.join(tmpdir, 'convert.tsv'), '--db-cache'],
+        'assembly': ['assembly', db, assembly, '-o', os.path.join(tmpdir, 'assembly.tsv'), '--db-cache'],
+    }
+
+
+def run(args: list[str], importtime: bool = False) -> tuple[float, str]:
+    """Runs Kaptive in a new process and returns the wall time in seconds and stderr"""
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', _RUN] + args
+    start = perf_counter()
+    process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = perf_counter() - start
+    if process.returncode:
+        raise RuntimeError(f'{" ".join(args)} failed:\n{process.stderr}')
+    return elapsed, process.stderr
+
+
+def imports(stderr: str) -> dict[str, float]:
+    """Returns the cumulative import time in ms of each module from the output of python -X importtime"""
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, module = line[len('import time:'):].split('|')
+            times[module.strip()] = int(cumulative) / 1000
+    return times
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    targets = _TARGETS_MS | {k: float(v) for k, v in (i.split('=', 1) for i in args.target)}
+    compile_dir(os.path.join(_ROOT, 'kaptive'), quiet=1)  # Time the imports, not compiling the modules
+    results = {'kaptive_version': __version__, 'python': platform.python_version(), 'platform': platform.platform(),
+               'settings': {'db': args.db, 'repeats': args.repeats, 'targets_ms': targets}, 'commands': {}}
+    with TemporaryDirectory() as tmpdir:
+        for name, cmd in commands(args.db, tmpdir).items():
+            run(cmd)  # Warm up the filesystem and database caches
+            times = [run(cmd)[0] * 1000 for _ in range(args.repeats)]
+            modules = imports(run(cmd, importtime=True)[1])
+            heavy = sorted(i for i in _HEAVY_MODULES if i in modules and i not in _ALLOWED_MODULES[name])
+            results['commands'][name] = {
+                'median_ms': median(times), 'min_ms': min(times), 'max_ms': max(times), 'target_ms': targets[name],
+                'modules_imported': len(modules), 'unneeded_heavy_modules': heavy,
+                'slowest_imports_ms': dict(sorted(modules.items(), key=lambda i: i[1], reverse=True)[:10]),
+                'passed': median(times) <= targets[name] and not heavy
+            }
+            log(f"{name}: {median(times):.0f} ms (target {targets[name]:.0f} ms)"
+                f"{', imports ' + ', '.join(heavy) if heavy else ''}", verbose=args.verbose)
+
+    results['passed'] = all(i['passed'] for i in results['commands'].values())
+    json.dump(results, args.out, indent=2)
+    args.out.write('\n')
+    if not results['passed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,13 +18,15 @@ from __future__ import annotations
 import sys
 import re
 import argparse
-from io import TextIOWrapper
+from os import path
+from io import TextIOBase
 
 from Bio import __version__ as biopython_version
 
 from kaptive.version import __version__
-from kaptive.log import bold, quit_with_error, log
-from kaptive.utils import get_logo, check_out, check_cpus, check_programs
+from kaptive.log import bold, quit_with_error, log, warning
+from kaptive.utils import get_logo, check_out, check_cpus, check_programs, check_file
+from kaptive import trace
 
 # Constants -----------------------------------------------------------------------------------------------------------
 _URL = 'https://kaptive.readthedocs.io/en/latest/'
@@ -41,12 +43,15 @@ def parse_args(a) -> argparse.Namespace:
     assembly_subparser(subparsers)
     extract_subparser(subparsers)
     convert_subparser(subparsers)
+    index_subparser(subparsers)
+    serve_subparser(subparsers)
+    cache_subparser(subparsers)
     opts = parser.add_argument_group(bold('Other options'), '')
     other_opts(opts)
 
     if len(a) == 0:  # No arguments, print help message
         parser.print_help(sys.stderr)
-        quit_with_error(f'Please specify a command; choose from {{assembly,extract,convert}}')
+        quit_with_error(f'Please specify a command; choose from {{assembly,extract,convert,index,serve,cache}}')
     if any(x in a for x in {'-v', '--version'}):  # Version message
         print(__version__)
         sys.exit(0)
@@ -62,7 +67,7 @@ def parse_args(a) -> argparse.Namespace:
         sys.exit(0)
     else:  # Unknown command
         parser.print_help(sys.stderr)
-        quit_with_error(f'Unknown command "{a[0]}"; choose from {{assembly,extract,convert}}')
+        quit_with_error(f'Unknown command "{a[0]}"; choose from {{assembly,extract,convert,index,serve,cache}}')
     return parser.parse_args(a)
 
 
@@ -89,45 +94,48 @@ def assembly_subparser(subparsers):
                       type=argparse.FileType('at'),
                       help='Dump locus score matrix to tsv (typing will not be performed!)\n'
                            'Optionally choose file (can be existing) (default: stdout)')
+    opts.add_argument('--resume', action='store_true',
+                      help='Skip assemblies that already have results in the -o and -j files,\n'
+                           'e.g. to continue an interrupted run without duplicating results')
     other_fmt_opts(opts)
     opts = assembly_parser.add_argument_group(bold('Scoring options'), "")
-    opts.add_argument('--min-cov', type=float, required=False, default=50.0, metavar='',
-                      help='Minimum gene %%coverage (blen/q_len*100) to be used for scoring (default: %(default)s)')
-    opts.add_argument("--score-metric", metavar='', default=0, type=int, choices=range(4),
-                      help="Metric for scoring each locus (default: %(default)s)\n"
-                           "  0: AS (alignment score of genes found)\n"
-                           "  1: mlen (matching bases of genes found)\n"
-                           "  2: blen (aligned bases of genes found)\n"
-                           "  3: q_len (query length of genes found)")
-    opts.add_argument("--weight-metric", metavar='', default=3, type=int, choices=range(6),
-                      help="Weighting for the 1st stage of the scoring algorithm (default: %(default)s)\n"
-                           "  0: No weighting\n"
-                           "  1: Number of genes found\n"
-                           "  2: Number of genes expected\n"
-                           "  3: Proportion of genes found\n"
-                           "  4: blen (aligned bases of genes found)\n"
-                           "  5: q_len (query length of genes found)")
-    opts.add_argument('--n-best', type=int, default=2, metavar='',
-                      help='Number of best loci from the 1st round of scoring to be\n'
-                           'fully aligned to the assembly (default: %(default)s)')
-
+    scoring_opts(opts)
     opts = assembly_parser.add_argument_group(bold('Confidence options'), "")
-    opts.add_argument("--gene-threshold", type=float, metavar='',
-                      help="Species-level locus gene identity threshold (default: database specific)")
-    opts.add_argument("--max-other-genes", type=int, metavar='', default=1,
-                      help="Typeable if <= other genes (default: %(default)s)")
-    opts.add_argument("--percent-expected", type=float, metavar='', default=50,
-                      help="Typeable if >= %% expected genes (default: %(default)s)")
-    opts.add_argument("--below-threshold", type=bool, default=False, metavar='',
-                      help="Typeable if any genes are below threshold (default: %(default)s)")
+    confidence_opts(opts)
     opts = assembly_parser.add_argument_group(bold('Database options'), "")
     db_opts(opts)
     opts.add_argument('--filter', type=re.compile, metavar='',
                       help='Python regular-expression to select loci to include in the database')
+    db_cache_opts(opts)
     opts = assembly_parser.add_argument_group(bold('Other options'), "")
     other_opts(opts)
     opts.add_argument('-t', '--threads', type=check_cpus, default=check_cpus(), metavar='',
-                      help="Number of alignment threads or 0 for all available (default: 0)")
+                      help="Number of alignment threads or 0 for all available (default: 0)\n"
+                           "When using --jobs, these are shared between the jobs")
+    opts.add_argument('--jobs', type=int, default=1, metavar='',
+                      help="Number of assemblies to type in parallel (default: %(default)s)")
+    opts.add_argument('--unordered', action='store_true',
+                      help="With --jobs, write results as soon as each assembly is typed\n"
+                           "instead of in the same order as the input assemblies")
+    opts.add_argument('--overlap', type=int, default=1, metavar='',
+                      help="Without --jobs, type this many assemblies at a time in one process,\n"
+                           "overlapping parsing, alignment, gene evaluation and writing of\n"
+                           "successive assemblies; results stay in order (default: %(default)s)")
+    opts.add_argument('--batch', type=int, default=1, metavar='',
+                      help="Align the database to this many assemblies at a time with one\n"
+                           "minimap2 run (default: %(default)s)")
+    opts.add_argument('--batch-memory', type=int, default=500, metavar='',
+                      help="Max total size of a batch in MB, counting each assembly as the size\n"
+                           "of the largest, which bounds the memory used by minimap2 and the\n"
+                           "alignments (default: %(default)s)")
+    opts.add_argument('--persist-translations', action='store_true',
+                      help="Save gene translations in the cache directory and reuse them in later\n"
+                           "runs with the same database (faster for similar assemblies)")
+    opts.add_argument('--result-cache', type=int, nargs='?', default=None, const=1000, metavar='',
+                      help="Reuse the results of assemblies typed before with the same database and\n"
+                           "options, from a cache of up to this many MB in the cache directory\n"
+                           "(default: off, or %(const)s MB if no size is given), see kaptive cache")
+    profile_opts(opts)
 
 
 def convert_subparser(subparsers):
@@ -156,10 +164,78 @@ def convert_subparser(subparsers):
                       help='Space-separated list to filter sample names (default: All)')
     opts = convert_parser.add_argument_group(bold('Database options'), "")
     db_opts(opts)
+    db_cache_opts(opts)
     # Note, we don't allow users to filter the database here in case the results contain a locus that has been filtered
     # out of the database
     opts = convert_parser.add_argument_group(bold('Other options'), "")
     other_opts(opts)
+    opts.add_argument('--jobs', type=int, default=1, metavar='',
+                      help="Number of processes to convert the input with (default: %(default)s)\n"
+                           "Results are still written in the same order as the input")
+    profile_opts(opts)
+
+
+def index_subparser(subparsers):
+    index_parser = subparsers.add_parser(
+        'index', description=get_logo('Index Kaptive results for fast lookups'),
+        epilog=f'For more help, visit: {bold(_URL)}', add_help=False, formatter_class=argparse.RawTextHelpFormatter,
+        help='Index Kaptive results for fast lookups', usage="kaptive index <json> [<json> ...] [options]")
+    opts = index_parser.add_argument_group(bold('Inputs'), "")
+    opts.add_argument('input', nargs='+', metavar='json',
+                      help='Kaptive JSON lines files, each index is written to {json}.idx')
+    opts = index_parser.add_argument_group(bold('Other options'), "")
+    other_opts(opts)
+
+
+def cache_subparser(subparsers):
+    cache_parser = subparsers.add_parser(
+        'cache', description=get_logo('Inspect and prune the Kaptive result cache'),
+        epilog=f'For more help, visit: {bold(_URL)}', add_help=False, formatter_class=argparse.RawTextHelpFormatter,
+        help='Inspect and prune the Kaptive result cache', usage="kaptive cache <info|prune|clear> [options]")
+    opts = cache_parser.add_argument_group(bold('Inputs'), "")
+    opts.add_argument('action', choices=('info', 'prune', 'clear'), metavar='info|prune|clear',
+                      help='info: print the size of the result cache\n'
+                           'prune: remove the least recently used results down to --max-size\n'
+                           'clear: remove all cached results')
+    opts = cache_parser.add_argument_group(bold('Other options'), "")
+    opts.add_argument('--max-size', type=int, default=1000, metavar='',
+                      help='Size in MB to prune the cache down to (default: %(default)s)')
+    other_opts(opts)
+
+
+def serve_subparser(subparsers):
+    serve_parser = subparsers.add_parser(
+        'serve', description=get_logo('Serve typing requests with warm databases'),
+        epilog=f'For more help, visit: {bold(_URL)}', add_help=False, formatter_class=argparse.RawTextHelpFormatter,
+        help='Serve typing requests with warm databases', usage="kaptive serve <db> [<db> ...] [options]")
+    opts = serve_parser.add_argument_group(bold('Inputs'), "")
+    opts.add_argument('db', nargs='+', metavar='db path/keyword',
+                      help='Kaptive database paths or keywords, requests choose one by this or its name')
+    opts = serve_parser.add_argument_group(bold('Server options'), "")
+    opts.add_argument('--host', default='127.0.0.1', metavar='',
+                      help='Host to serve HTTP requests on (default: %(default)s)')
+    opts.add_argument('--port', type=int, default=8000, metavar='',
+                      help='Port to serve HTTP requests on (default: %(default)s)')
+    opts.add_argument('--socket', metavar='',
+                      help='Serve HTTP requests on this Unix socket instead of a port')
+    opts.add_argument('--jobs', type=int, default=1, metavar='',
+                      help="Number of assemblies to type in parallel (default: %(default)s)")
+    opts.add_argument('--queue', type=int, default=0, metavar='',
+                      help="Max requests accepted at a time, running or waiting, further\n"
+                           "requests are rejected with status 503 (default: 4 per job)")
+    opts = serve_parser.add_argument_group(bold('Scoring options'), "")
+    scoring_opts(opts)
+    opts = serve_parser.add_argument_group(bold('Confidence options'), "")
+    confidence_opts(opts)
+    opts = serve_parser.add_argument_group(bold('Database options'), "")
+    db_opts(opts)
+    opts.add_argument('--filter', type=re.compile, metavar='',
+                      help='Python regular-expression to select loci to include in the database')
+    db_cache_opts(opts)
+    opts = serve_parser.add_argument_group(bold('Other options'), "")
+    other_opts(opts)
+    opts.add_argument('-t', '--threads', type=check_cpus, default=1, metavar='',
+                      help="Number of alignment threads per job (default: %(default)s)")
 
 
 def extract_subparser(subparsers):
@@ -199,9 +275,47 @@ def other_fmt_opts(opts: argparse.ArgumentParser):
                            'Optionally choose a directory (default: cwd)')
     opts.add_argument('--plot-fmt', default='png', metavar='png/svg', choices={'png', 'svg'},
                       help='Format for locus plots (default: %(default)s)')
+    opts.add_argument('--plot-jobs', type=int, default=1, metavar='',
+                      help='Number of processes rendering plots while typing continues\n'
+                           '0 renders each plot before moving on (default: %(default)s)')
     opts.add_argument('--no-header', action='store_true', help='Suppress header line')
 
 
+def scoring_opts(opts: argparse.ArgumentParser):
+    """Scoring opts shared by assembly and serve"""
+    opts.add_argument('--min-cov', type=float, required=False, default=50.0, metavar='',
+                      help='Minimum gene %%coverage (blen/q_len*100) to be used for scoring (default: %(default)s)')
+    opts.add_argument("--score-metric", metavar='', default=0, type=int, choices=range(4),
+                      help="Metric for scoring each locus (default: %(default)s)\n"
+                           "  0: AS (alignment score of genes found)\n"
+                           "  1: mlen (matching bases of genes found)\n"
+                           "  2: blen (aligned bases of genes found)\n"
+                           "  3: q_len (query length of genes found)")
+    opts.add_argument("--weight-metric", metavar='', default=3, type=int, choices=range(6),
+                      help="Weighting for the 1st stage of the scoring algorithm (default: %(default)s)\n"
+                           "  0: No weighting\n"
+                           "  1: Number of genes found\n"
+                           "  2: Number of genes expected\n"
+                           "  3: Proportion of genes found\n"
+                           "  4: blen (aligned bases of genes found)\n"
+                           "  5: q_len (query length of genes found)")
+    opts.add_argument('--n-best', type=int, default=2, metavar='',
+                      help='Number of best loci from the 1st round of scoring to be\n'
+                           'fully aligned to the assembly (default: %(default)s)')
+
+
+def confidence_opts(opts: argparse.ArgumentParser):
+    """Confidence opts shared by assembly and serve"""
+    opts.add_argument("--gene-threshold", type=float, metavar='',
+                      help="Species-level locus gene identity threshold (default: database specific)")
+    opts.add_argument("--max-other-genes", type=int, metavar='', default=1,
+                      help="Typeable if <= other genes (default: %(default)s)")
+    opts.add_argument("--percent-expected", type=float, metavar='', default=50,
+                      help="Typeable if >= %% expected genes (default: %(default)s)")
+    opts.add_argument("--below-threshold", type=bool, default=False, metavar='',
+                      help="Typeable if any genes are below threshold (default: %(default)s)")
+
+
 def db_opts(opts: argparse.ArgumentParser):
     opts.add_argument('--locus-regex', type=re.compile, metavar='',
                       help=f'Python regular-expression to match locus names in db source note')
@@ -209,6 +323,21 @@ def db_opts(opts: argparse.ArgumentParser):
                       help=f'Python regular-expression to match locus types in db source note')
 
 
+def db_cache_opts(opts: argparse.ArgumentParser):
+    """Database cache opts shared by assembly, convert and serve"""
+    opts.add_argument('--db-cache', action='store_true',
+                      help='Load the parsed database from (or save it to) the cache directory instead\n'
+                           'of parsing it every run; the cache directory must only be writable by you')
+
+
+def profile_opts(opts: argparse.ArgumentParser):
+    """Profiling opts shared by assembly and convert"""
+    opts.add_argument('--profile', metavar='', type=argparse.FileType('wt'),
+                      help='Write the time spent in each stage to a Chrome trace JSON file')
+    opts.add_argument('--profile-memory', action='store_true',
+                      help='With --profile, also record the peak memory of each stage (slower)')
+
+
 def other_opts(opts: argparse.ArgumentParser):
     opts.add_argument('-V', '--verbose', action='store_true', help='Print debug messages to stderr')
     opts.add_argument('-v', '--version', help='Show version number and exit', metavar='')
@@ -224,24 +353,78 @@ def main():
         quit_with_error('Biopython version 1.83 or greater required')
 
     args = parse_args(sys.argv[1:])  # Parse the arguments
+    if getattr(args, 'profile', None):
+        trace.enable(args.profile_memory)
+    if getattr(args, 'plot', None) and args.plot_jobs > 0:  # Render plots in the background
+        from kaptive.typing import start_plots
+        start_plots(args.plot_jobs, args.verbose)
 
     # Assembly mode ----------------------------------------------------------------------------------------------------
     if args.subparser_name == 'assembly':
-        check_programs(['minimap2'], verbose=args.verbose)
-        from kaptive.assembly import typing_pipeline, write_headers
+        from kaptive.assembly import (typing_pipeline, typing_pool, typing_batch, typing_overlapped, write_headers,
+                                      mappy, ResultIndexWriter, completed_samples, assembly_name)
+        from kaptive.typing import load_translations, save_translations, ResultCache, _TRANSLATIONS
+        if not mappy or args.batch > 1:  # With mappy, alignments are performed in-process, except for batches
+            check_programs(['minimap2'], verbose=args.verbose)
         from kaptive.database import load_database
 
         args.db = load_database(
-            args.db, args.gene_threshold, locus_filter=args.filter, load_locus_seqs=True, verbose=args.verbose,
-            extract_translations=False, locus_regex=args.locus_regex, type_regex=args.type_regex)
+            args.db, args.gene_threshold, cache=args.db_cache, locus_filter=args.filter,
+            load_locus_seqs=True, verbose=args.verbose, extract_translations=False, locus_regex=args.locus_regex,
+            type_regex=args.type_regex)
+        if args.persist_translations:
+            load_translations(args.db, args.verbose)
+        cache = ResultCache(max_size=args.result_cache * 1_000_000, verbose=args.verbose) if args.result_cache else None
+
+        if args.resume:  # Skip assemblies with results from an earlier run, before anything is written
+            if not (files := [i.name for i in (args.out, args.json) if i and path.isfile(i.name)]):
+                quit_with_error('--resume needs a -o or -j file to find the assemblies already typed')
+            completed = completed_samples(files, args.verbose)
+            n_input, args.input = len(args.input), [i for i in args.input if assembly_name(i) not in completed]
+            log(f'Resuming: skipping {n_input - len(args.input)} of {n_input} assemblies already typed', verbose=True)
 
         write_headers(args.scores or args.out, args.no_header, args.scores)
-
-        for assembly in args.input:
-            if result := typing_pipeline(assembly, args.db, args.threads, args.score_metric, args.weight_metric,
-                                         args.min_cov, args.n_best, args.max_other_genes, args.percent_expected,
-                                         args.below_threshold, args.scores, args.verbose):
-                result.write(args.out, args.json, args.fasta, None, None, args.plot, args.plot_fmt)
+        if args.json and args.json is not sys.stdout and path.isfile(args.json.name):  # Index results for convert
+            args.json = ResultIndexWriter(args.json, args.verbose)
+
+        if args.jobs > 1 and len(args.input) > 1:  # Type assemblies in parallel, results are written by this process
+            for texts in typing_pool(
+                    args.input, args.db, args.jobs, not args.unordered, (args.out, args.json, args.fasta),
+                    args.plot, args.plot_fmt, args.scores, args.persist_translations, args.verbose,
+                    threads=max(1, args.threads // args.jobs),
+                    score_metric=args.score_metric, weight_metric=args.weight_metric, min_cov=args.min_cov,
+                    n_best=args.n_best, max_other_genes=args.max_other_genes,
+                    percent_expected_genes=args.percent_expected, allow_below_threshold=args.below_threshold,
+                    cache=cache, batch_size=args.batch,
+                    max_bases=args.batch_memory * 1_000_000):
+                [f.write(text) for f, text in zip((args.out, args.json, args.fasta, args.scores), texts) if text]
+        elif args.batch > 1:  # Align the database to each batch of assemblies together
+            for result in typing_batch(
+                    args.input, args.db, args.batch, args.batch_memory * 1_000_000, args.threads, args.verbose,
+                    score_metric=args.score_metric, weight_metric=args.weight_metric, min_cov=args.min_cov,
+                    n_best=args.n_best, max_other_genes=args.max_other_genes,
+                    percent_expected_genes=args.percent_expected, allow_below_threshold=args.below_threshold,
+                    score_file=args.scores, cache=cache):
+                if result:
+                    result.write(args.out, args.json, args.fasta, None, None, args.plot, args.plot_fmt)
+        elif args.overlap > 1 and len(args.input) > 1:  # Overlap the stages of successive assemblies
+            typing_overlapped(
+                args.input, args.db, args.overlap, 2, (args.out, args.json, args.fasta), args.plot, args.plot_fmt,
+                args.scores, args.threads, args.verbose, score_metric=args.score_metric,
+                weight_metric=args.weight_metric, min_cov=args.min_cov, n_best=args.n_best,
+                max_other_genes=args.max_other_genes, percent_expected_genes=args.percent_expected,
+                allow_below_threshold=args.below_threshold, cache=cache)
+        else:
+            for assembly in args.input:
+                if result := typing_pipeline(assembly, args.db, args.threads, args.score_metric, args.weight_metric,
+                                             args.min_cov, args.n_best, args.max_other_genes, args.percent_expected,
+                                             args.below_threshold, args.scores, args.verbose, cache=cache):
+                    result.write(args.out, args.json, args.fasta, None, None, args.plot, args.plot_fmt)
+        if args.persist_translations:
+            save_translations(args.db, args.verbose)
+        log(f'Translation cache: {_TRANSLATIONS}', verbose=args.verbose)
+        if cache and args.verbose:  # Only scan the cache for its size if it will be logged
+            log(f'Result cache {cache}', verbose=args.verbose)
 
     # Extract mode -----------------------------------------------------------------------------------------------------
     elif args.subparser_name == 'extract':
@@ -253,21 +436,75 @@ def main():
     # Convert mode -----------------------------------------------------------------------------------------------------
     elif args.subparser_name == 'convert':
         from kaptive.database import load_database
-        from kaptive.assembly import parse_result, write_headers
+        from kaptive.assembly import parse_result, write_headers, convert_pool, ResultIndex, ResultIndexError
 
         args.db = load_database(  # Load database in memory, we don't need to load the full sequences (False)
-            args.db, verbose=args.verbose, load_locus_seqs=False, extract_translations=False,
-            locus_regex=args.locus_regex, type_regex=args.type_regex)
+            args.db, cache=args.db_cache, verbose=args.verbose, load_locus_seqs=False,
+            extract_translations=False, locus_regex=args.locus_regex, type_regex=args.type_regex)
 
         write_headers(args.tsv, args.no_header)
 
-        for line in args.input:
-            if result := parse_result(line, args.db, args.regex, args.samples, args.loci):
-                result.write(args.tsv, args.json, args.fna, args.ffn, args.faa, args.plot, args.plot_fmt)
+        lines = args.input
+        if (args.samples or args.loci) and path.isfile(args.input.name) and (
+                index := ResultIndex.load(args.input.name, args.verbose)):  # Only read the selected results
+            try:
+                lines = index.lines(args.samples, args.loci)
+            except ResultIndexError as e:
+                warning(f'{e}, reading every result')
+        if lines is args.input and args.jobs > 1 and path.isfile(args.input.name):  # Convert ranges in parallel
+            outputs = (args.tsv, args.json, args.fna, args.ffn, args.faa)
+            for texts in convert_pool(args.input.name, args.db, args.jobs, args.regex, args.samples, args.loci,
+                                      outputs, args.plot, args.plot_fmt, args.verbose):
+                [f.write(text) for f, text in zip(outputs, texts) if text]
+        else:
+            for line in lines:
+                if result := parse_result(line, args.db, args.regex, args.samples, args.loci):
+                    result.write(args.tsv, args.json, args.fna, args.ffn, args.faa, args.plot, args.plot_fmt)
+
+    # Index mode -------------------------------------------------------------------------------------------------------
+    elif args.subparser_name == 'index':
+        from kaptive.assembly import ResultIndex
+        for file in args.input:
+            if file := check_file(file):
+                log(f'Wrote {ResultIndex.build(file, args.verbose)}', verbose=args.verbose)
+
+    # Cache mode -------------------------------------------------------------------------------------------------------
+    elif args.subparser_name == 'cache':
+        from datetime import datetime
+        from kaptive.typing import ResultCache
+        cache = ResultCache(max_size=args.max_size * 1_000_000, verbose=args.verbose)
+        if args.action in {'prune', 'clear'}:
+            removed, freed = cache.prune(0 if args.action == 'clear' else cache.max_size)
+            print(f'Removed {removed} results ({freed / 1e6:.1f} MB)')
+        entries = [i.stat() for i in cache.entries()]
+        print(f'{cache.directory}\t{len(entries)} results\t{sum(i.st_size for i in entries) / 1e6:.1f} MB' +
+              (f'\tlast used {datetime.fromtimestamp(max(i.st_mtime for i in entries)):%Y-%m-%d %H:%M:%S}'
+               if entries else ''))
+
+    # Serve mode -------------------------------------------------------------------------------------------------------
+    elif args.subparser_name == 'serve':
+        from kaptive.assembly import mappy
+        from kaptive.database import load_database
+        from kaptive.serve import serve
+        if not mappy:
+            check_programs(['minimap2'], verbose=args.verbose)
+        dbs = {db: load_database(
+            db, args.gene_threshold, cache=args.db_cache, locus_filter=args.filter, load_locus_seqs=True,
+            verbose=args.verbose, extract_translations=False, locus_regex=args.locus_regex,
+            type_regex=args.type_regex) for db in args.db}
+        serve(dbs, args.host, args.port, args.socket, args.jobs, args.queue, args.threads, args.verbose,
+              score_metric=args.score_metric, weight_metric=args.weight_metric, min_cov=args.min_cov,
+              n_best=args.n_best, max_other_genes=args.max_other_genes, percent_expected_genes=args.percent_expected,
+              allow_below_threshold=args.below_threshold)
 
     # Cleanup ----------------------------------------------------------------------------------------------------------
+    if getattr(args, 'plot', None) and args.plot_jobs > 0:  # Wait for the plots to be written
+        from kaptive.typing import finish_plots
+        finish_plots()
+    if getattr(args, 'profile', None):
+        trace.write(args.profile)
     for attr in vars(args):  # Close all open files in the args namespace if they aren't sys.stdout or sys.stdin
-        if (x := getattr(args, attr, None)) and isinstance(x, TextIOWrapper) and x not in {sys.stdout, sys.stdin}:
+        if (x := getattr(args, attr, None)) and isinstance(x, TextIOBase) and x not in {sys.stdout, sys.stdin}:
             x.close()  # Close the file
 
     log("Done!", verbose=args.verbose)
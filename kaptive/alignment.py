@@ -11,9 +11,18 @@ details. You should have received a copy of the GNU General Public License along
 If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
+from sys import intern
 from typing import Iterable, Generator
 from itertools import groupby
-from kaptive.utils import range_overlap
+from collections import defaultdict
+from operator import attrgetter
+from kaptive.utils import range_overlap, IntervalIndex
+
+# Constants -----------------------------------------------------------------------------------------------------------
+# Default minimap2 scoring used to recalculate the alignment score (AS) from in-process mappy alignments
+_MATCH, _MISMATCH, _AMBIGUOUS, _GAP_OPEN, _GAP_EXTEND, _LONG_GAP_OPEN, _LONG_GAP_EXTEND = 2, 4, 1, 4, 2, 24, 1
+_CIGAR_TAGS = {'cg', 'cs', 'MD'}  # Tags describing the alignment from the query's point of view
+_MISSING = object()  # Sentinel for missing tags
 
 
 # Classes -------------------------------------------------------------------------------------------------------------
@@ -24,59 +33,107 @@ class AlignmentError(Exception):
 class Alignment:
     """
     Similar to `mappy.Alignment` but with additional attributes and methods.
+    As the gene pass produces alignments of every gene in every locus, alignments use __slots__, names are interned
+    and the SAM-style tags of PAF lines are kept as text and only decoded when they are used.
     """
+    __slots__ = ('q', 'q_len', 'q_st', 'q_en', 'strand', 'ctg', 'ctg_len', 'r_st', 'r_en', 'mlen', 'blen', 'mapq',
+                 '_tags', '_raw_tags')
 
     def __init__(
             self, q: str = None, q_len: int | None = 0, q_st: int | None = 0,
             q_en: int | None = 0, strand: str = None, ctg: str = None,
             ctg_len: int | None = 0, r_st: int | None = 0, r_en: int | None = 0,
             mlen: int | None = 0, blen: int | None = 0, mapq: int | None = 0,
-            tags: dict = None):
-        self.q = q or 'unknown'  # Query sequence name
+            tags: dict = None, raw_tags: str = ''):
+        self.q = intern(q) if q else 'unknown'  # Query sequence name
         self.q_len = q_len  # Query sequence length
         self.q_st = q_st  # Query start coordinate (0-based)
         self.q_en = q_en  # Query end coordinate (0-based)
         self.strand = strand or 'unknown'  # ‘+’ if query/target on the same strand; ‘-’ if opposite
-        self.ctg = ctg or 'unknown'  # Target sequence name
+        self.ctg = intern(ctg) if ctg else 'unknown'  # Target sequence name
         self.ctg_len = ctg_len  # Target sequence length
         self.r_st = r_st  # Target start coordinate on the original strand (0-based)
         self.r_en = r_en  # Target end coordinate on the original strand (0-based)
         self.mlen = mlen  # Number of matching bases in the alignment
         self.blen = blen  # Number bases, including gaps, in the alignment
         self.mapq = mapq  # Mapping quality (0-255 with 255 for missing)
-        self.tags = tags or {}  # {tag: value} pairs
+        self._tags = tags  # {tag: value} pairs, decoded from the raw tags when first used if None
+        self._raw_tags = raw_tags  # Tab-separated SAM-style tags, e.g. from a PAF line
 
     @classmethod
     def from_paf_line(cls, line: str):
         """
         Parse a line in PAF format and return an Alignment object.
         """
-        if len(line := line.split('\t')) < 12:
+        if len(line := line.split('\t', 12)) < 12:  # Tags are left in one string to be decoded when needed
             raise AlignmentError(f"Line has < 12 columns: {line}")
         try:
             return Alignment(  # Parse standard fields
                 q=line[0], q_len=int(line[1]), q_st=int(line[2]), q_en=int(line[3]), strand=line[4], ctg=line[5],
                 ctg_len=int(line[6]), r_st=int(line[7]), r_en=int(line[8]), mlen=int(line[9]), blen=int(line[10]),
-                mapq=int(line[11]),
-                tags={(x := t.split(":", 2))[0]: int(x[2]) if x[1] == "i" else float(x[2]) if x[1] == "f" else x[2] for
-                      t in line[12:]}
+                mapq=int(line[11]), raw_tags=line[12] if len(line) > 12 else ''
             )
         except Exception as e:
             raise AlignmentError(f"Error parsing PAF line: {line}") from e
 
+    @classmethod
+    def from_mappy(cls, q: str, q_len: int, hit: 'mappy.Alignment'):
+        """
+        Create an Alignment object from a `mappy.Alignment` hit of query `q`. Mappy doesn't report the alignment
+        score (AS), so it is recalculated from the CIGAR with the default minimap2 scoring, as written by minimap2 -c.
+        """
+        matches = sum(length for length, op in hit.cigar if op == 0)  # Total length of M operations
+        ambiguous = hit.NM - (hit.blen - hit.mlen)  # Ambiguous bases are counted in NM but not in blen
+        score = (_MATCH * hit.mlen - _MISMATCH * (matches - ambiguous - hit.mlen) - _AMBIGUOUS * ambiguous -
+                 sum(min(_GAP_OPEN + _GAP_EXTEND * length, _LONG_GAP_OPEN + _LONG_GAP_EXTEND * length)
+                     for length, op in hit.cigar if op in {1, 2}))  # Dual affine gap cost of each I and D operation
+        return cls(
+            q=q, q_len=q_len, q_st=hit.q_st, q_en=hit.q_en, strand='+' if hit.strand > 0 else '-', ctg=hit.ctg,
+            ctg_len=hit.ctg_len, r_st=hit.r_st, r_en=hit.r_en, mlen=hit.mlen, blen=hit.blen, mapq=hit.mapq,
+            tags={'NM': hit.NM, 'AS': score, 'tp': 'P' if hit.is_primary else 'S', 'cg': hit.cigar_str}
+        )
+
+    def swapped(self) -> Alignment:
+        """
+        Returns a copy of the alignment with the query and target swapped, e.g. to turn an alignment of a contig to a
+        database gene into an alignment of the gene to the contig. Tags describing the CIGAR are not kept.
+        """
+        return Alignment(
+            q=self.ctg, q_len=self.ctg_len, q_st=self.r_st, q_en=self.r_en, strand=self.strand, ctg=self.q,
+            ctg_len=self.q_len, r_st=self.q_st, r_en=self.q_en, mlen=self.mlen, blen=self.blen, mapq=self.mapq,
+            tags=None if self._tags is None else {k: v for k, v in self._tags.items() if k not in _CIGAR_TAGS},
+            raw_tags='\t'.join(t for t in self._raw_tags.split('\t') if t[:2] not in _CIGAR_TAGS)
+        )
+
+    @property
+    def tags(self) -> dict:
+        """All tags as {tag: value} pairs, decoding the raw tags the first time"""
+        if self._tags is None:
+            self._tags = dict(map(_decode_tag, self._raw_tags.split('\t'))) if self._raw_tags else {}
+        return self._tags
+
+    def tag(self, name: str, default=None):
+        """Returns the value of a tag, only decoding that tag if the tags haven't been decoded yet"""
+        if self._tags is not None:
+            return self._tags.get(name, default)
+        if self._raw_tags.startswith(f'{name}:'):
+            start = 0
+        elif (start := self._raw_tags.find(f'\t{name}:')) == -1:
+            return default
+        else:
+            start += 1
+        return _decode_tag(self._raw_tags[start:end if (end := self._raw_tags.find('\t', start)) != -1 else None])[1]
+
     def __repr__(self):
         return f'{self.q}:{self.q_st}-{self.q_en} {self.ctg}:{self.r_st}-{self.r_en} {self.strand}'
 
     def __len__(self):
         return self.num_bases
 
-    def __getattr__(self, item):
-        if item in self.__dict__:  # First check attributes
-            return self.__dict__[item]
-        elif item in self.tags:  # Then check tags
-            return self.tags[item]
-        else:
-            raise AttributeError(f"{self.__class__.__name__} object has no attribute {item}")
+    def __getattr__(self, item):  # Only called if item isn't an attribute, so check the tags
+        if not item.startswith('_') and (value := self.tag(item, _MISSING)) is not _MISSING:
+            return value
+        raise AttributeError(f"{self.__class__.__name__} object has no attribute {item}")
 
     @property
     def partial(self) -> bool:
@@ -94,6 +151,12 @@ class Alignment:
 
 
 # Functions ------------------------------------------------------------------------------------------------------------
+def _decode_tag(tag: str) -> tuple[str, int | float | str]:
+    """Decodes a SAM-style tag (e.g. AS:i:100) to a (tag, value) tuple"""
+    name, kind, value = tag.split(':', 2)
+    return name, int(value) if kind == 'i' else float(value) if kind == 'f' else value
+
+
 def group_alns(alignments: Iterable[Alignment], key: str = 'q') -> Generator[tuple[str, Generator[Alignment]]]:
     """Group alignments by a key"""
     yield from groupby(sorted(alignments, key=lambda x: getattr(x, key)), key=lambda x: getattr(x, key))
@@ -108,12 +171,23 @@ def cull(keep: Alignment, alignments: Iterable[Alignment],
             yield a
 
 
+def conflicts(a: Alignment, kept: dict[str, IntervalIndex], overlap_fraction: float = 0.1) -> bool:
+    """
+    Whether the alignment conflicts with any kept alignment, i.e. the reverse of cull for each kept alignment.
+    Kept alignments are indexed by contig so only the alignments overlapping this one are checked.
+    """
+    return (index := kept.get(a.ctg)) is not None and any(
+        not range_overlap((a.r_st, a.r_en), (start, end), skip_sort=True) / a.blen < overlap_fraction
+        for start, end, _ in index.overlapping(a.r_st, a.r_en))
+
+
 def cull_all(alignments: list[Alignment]) -> list[Alignment]:
-    kept_alignments = []
-    sorted_alignments = sorted(list(alignments), key=lambda x: x.mlen, reverse=True)
-    while sorted_alignments:
-        kept_alignments.append(sorted_alignments.pop(0))
-        sorted_alignments = list(cull(kept_alignments[-1], sorted_alignments))
+    """Keeps alignments in order of mlen that don't conflict with a kept alignment with a higher (or equal) mlen"""
+    kept_alignments, kept = [], defaultdict(IntervalIndex)
+    for a in sorted(alignments, key=attrgetter('mlen'), reverse=True):
+        if not conflicts(a, kept):
+            kept_alignments.append(a)
+            kept[a.ctg].add(a.r_st, a.r_en)
     return kept_alignments
 
 
@@ -122,13 +196,13 @@ def cull_filtered(pred: callable, alignments: Iterable[Alignment]) -> Generator[
     Cull and flatten alignments that don't overlap with alignments matching the predicate.
     E.g. list(cull_filtered(lambda i: i.q in query_genes, alignments))
     """
-    keep, other = [], []
+    keep, other, kept = [], [], defaultdict(IntervalIndex)
     [(keep if pred(a) else other).append(a) for a in alignments]
-    other = cull_all(other)  # Remove conflicting other alignments
-    for i in keep:  # Remove other alignments overlapping best match gene alignments
-        other = list(cull(i, other))
+    for i in keep:
+        kept[i.ctg].add(i.r_st, i.r_en)
         yield i
-    yield from other
+    # Remove conflicting other alignments, then other alignments overlapping alignments matching the predicate
+    yield from (a for a in cull_all(other) if not conflicts(a, kept))
 
 # def extend_aln_ranges(q_len: int, q_st: int, q_en: int, ctg_len: int, r_st: int, r_en: int, tolerance: int = 10
 #                       ) -> tuple[int, int, int, int]:
@@ -0,0 +1,171 @@
+"""
+An embeddable typing API: a Typer holds a loaded database and (optionally) a pool of worker processes, so services
+that type many genomes only pay for these once rather than once per genome.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from os import PathLike
+from json import loads
+from collections import deque
+from typing import Iterable, Generator, Union
+
+from kaptive.assembly import Assembly, typing_pipeline, assembly_from_records, parse_assembly, minimap2_installed
+from kaptive.database import Database, load_database
+from kaptive.typing import TypingResult
+from kaptive.utils import check_cpus
+from kaptive.log import log
+from kaptive import trace
+
+# Constants -----------------------------------------------------------------------------------------------------------
+AssemblyInput = Union[str, PathLike, Assembly, tuple]  # Path, Assembly or (name, contig records), see to_assembly
+_WORKER_DB = None  # Database used by Typer worker processes, set once per worker by _init_typer_worker
+
+
+# Classes -------------------------------------------------------------------------------------------------------------
+class TyperError(Exception):
+    pass
+
+
+class Typer:
+    """
+    Types assemblies with a database that is loaded once. Assemblies can be paths to assembly files, Assembly objects
+    or in-memory contigs, as (name, records) where records are (header, sequence) tuples or SeqRecords.
+    Files and Assembly objects are typed exactly as with kaptive assembly. In-memory assemblies are never written to
+    disk: their contigs are streamed to minimap2, which gives the same results as typing them from a file, so they
+    need the minimap2 executable even if mappy is installed (TyperError is raised without it).
+
+    Example:
+        with Typer('kpsc_k', jobs=4) as typer:
+            for result in typer.type_all(('sample', SeqIO.parse(f, 'fasta')) for f in files):
+                ...
+    """
+    def __init__(self, db: str | PathLike | Database, jobs: int = 1, threads: int = 0, max_pending: int = 0,
+                 verbose: bool = False, **kwargs):
+        """
+        :param db: Database object, or path/keyword of the database to load
+        :param jobs: Number of worker processes, 1 to type in this process
+        :param threads: Number of alignment threads per job (default: available CPUs divided by jobs)
+        :param max_pending: Maximum number of assemblies submitted to the workers and not yet yielded by type_all, so
+                            the input is only read as fast as results are consumed (default: 2 per job)
+        :param verbose: Print progress to stderr
+        :param kwargs: Other keyword arguments to pass to the typing_pipeline (e.g. min_cov, n_best)
+        """
+        if not isinstance(db, Database) and not (db := load_database(db, verbose=verbose)):
+            raise TyperError(f'Could not load database {db}')
+        self.db = db
+        self.jobs = max(jobs, 1)
+        self.threads = threads or max(check_cpus(verbose=verbose) // self.jobs, 1)
+        self.max_pending = max_pending or self.jobs * 2
+        self.verbose = verbose
+        self.kwargs = kwargs | {'threads': self.threads, 'verbose': verbose}
+        self._pool = None
+        if self.jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(self.jobs, initializer=_init_typer_worker,
+                                             initargs=(db, trace.settings()))
+        log(f'Typing with {db.name}, {self.jobs} jobs and {self.threads} threads per job', verbose=verbose)
+
+    def __repr__(self):
+        return f'Typer({self.db.name}, jobs={self.jobs}, threads={self.threads})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def type(self, assembly: AssemblyInput) -> TypingResult | None:
+        """
+        Types one assembly in this process
+        :param assembly: Path, Assembly or (name, records), see to_assembly
+        :return: TypingResult, or None if the assembly couldn't be typed
+        """
+        if not (assembly := to_assembly(assembly, self.verbose)):
+            return None
+        return typing_pipeline(assembly, self.db, **self.kwargs)
+
+    def type_all(self, assemblies: Iterable[AssemblyInput]) -> Generator[TypingResult | None, None, None]:
+        """
+        Types assemblies, in the worker pool if jobs > 1, yielding the results in input order. The input is consumed
+        lazily: at most max_pending assemblies are read ahead of the results, so a generator of in-memory assemblies
+        is never held in memory all at once.
+        :param assemblies: Paths, Assemblies or (name, records), see to_assembly
+        :return: Generator of the TypingResult (or None if the assembly couldn't be typed) of each assembly
+        """
+        if not self._pool:
+            yield from map(self.type, assemblies)
+            return None
+        pending = deque()
+        for assembly in assemblies:
+            if isinstance(assembly, Assembly) and assembly.path is not None:
+                assembly = assembly.path  # Parsed again in the worker, as open file indexes can't be sent to it
+            elif not isinstance(assembly, (str, PathLike)):  # In-memory assemblies are created here
+                assembly = to_assembly(assembly, self.verbose)
+            pending.append(self._pool.submit(_typer_worker, assembly, self.kwargs))
+            if len(pending) >= self.max_pending:
+                yield self._result(pending.popleft())
+        while pending:
+            yield self._result(pending.popleft())
+
+    def close(self):
+        """Stops the worker processes"""
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _result(self, future) -> TypingResult | None:
+        """Recreates the result of a worker with this process's database, as results are returned as JSON"""
+        text, counts, events = future.result()
+        if cache := self.kwargs.get('cache'):  # Add the result cache hits and misses of the worker
+            cache.hits, cache.misses = cache.hits + counts[0], cache.misses + counts[1]
+        trace.add_events(events)
+        return TypingResult.from_dict(loads(text), self.db) if text else None
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def to_assembly(assembly: AssemblyInput, verbose: bool = False) -> Assembly | None:
+    """
+    Returns an Assembly from a path (parsed with parse_assembly), an Assembly (returned as is) or a (name, records)
+    tuple, where records are (header, sequence) tuples or SeqRecords (an in-memory Assembly, see
+    assembly_from_records)
+    :raises TyperError: If the input isn't one of these, or is in memory and the minimap2 executable isn't installed
+    """
+    if isinstance(assembly, (str, PathLike)):
+        return parse_assembly(assembly, verbose=verbose)
+    if isinstance(assembly, tuple) and len(assembly) == 2 and isinstance(assembly[0], str):
+        assembly = assembly_from_records(*assembly)
+    elif not isinstance(assembly, Assembly):
+        raise TyperError(f'Assemblies must be paths, Assembly objects or (name, records) tuples, not {type(assembly)}')
+    if assembly.path is None and not minimap2_installed():  # The contigs are streamed to minimap2, see Assembly.map
+        raise TyperError(f'Could not type {assembly}, in-memory assemblies need the minimap2 executable')
+    return assembly
+
+
+def _init_typer_worker(db: Database, trace_settings: dict | None):
+    """Stores the database in the worker process so it is only copied once per worker"""
+    global _WORKER_DB
+    _WORKER_DB = db
+    if trace_settings:
+        trace.enable(process_name='kaptive worker', **trace_settings)
+
+
+def _typer_worker(assembly: str | PathLike | Assembly, kwargs: dict
+                  ) -> tuple[str | None, tuple[int, int], list[dict]]:
+    """
+    Types an assembly in a worker process, returning the result as JSON (None if untypeable), the hits and misses of
+    the result cache (if any) and trace events
+    """
+    result = typing_pipeline(assembly, _WORKER_DB, **kwargs)
+    counts = cache.pop_counts() if (cache := kwargs.get('cache')) else (0, 0)
+    return result.format('json') if result else None, counts, trace.pop_events()
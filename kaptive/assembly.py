@@ -15,24 +15,35 @@ If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
 
-from itertools import chain
+from itertools import chain, compress
+from collections import defaultdict, deque
+from operator import attrgetter
 from json import loads
+from io import StringIO, TextIOBase
 from subprocess import Popen, PIPE
-from typing import TextIO, Pattern, Generator
+from typing import TextIO, Pattern, Generator, Iterable
 from re import compile
-from os import fstat, PathLike, path
+from os import fstat, PathLike, path, close, remove
+from tempfile import mkstemp, NamedTemporaryFile
+from functools import lru_cache
+from shutil import which
+from weakref import finalize
 
 from Bio.Seq import Seq
-from Bio.SeqIO.FastaIO import SimpleFastaParser
-import numpy as np
 
-np.seterr(divide='ignore', invalid='ignore')  # Ignore divide by zero and invalid value errors
+try:  # Optional, if installed alignments are performed in-process instead of with the minimap2 executable
+    import mappy
+except ImportError:
+    mappy = None
 
-from kaptive.typing import TypingResult, LocusPiece, GeneResult
-from kaptive.database import Database, load_database
+from kaptive.typing import (TypingResult, LocusPiece, GeneResult, ResultCache, load_translations, plot_pool,
+                            _TRANSLATIONS)
+from kaptive.database import Database, Locus, load_database
 from kaptive.alignment import Alignment, group_alns, cull_filtered
-from kaptive.utils import opener, merge_ranges, range_overlap, check_cpus, check_file
+from kaptive.utils import (opener, merge_ranges, check_cpus, check_file, stream_command, IntervalIndex, FastaIndex,
+                           FastaIndexError, line_ranges, read_lines, parse_fasta)
 from kaptive.log import log, warning
+from kaptive import trace
 
 # Constants -----------------------------------------------------------------------------------------------------------
 # _ASSEMBLY_FASTA_REGEX = compile(r'\.(fasta|fa|fna|ffn)(\.gz|\.bz2|\.xz)?$')
@@ -44,6 +55,13 @@ _ASSEMBLY_HEADER = ('Assembly\tBest match locus\tBest match type\tMatch confiden
                     'Other genes outside locus\tOther genes outside locus, details\t'
                     'Truncated genes, details\tExtra genes, details\n')
 _SCORES_HEADER = 'Assembly\tLocus\tAS\tmlen\tblen\tq_len\tgenes_found\tgenes_expected\n'
+_WORKER_DB = None  # Database used by typing pool worker processes, set once per worker by _init_typing_worker
+_MIN_MID_OCC = 10  # Lowest repetitive minimizer threshold minimap2 uses (--min-occ-floor), see map_batch
+_MAX_PART_SIZE = 50_000_000  # minimap2 reads the target in chunks of this many bases, so a part can't be longer
+_REP_LEN_REGEX = compile(r'\trl:i:(\d+)')  # Length of the query covered by repetitive (filtered) seeds
+_RESULT_INDEX_SUFFIX = '.idx'  # Suffix of the sidecar index of a JSON lines results file
+_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # Maximum number of bytes of results converted by a convert_pool worker at a time
+_SAMPLE_NAME_REGEX = compile(r'\{"sample_name": ("(?:[^"\\]|\\.)*")')  # Sample name, the first key of a JSON result
 
 
 # Classes -------------------------------------------------------------------------------------------------------------
@@ -53,32 +71,105 @@ class AssemblyError(Exception):
 
 class Assembly:
     def __init__(self, path_: PathLike = None, name: str = None,
-                 contigs: dict[str: Contig] = None):
+                 contigs: dict[str: Contig] = None, fasta: FastaIndex = None):
         self.path = path_
         self.name = name
         self.contigs = contigs or {}
+        self._fasta = fasta  # Index the contig sequences are fetched from, None if they are in memory
+        self._index = None  # Temporary minimap2 index built on the first alignment, or the path if that failed
+        self._index_finalizer = None
+        self._aligner = None  # In-memory mappy index, used if mappy is installed, False if it failed
 
     def __repr__(self):
         return self.name
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.remove_index()
+        if self._fasta:
+            self._fasta.close()
+
     def __len__(self):
         return sum(len(i) for i in self.contigs.values())
 
     def seq(self, ctg: str, start: int, end: int, strand: str = "+") -> Seq:
-        return self.contigs[ctg].seq[start:end] if strand == "+" else self.contigs[ctg].seq[
-                                                                      start:end].reverse_complement()
+        return self.contigs[ctg].subseq(start, end, strand)
+
+    def index(self, threads: int, verbose: bool = False) -> str | PathLike:
+        """
+        Builds a minimap2 index of the assembly in a temporary file so the assembly is only read and indexed once,
+        no matter how many times it is aligned to. Returns the path to the index, or the assembly path if the
+        index could not be built (minimap2 will then index the assembly on the fly). A failure is also kept, so the
+        index isn't built again for every alignment.
+        """
+        if self._index is None:
+            fd, index = mkstemp(suffix='.mmi', prefix='kaptive_')
+            close(fd)
+            cmd = f'minimap2 -t {threads} -d "{index}" "{self.path}"'
+            log(f"{cmd=}", verbose=verbose)
+            trace.begin('index assembly')
+            process = Popen(cmd, stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
+            stderr = process.communicate()[1]
+            trace.end()
+            if process.returncode:  # Indexing failed, fall back to the assembly path
+                remove(index)
+                warning(f"Could not index {self}, it will be indexed during alignment\n{stderr}")
+                self._index = self.path
+                return self._index
+            self._index, self._index_finalizer = index, finalize(self, remove, index)  # Remove index on cleanup
+        return self._index
+
+    def aligner(self, threads: int, verbose: bool = False) -> mappy.Aligner | None:
+        """
+        Builds the in-memory mappy index of the assembly once so it can be reused, returns None on failure (which is
+        also kept, so the index isn't built again for every alignment)
+        """
+        if self._aligner is None:
+            log(f'Indexing {self} with mappy', verbose=verbose)
+            trace.begin('index assembly')
+            aligner = mappy.Aligner(str(self.path), n_threads=threads)  # Default minimap2 options
+            trace.end()
+            if not aligner:
+                warning(f"Could not index {self} with mappy, falling back to minimap2")
+            self._aligner = aligner or False
+        return self._aligner or None
+
+    def remove_index(self):
+        """Removes the minimap2 index if it exists; it will be rebuilt if the assembly is mapped again"""
+        if self._index_finalizer is not None:
+            self._index_finalizer()  # Only removes the file once, even if called again by the garbage collector
+        self._index, self._index_finalizer, self._aligner = None, None, None
 
     def map(self, query: str, threads: int, extra_args: str = '', verbose: bool = False
             ) -> Generator[Alignment, None, None]:
-        cmd = "minimap2 -c " + (f"{extra_args} " if extra_args else '') + f'-t {threads} "{self.path}" -'
-        log(f"{cmd=}", verbose=verbose)
-        stdout, stderr = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True,
-                               shell=True).communicate(query)
-        if not stdout and stderr:  # No alignments, maybe an error with minimap2
-            return warning(stderr)
-        for line in stdout.splitlines():
-            yield Alignment.from_paf_line(line)
-
+        """
+        Aligns the query fasta string to the assembly. If mappy is installed, the alignment is performed in-process,
+        otherwise (or if extra minimap2 arguments are passed) the minimap2 executable is used.
+        In-memory assemblies (with no path) are always aligned with the minimap2 executable: the contigs are streamed
+        to minimap2 as the target and the query is read from a temporary file, so the assembly is never written to
+        disk and the alignments are the same as if it had been read from a file.
+        """
+        if self.path is None:
+            with NamedTemporaryFile('wt', prefix='kaptive_', suffix='.fasta') as f:  # stdin is taken by the target
+                f.write(query)
+                f.flush()
+                cmd = "minimap2 -c " + (f"{extra_args} " if extra_args else '') + f'-t {threads} - "{f.name}"'
+                yield from trace.timed(Alignment.from_paf_line, stream_command(
+                    cmd, (f'>{i.name}\n{i.seq}\n' for i in self.contigs.values()), verbose), 'parse_ms')
+            return None
+        if mappy and not extra_args and (aligner := self.aligner(threads, verbose)):
+            for name, seq in parse_fasta(query):
+                name = name.split(maxsplit=1)[0]
+                # The name seeds the hash minimap2 breaks ties between equal scoring hits with, as in the executable
+                yield from trace.timed(lambda hit: Alignment.from_mappy(name, len(seq), hit),
+                                       aligner.map(seq, name=name), 'parse_ms')
+            return None
+        cmd = ("minimap2 -c " + (f"{extra_args} " if extra_args else '') +
+               f'-t {threads} "{self.index(threads, verbose)}" -')
+        # Parse alignments as soon as minimap2 writes them
+        yield from trace.timed(Alignment.from_paf_line, stream_command(cmd, query, verbose), 'parse_ms')
 
 class ContigError(Exception):
     pass
@@ -86,28 +177,170 @@ class ContigError(Exception):
 
 class Contig(object):
     """
-    This class describes a contig in an assembly: the name, length, and sequence.
+    This class describes a contig in an assembly: the name, length, and sequence. If the contig is in an indexed
+    fasta file, the sequence is fetched from the file when needed instead of being kept in memory.
     """
 
-    def __init__(self, name: str, desc: str, seq: Seq):
+    def __init__(self, name: str, desc: str, seq: Seq = None, length: int = None, fasta: FastaIndex = None):
         self.name = name
         self.desc = desc
-        self.seq = seq
+        self._seq = seq
+        self._length = len(seq) if seq is not None else length
+        self._fasta = fasta
+        if seq is None and fasta is None:
+            raise ContigError(f'Contig {name} needs a sequence or fasta index')
 
     def __repr__(self):
         return self.name
 
     def __len__(self):
-        return len(self.seq)
+        return self._length
+
+    @property
+    def seq(self) -> Seq:
+        return self._seq if self._seq is not None else Seq(self._fasta.fetch(self.name))
+
+    def subseq(self, start: int, end: int, strand: str = "+") -> Seq:
+        """Returns the start-end region of the contig, reverse complemented unless the strand is +"""
+        if self._seq is not None:
+            return self._seq[start:end] if strand == "+" else self._seq[start:end].reverse_complement()
+        return Seq(self._fasta.fetch(self.name, start, end, reverse_complement=strand != "+"))
+
+
+class ResultIndexError(Exception):
+    pass
+
+
+class ResultIndex:
+    """
+    Sidecar index of a Kaptive JSON lines results file (file.idx) with the sample name, best match locus, confidence,
+    byte offset and length of each line, so results can be selected without parsing the whole file.
+    The index is stale if it doesn't end where the file ends, e.g. if results were appended without updating it.
+    """
+
+    def __init__(self, file: str | PathLike, entries: list[tuple[str, str, str, int, int]] = None):
+        self.file = file
+        self.path = f'{file}{_RESULT_INDEX_SUFFIX}'
+        self.entries = entries or []
+        self.size = self.entries[-1][3] + self.entries[-1][4] if self.entries else 0  # Bytes of the file indexed
+
+    def __repr__(self):
+        return f'{self.path}: {len(self)} results'
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, file: str | PathLike, verbose: bool = False) -> ResultIndex | None:
+        """Loads the index of a results file, or returns None if there isn't one or it is stale"""
+        if not path.isfile(index := f'{file}{_RESULT_INDEX_SUFFIX}'):
+            return None
+        try:
+            with open(index, 'rt') as f:
+                self = cls(file, [(sample, locus, confidence, int(offset), int(length)) for
+                                  sample, locus, confidence, offset, length in (i.rstrip('\n').split('\t') for i in f)])
+        except Exception as e:
+            return warning(f'Error reading {index}: {e}')
+        if self.size != path.getsize(file):
+            return log(f'{index} is stale', verbose=verbose)
+        return self
+
+    @classmethod
+    def build(cls, file: str | PathLike, verbose: bool = False) -> ResultIndex:
+        """Indexes a results file by reading each line and writes the index"""
+        log(f'Indexing {file}', verbose=verbose)
+        self = cls(file)
+        with open(file, 'rb') as f:
+            [self.add(line) for line in f]
+        self.write()
+        return self
+
+    def add(self, line: bytes):
+        """Adds the next line of the results file to the index"""
+        try:
+            d = loads(line)
+            entry = (d['sample_name'], d['best_match'], d['confidence'])
+        except Exception:  # Not a result, e.g. a blank line, but still indexed so the index covers the whole file
+            entry = ('', '', '')
+        self.entries.append((*entry, self.size, len(line)))
+        self.size += len(line)
+
+    def write(self):
+        with open(self.path, 'wt') as f:
+            f.write(''.join(f'{s}\t{l}\t{c}\t{o}\t{n}\n' for s, l, c, o, n in self.entries))
+
+    def lines(self, samples: Iterable[str] = None, loci: Iterable[str] = None) -> list[str]:
+        """
+        Reads the lines of the results matching the sample names and best match loci, in file order. Raises
+        ResultIndexError if a line doesn't look like a result, i.e. the file has changed since it was indexed.
+        """
+        samples, loci, lines = set(samples or ()), set(loci or ()), []
+        with open(self.file, 'rb') as f:
+            for sample, locus, _, offset, length in self.entries:
+                if (samples and sample not in samples) or (loci and locus not in loci):
+                    continue
+                f.seek(offset)
+                if not (line := f.read(length)).startswith(b'{'):
+                    raise ResultIndexError(f'{self.path} does not match {self.file}')
+                lines.append(line.decode())
+        return lines
+
+
+class ResultIndexWriter(TextIOBase):
+    """
+    Wraps the handle of a JSON lines results file, indexing each line written and writing the index when closed.
+    If the file already has results, they are indexed first unless their index is up-to-date.
+    """
+
+    def __init__(self, handle: TextIO, verbose: bool = False):
+        super().__init__()
+        self.handle = handle
+        handle.flush()
+        if fstat(handle.fileno()).st_size:
+            self.index = ResultIndex.load(handle.name, verbose) or ResultIndex.build(handle.name, verbose)
+        else:
+            self.index = ResultIndex(handle.name)
+
+    @property
+    def name(self):
+        return self.handle.name
+
+    def write(self, text: str) -> int:
+        [self.index.add(line) for line in text.encode(self.handle.encoding).splitlines(keepends=True)]
+        return self.handle.write(text)
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.handle.close()
+            self.index.write()
 
 
 # Functions -----------------------------------------------------------------------------------------------------------
+@trace.traced('parse assembly')
 def parse_assembly(file: PathLike | str, verbose: bool = False) -> Assembly | None:
-    """Parse an assembly file and return an Assembly object"""
+    """
+    Parse an assembly file and return an Assembly object. The contigs are indexed so their sequences are only read
+    from the file when needed, unless the file can't be indexed, in which case they are loaded into memory.
+    """
     if file := check_file(file):  # Check the file exists, warn if not (instead of quitting)
-        if match := _ASSEMBLY_FASTA_REGEX.search(basename := path.basename(file)):
+        if name := assembly_name(file):
+            basename = path.basename(file)
             log(f'Assuming {basename} is in fasta format', verbose=verbose)
-            assembly = Assembly(file, basename.rstrip(match.group()))
+            try:
+                fasta = FastaIndex(file, verbose)
+                return Assembly(file, name, {
+                    name: Contig(name, fasta.descriptions[name], length=length, fasta=fasta)
+                    for name, length in fasta.lengths().items()}, fasta)
+            except FastaIndexError as e:
+                log(f'Could not index {basename} ({e}), loading it into memory', verbose=verbose)
+            except Exception as e:
+                return warning(f"Error parsing {basename}\n{e}")
+            from Bio.SeqIO.FastaIO import SimpleFastaParser
+            assembly = Assembly(file, name)
             try:
                 with opener(file, verbose=verbose, mode='rt') as f:
                     for header, seq in SimpleFastaParser(f):
@@ -117,7 +350,43 @@ def parse_assembly(file: PathLike | str, verbose: bool = False) -> Assembly | No
             except Exception as e:
                 return warning(f"Error parsing {basename}\n{e}")
             return assembly
-        return warning(f"File extension must match {_ASSEMBLY_FASTA_REGEX.pattern}: {basename}")
+        return warning(f"File extension must match {_ASSEMBLY_FASTA_REGEX.pattern}: {path.basename(file)}")
+
+
+def assembly_name(file: PathLike | str) -> str | None:
+    """Returns the name parse_assembly gives the assembly in a file, or None if the file isn't a fasta file"""
+    if match := _ASSEMBLY_FASTA_REGEX.search(basename := path.basename(file)):
+        return basename.rstrip(match.group())
+    return None
+
+
+def assembly_from_records(name: str, records: Iterable[tuple[str, str | Seq] | 'SeqRecord']) -> Assembly:
+    """
+    Creates an in-memory Assembly, with no file, from contig records. Records can be (header, sequence) tuples or
+    Bio.SeqRecord.SeqRecord objects. In-memory assemblies are typed by streaming their contigs to minimap2 (see
+    Assembly.map), so they are never written to disk.
+    :param name: Name of the assembly, used as the sample name of the result
+    :param records: Contig records
+    :return: Assembly object
+    """
+    assembly = Assembly(name=name)
+    for record in records:
+        if isinstance(record, tuple):
+            header, seq = record
+            header = header.lstrip('>').split(maxsplit=1)
+            name_, description = header if len(header) == 2 else (header[0], '')
+        else:  # SeqRecord, which has the name (id) and description separately
+            name_, description, seq = record.id, record.description.removeprefix(record.id).strip(), record.seq
+        if name_ in assembly.contigs:
+            raise AssemblyError(f'Duplicate contig name {name_} in {name}')
+        assembly.contigs[name_] = Contig(name_, description, seq if isinstance(seq, Seq) else Seq(str(seq)))
+    return assembly
+
+
+@lru_cache(maxsize=None)
+def minimap2_installed() -> bool:
+    """Returns True if the minimap2 executable is on the PATH, which is only checked once"""
+    return which('minimap2') is not None
 
 
 def parse_result(line: str, db: Database, regex: Pattern = None, samples: set[str] = None,
@@ -140,17 +409,170 @@ def parse_result(line: str, db: Database, regex: Pattern = None, samples: set[st
         return None
 
 
+def truncate_partial_line(file: str | PathLike, verbose: bool = False) -> int:
+    """
+    Removes the last line of a file if it was only partly written (doesn't end in a newline), e.g. by a run that was
+    interrupted, so results appended to the file start on a new line. Returns the number of bytes removed.
+    """
+    with open(file, 'rb+') as f:
+        end = size = f.seek(0, 2)
+        while end:  # Find the last newline, reading back from the end a block at a time
+            f.seek(start := max(0, end - 65536))
+            if (newline := f.read(end - start).rfind(b'\n')) != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            warning(f'Removing {size - end} bytes of a partly written line from the end of {file}')
+            f.truncate(end)
+        return size - end
+
+
+def completed_samples(files: Iterable[str | PathLike], verbose: bool = False) -> set[str]:
+    """
+    Returns the names of the samples with results in every TSV (-o) and JSON lines (-j) results file, removing a
+    partly written last line from each first, so an interrupted run can be resumed without typing these samples
+    again or duplicating their results. If a file has results of samples that aren't in the others (e.g. the run was
+    interrupted between writing them), those results are removed so the samples are typed again and written once
+    to every file. JSON sample names are read from the sidecar index if it is up-to-date.
+    :param files: Paths to the results files, those that don't exist yet have no samples
+    :param verbose: Print progress to stderr
+    :return: Sample names
+    """
+    samples = {}
+    for file in files:
+        samples[file] = set()
+        if path.isfile(file) and path.getsize(file):
+            truncate_partial_line(file, verbose)
+            if index := ResultIndex.load(file, verbose):
+                samples[file] = {i[0] for i in index.entries if i[0]}
+            else:
+                with open(file, 'rb') as f:
+                    for line in f:
+                        try:
+                            if sample := _result_sample(line):
+                                samples[file].add(sample)
+                        except Exception as e:
+                            warning(f'Error parsing JSON line in {file}: {e}')
+        log(f'{len(samples[file])} samples already in {file}', verbose=verbose)
+    completed = set.intersection(*samples.values()) if samples else set()
+    for file, file_samples in samples.items():
+        if extra := file_samples - completed:
+            warning(f'Removing the results of {len(extra)} samples from {file} that are missing from the other '
+                    f'results files, they will be typed again')
+            remove_results(file, extra, verbose)
+    return completed
+
+
+def remove_results(file: str | PathLike, samples: set[str], verbose: bool = False) -> int:
+    """
+    Removes the results of the samples from a TSV or JSON lines results file. Lines are moved back over the removed
+    ones in place, so handles already open to append to the file keep working, and the sidecar index is removed as it
+    no longer matches the file. Lines that aren't results are kept.
+    :param file: Path to the results file
+    :param samples: Names of the samples to remove
+    :param verbose: Print progress to stderr
+    :return: Number of results removed
+    """
+    removed = 0
+    with open(file, 'rb') as reader, open(file, 'rb+') as writer:  # The writer never passes the reader
+        for line in reader:
+            try:
+                if _result_sample(line) in samples:
+                    removed += 1
+                    continue
+            except Exception:  # Kept as it is, see completed_samples
+                pass
+            writer.write(line)
+        writer.truncate()
+    if path.isfile(index := f'{file}{_RESULT_INDEX_SUFFIX}'):
+        remove(index)
+    log(f'Removed {removed} results from {file}', verbose=verbose)
+    return removed
+
+
+def _result_sample(line: bytes) -> str | None:
+    """Returns the sample name of a line of a TSV or JSON lines results file, or None if it isn't a result"""
+    if line.startswith(b'{'):  # Only decode the whole result if the name isn't the first key
+        match = _SAMPLE_NAME_REGEX.match(text := line.decode())
+        return loads(match.group(1)) if match else loads(text)['sample_name']
+    if line.strip() and line.decode() != _ASSEMBLY_HEADER:
+        return line.split(b'\t', 1)[0].decode()
+    return None
+
+
 def write_headers(tsv: TextIO = None, no_header: bool = False, scores: bool = False) -> int:
     """Write appropriate header to a file handle."""
     if tsv and not no_header and (tsv.name == '<stdout>' or fstat(tsv.fileno()).st_size == 0):
         return tsv.write(_SCORES_HEADER if scores else _ASSEMBLY_HEADER)
 
 
+def score_genes(alignments: list[Alignment], db: Database, min_cov: float) -> tuple[list[Alignment], 'np.ndarray']:
+    """
+    Scores the gene alignments of the first round of typing. The best alignment (highest mlen, first if tied) of each
+    gene is added to the score row of the gene's locus if its coverage is at least min_cov.
+    Returns the alignments grouped by gene (keeping only the best alignment of extra genes) and the score matrix, with
+    columns AS, mlen, blen, q_len, genes_found and genes_expected (0, this is added later).
+    """
+    import numpy as np  # Only needed for typing, so not imported by the other subcommands
+    scores = np.zeros((len(db), 6))
+    if not alignments:
+        return alignments, scores
+    # Group by gene, keeping the alignments of each gene in their original order
+    grouped = sorted(alignments, key=attrgetter('q'))
+    names = np.array(list(map(attrgetter('q'), grouped)), dtype=object)
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])  # Index of the first alignment of each gene
+    sizes = np.diff(np.r_[starts, len(grouped)])
+    # The best alignment of each gene is the first with the highest mlen
+    mlen = np.fromiter(map(attrgetter('mlen'), grouped), dtype=int, count=len(grouped))
+    best = np.flatnonzero(mlen == np.repeat(np.maximum.reduceat(mlen, starts), sizes))
+    best = best[np.r_[True, np.diff(np.searchsorted(starts, best, side='right')) > 0]]
+    extra = np.array([i.startswith('Extra') for i in names[starts]])
+    if extra.any():  # Only keep the best alignment of extra genes
+        keep = ~np.repeat(extra, sizes)
+        keep[best[extra]] = True
+        grouped, best = list(compress(grouped, keep.tolist())), best[~extra]
+        best = np.cumsum(keep)[best] - 1  # Index of the best alignments in the kept alignments
+    # Add AS, mlen, blen, q_len, genes_found (1), genes_expected (0 but will update later) of the best alignments
+    if best := [a for a in map(grouped.__getitem__, best.tolist()) if (a.blen / a.q_len) * 100 >= min_cov]:
+        np.add.at(scores, db.gene_loci[[db.gene_index[a.q] for a in best]],
+                  [(a.tag('AS'), a.mlen, a.blen, a.q_len, 1, 0) for a in best])
+    return grouped, scores
+
+
+def rank_loci(scores: 'np.ndarray', db: Database, score_metric: int = 0, weight_metric: int = 3, n_best: int = 2
+              ) -> list[Locus]:
+    """
+    Returns the n_best loci with the highest first round scores, to be fully aligned to the assembly. The score matrix
+    from score_genes (with the expected gene counts added) is collapsed to one score per locus with the score_metric,
+    weighted by the weight_metric (see typing_pipeline).
+    """
+    import numpy as np
+    if weight_metric:  # If we are using a weighted score
+        with np.errstate(divide='ignore', invalid='ignore'):  # Loci without gene alignments are scored nan
+            if weight_metric == 1:
+                scores = scores[:, score_metric] / scores[:, 4]  # Genes found
+            elif weight_metric == 2:
+                scores = scores[:, score_metric] / scores[:, 5]  # Genes expected
+            elif weight_metric == 3:
+                scores = scores[:, score_metric] * (scores[:, 4] / scores[:, 5])  # Prop genes
+            elif weight_metric == 4:
+                scores = scores[:, score_metric] / scores[:, 2]  # blen
+            elif weight_metric == 5:
+                scores = scores[:, score_metric] / scores[:, 3]  # q_len
+    else:
+        scores = scores[:, score_metric]  # Unweighted score
+    return [db[int(i)] for i in np.argsort(scores)[::-1][:min(n_best, len(scores))]]
+
+
+@trace.traced('typing_pipeline')
 def typing_pipeline(
         assembly: str | PathLike | Assembly, db: str | PathLike | Database, threads: int = 0,
         score_metric: int = 0, weight_metric: int = 3, min_cov: float = 50, n_best: int = 2,
         max_other_genes: int = 1, percent_expected_genes: float = 50, allow_below_threshold: bool = False,
-        score_file: TextIO = None, verbose: bool = False) -> TypingResult | None:
+        score_file: TextIO = None, verbose: bool = False,
+        batch_alignments: tuple[list[Alignment], list[Alignment]] = None,
+        cache: ResultCache = None) -> TypingResult | None:
     """
     Performs *in silico* serotyping on a bacterial genome assembly using a database of known loci.
     :param assembly: Path to the assembly file or Assembly object
@@ -165,33 +587,47 @@ def typing_pipeline(
     :param allow_below_threshold: Allow genes below the threshold to be considered Typeable
     :param score_file: File handle to write the scores to, will not type the assembly if provided
     :param verbose: Print progress to stderr
+    :param batch_alignments: Alignments of the database genes and best loci to the assembly from map_batch, used
+                             instead of aligning them to the assembly (see typing_batch)
+    :param cache: ResultCache to return the result from if the assembly has been typed before with the same database
+                  and options, and to add the result to otherwise
     :return: TypingResult object or None
     """
     # CHECK ARGS -------------------------------------------------------------------------------------------------------
+    import numpy as np
     if not isinstance(db, Database) and not (db := load_database(db, verbose=verbose)):
         return None
     if not isinstance(assembly, Assembly) and not (assembly := parse_assembly(assembly, verbose=verbose)):
         return None
     threads = threads if threads else check_cpus(threads, verbose=verbose)
+    if assembly.path is None and not minimap2_installed():  # The contigs are streamed to minimap2, see Assembly.map
+        return warning(f'Could not type {assembly}, in-memory assemblies need the minimap2 executable')
+    trace.annotate(assembly=assembly.name)
+    key = None
+    if cache and not score_file:  # Every option that changes the result is part of the key
+        key = cache.key(assembly, db, score_metric=score_metric, weight_metric=weight_metric, min_cov=min_cov,
+                        n_best=n_best, max_other_genes=max_other_genes, percent_expected_genes=percent_expected_genes,
+                        allow_below_threshold=allow_below_threshold)
+        if key and (result := cache.get(key, assembly.name, db)):
+            trace.annotate(cached=True)
+            log(f"Finished typing {result} (cached)", verbose=verbose)
+            return result
     # ALIGN GENES ------------------------------------------------------------------------------------------------------
-    # Init scores array with 6 columns: AS, mlen, blen, q_len, genes_found, genes_expected
-    scores, alignments = np.zeros((len(db), 6)), []
-    # Group alignments by query gene (Alignment.q)
-    for q, alns in group_alns(assembly.map(db.format('ffn'), threads, verbose=verbose)):
-        if q.startswith("Extra"):
-            alignments.append(max(alns, key=lambda x: x.mlen))  # Add the best alignment for extra genes
-        else:
-            alignments.extend(alns := list(alns))  # Add all alignments to the list, convert generator to list too
-            # Use the best alignment for each gene for scoring, if the coverage is above the minimum
-            if ((best := max(alns, key=lambda x: x.mlen)).blen / best.q_len) * 100 >= min_cov:
-                scores[db.genes[q].locus.index] += [best.tags['AS'], best.mlen, best.blen, best.q_len, 1, 0]
-            # For each gene, add: AS, mlen, blen, q_len, genes_found (1), genes_expected (0 but will update later)
+    trace.stage('align genes')
+    if batch_alignments:  # The contigs were aligned to the database with the rest of the batch
+        alignments = batch_alignments[0]
+    else:  # Align the database genes to the assembly
+        alignments = list(assembly.map(db.format('ffn'), threads, verbose=verbose))
+    trace.stage('score genes')
+    # Scores array has 6 columns: AS, mlen, blen, q_len, genes_found, genes_expected
+    alignments, scores = score_genes(alignments, db, min_cov)
 
     if scores.max() == 0:  # If no gene alignments were found, return None so pipeline can continue
         return warning(f'No gene alignments sufficient for typing {assembly}\n'
                        f'Have you used the appropriate database for your species?')
 
     # SCORE LOCI -------------------------------------------------------------------------------------------------------
+    trace.stage('score loci')
     scores[:, 5] = db.expected_gene_counts  # Add expected genes to the 6th column (0-based) score matrix
 
     if score_file:  # If we are just scoring the assembly
@@ -200,39 +636,33 @@ def typing_pipeline(
         )
         return log(f"Finished scoring {assembly}", verbose=verbose)  # Return without typing the assembly
 
-    # Process the scores to get the best loci to fully align, this collapses the matrix to a 1D array
-    if weight_metric:  # If we are using a weighted score
-        if weight_metric == 1:
-            scores = scores[:, score_metric] / scores[:, 4]  # Genes found
-        elif weight_metric == 2:
-            scores = scores[:, score_metric] / scores[:, 5]  # Genes expected
-        elif weight_metric == 3:
-            scores = scores[:, score_metric] * (scores[:, 4] / scores[:, 5])  # Prop genes
-        elif weight_metric == 4:
-            scores = scores[:, score_metric] / scores[:, 2]  # blen
-        elif weight_metric == 5:
-            scores = scores[:, score_metric] / scores[:, 3]  # q_len
-    else:
-        scores = scores[:, score_metric]  # Unweighted score
-
-    best_loci = [db[int(i)] for i in
-                 np.argsort(scores)[::-1][:min(n_best, len(scores))]]  # Get the best loci to fully align
+    best_loci = rank_loci(scores, db, score_metric, weight_metric, n_best)  # Get the best loci to fully align
     scores, idx = np.zeros((len(best_loci), 4)), {l.name: i for i, l in enumerate(best_loci)}  # Init scores and index
     locus_alignments = {l.name: [] for l in best_loci}  # Init dict to store alignments for each locus
+    trace.stage('align loci')
+    if batch_alignments:
+        locus_alignments_ = (a for a in batch_alignments[1] if a.q in idx)
+    else:  # Align the best loci to the assembly
+        locus_alignments_ = assembly.map(''.join(i.format('fna') for i in best_loci), threads, verbose=verbose)
     # Group alignments by locus
-    for locus, alns in group_alns(assembly.map(''.join(i.format('fna') for i in best_loci), threads, verbose=verbose)):
+    for locus, alns in group_alns(locus_alignments_):
         for a in alns:  # For each alignment of the locus
-            scores[idx[locus]] += [a.tags['AS'], a.mlen, a.blen, a.q_len]  # Add alignment metrics to the scores
+            scores[idx[locus]] += [a.tag('AS'), a.mlen, a.blen, a.q_len]  # Add alignment metrics to the scores
             locus_alignments[locus].append(a)  # Add the alignment to the locus alignments
+    assembly.remove_index()  # No more alignments are needed, remove the index (also removed if the assembly is freed)
     best_match = best_loci[np.argmax(scores[:, score_metric])]  # Get the best match based on the highest score
 
     # RECONSTRUCT LOCUS ------------------------------------------------------------------------------------------------
+    trace.stage('reconstruct locus')
     result = TypingResult(assembly.name, db, best_match)  # Create the result object
     pieces = {  # Init dict to store pieces for each contig
         ctg: [LocusPiece(ctg, result, s, e) for s, e in  # Create pieces for each merged contig range
               merge_ranges([(a.r_st, a.r_en) for a in alns], len(db.largest_locus))]  # Merge ranges by largest locus
         for ctg, alns in group_alns(locus_alignments[best_match.name], key='ctg')  # Group by contig
     }  # We can't add strand as the pieces may be merged from multiple alignments, we will determine from the genes
+    piece_index = defaultdict(IntervalIndex)  # Index of each piece in pieces[ctg] by its range, kept up to date
+    for ctg, ctg_pieces in pieces.items():
+        [piece_index[ctg].add(piece.start, piece.end, n) for n, piece in enumerate(ctg_pieces)]
 
     # GET GENE RESULTS -------------------------------------------------------------------------------------------------
     for a in cull_filtered(lambda i: i.q in best_match.genes, alignments):  # For each non-overlapping gene alignment
@@ -244,9 +674,11 @@ def typing_pipeline(
             gene = db.genes.get(a.q)
             gene_type = "unexpected_genes"
 
-        # Get Piece if gene range overlaps with a piece
-        piece = next(filter(lambda p: range_overlap((p.start, p.end), (a.r_st, a.r_en)) > 0,
-                            pieces.get(a.ctg, [])), None)
+        # Get the first Piece the gene range overlaps with
+        if (n := min((i[2] for i in piece_index[a.ctg].overlapping(a.r_st, a.r_en)), default=None)) is not None:
+            piece, piece_range = pieces[a.ctg][n], (pieces[a.ctg][n].start, pieces[a.ctg][n].end)
+        else:
+            piece = None
         # Create gene result and extract sequence from assembly
         gene_result = GeneResult(a.ctg, gene, result, piece, a.r_st, a.r_en, a.strand, gene_type=gene_type,
                                  partial=a.partial, dna_seq=assembly.seq(a.ctg, a.r_st, a.r_en, a.strand))
@@ -256,6 +688,9 @@ def typing_pipeline(
         if not piece and gene_result.below_threshold:  # If below protein identity threshold
             continue  # Skip this gene, probably a homologue in another part of the genome
         result.add_gene_result(gene_result)  # Add the gene result to the result to get neighbouring genes
+        if piece and (piece.start, piece.end) != piece_range:  # The gene extended the piece, update the index
+            piece_index[a.ctg].remove(*piece_range, n)
+            piece_index[a.ctg].add(piece.start, piece.end, n)
         # previous_result = gene_result  # Set the previous gene result to the current result
 
     # FINALISE PIECES --------------------------------------------------------------------------------------------------
@@ -276,6 +711,370 @@ def typing_pipeline(
     result.missing_genes = list(set(best_match.genes) - {
         i.gene.name for i in chain(result.expected_genes_inside_locus, result.expected_genes_outside_locus)
     })
+    trace.stage('confidence')
     result.get_confidence(allow_below_threshold, max_other_genes, percent_expected_genes)
+    if key:
+        cache.put(key, result)
     log(f"Finished typing {result}", verbose=verbose)
     return result
+
+
+def map_batch(assemblies: list[Assembly], query: str, threads: int, verbose: bool = False
+              ) -> list[list[Alignment] | None]:
+    """
+    Aligns the query fasta string to every assembly in the batch with one minimap2 run, returning the alignments of
+    each assembly, or None for those that must be aligned on their own.
+    The contigs are streamed to minimap2 as the target, prefixed with the position of their assembly, and each
+    assembly is padded with Ns (which have no minimizers) to the same length so that minimap2 indexes it as a separate
+    part (-I). minimap2 aligns the query to each part independently, so the alignments are the same as Assembly.map,
+    except that the repetitive minimizer threshold of the first part is used for all parts. It is set to the lowest
+    threshold minimap2 uses (-f, without rescuing repetitive seeds, -e 0), and assemblies where any query had seeds
+    above it (a non-zero rl:i tag) are returned as None; for the others, no seeds were filtered, as with Assembly.map.
+    """
+    size = max(map(len, assemblies)) + 2  # Each part is size long, see below
+    if size > _MAX_PART_SIZE:
+        return [None] * len(assemblies)
+    n_queries, batch = sum(1 for _ in parse_fasta(query)), [[] for _ in assemblies]
+
+    def target():
+        for n, assembly in enumerate(assemblies):
+            yield from (f'>{n}:{contig.name}\n{contig.seq}\n' for contig in assembly.contigs.values())
+            yield f'>{n}:\n{"N" * (size - len(assembly))}\n'
+
+    # minimap2 ends a part once it is larger than -I, after the sequence that takes it to at least -I, which is the
+    # padding, as each assembly is at least 2bp shorter than size. Every query has at least one line for each part
+    # (--paf-no-hit), and the parts are written one after the other, so no-hit lines are assigned to their part by
+    # counting the queries.
+    part, n_query, previous = 0, -1, None
+    with NamedTemporaryFile('wt', prefix='kaptive_', suffix='.fasta') as f:  # stdin is taken by the target
+        f.write(query)
+        f.flush()
+        for line in stream_command(f'minimap2 -c -f {_MIN_MID_OCC} -e 0 --paf-no-hit -I {size - 1} -t {threads} - '
+                                   f'"{f.name}"', target(), verbose):
+            q, _, rest = line.partition('\t')
+            ctg = rest.split('\t', 5)[4]
+            if ctg == '*' or (q, ctg.partition(':')[0]) != previous:  # The next query or part
+                if (n_query := n_query + 1) == n_queries:
+                    part, n_query = part + 1, 0
+            previous = None if ctg == '*' else (q, ctg.partition(':')[0])
+            if part >= len(assemblies) or (previous and previous[1] != str(part)):
+                warning(f'Could not split the alignments of a batch of {len(assemblies)} assemblies')
+                return [None] * len(assemblies)
+            if batch[part] is None:
+                continue
+            if (match := _REP_LEN_REGEX.search(line)) and match.group(1) != '0':  # Seeds were filtered
+                batch[part] = None
+            elif ctg != '*':
+                batch[part].append(Alignment.from_paf_line(line.replace(f'\t{part}:', '\t', 1)))
+    if (part, n_query) != (len(assemblies) - 1, n_queries - 1):  # minimap2 didn't align to every part
+        return [None] * len(assemblies)
+    return batch
+
+
+def _type_batch(batch: list[Assembly | None], db: Database, threads: int, verbose: bool, kwargs: dict
+                ) -> Generator[TypingResult | None, None, None]:
+    """
+    Aligns the database genes to every assembly in the batch with one minimap2 run, then the union of the best loci
+    of each assembly with another, and types each assembly from its alignments (see map_batch). Assemblies that
+    can't be aligned in the batch are typed on their own.
+    """
+    assemblies, alignments = [i for i in batch if i], {}
+    if len(assemblies) > 1:
+        log(f'Aligning a batch of {len(assemblies)} assemblies', verbose=verbose)
+        with trace.span('align batch', assemblies=len(assemblies)):
+            genes = dict(zip(map(id, assemblies), map_batch(assemblies, db.format('ffn'), threads, verbose)))
+            alignments = {i: (alns, []) for i, alns in genes.items() if alns is not None}
+            best_loci = {}  # Loci to align to each assembly, none if only writing the scores
+            for assembly in ([] if kwargs.get('score_file') else assemblies):
+                if id(assembly) in alignments and (scores := score_genes(
+                        genes[id(assembly)], db, kwargs.get('min_cov', 50))[1]).max() > 0:
+                    scores[:, 5] = db.expected_gene_counts
+                    best_loci[id(assembly)] = rank_loci(scores, db, kwargs.get('score_metric', 0),
+                                                        kwargs.get('weight_metric', 3), kwargs.get('n_best', 2))
+            if loci := [i for i in assemblies if id(i) in best_loci]:
+                union = {i.name for i in chain.from_iterable(best_loci.values())}
+                for assembly, locus_alignments in zip(loci, map_batch(loci, ''.join(
+                        i.format('fna') for i in db.loci.values() if i.name in union), threads, verbose)):
+                    if locus_alignments is None:  # Typed on its own
+                        del alignments[id(assembly)]
+                    else:
+                        alignments[id(assembly)] = (genes[id(assembly)], locus_alignments)
+    for assembly in batch:
+        yield typing_pipeline(assembly, db, threads, verbose=verbose, **kwargs | {
+            'batch_alignments': alignments.get(id(assembly))}) if assembly else None
+
+
+def typing_batch(assemblies: Iterable[str | PathLike | Assembly], db: Database, batch_size: int, max_bases: int = 0,
+                 threads: int = 0, verbose: bool = False, **kwargs) -> Generator[TypingResult | None, None, None]:
+    """
+    Types assemblies in batches, aligning the database genes and loci to every assembly in a batch with one minimap2
+    run each instead of one run per assembly, so minimap2 is only started and the queries only read once per batch
+    (see map_batch). Results are identical to typing each assembly with the typing_pipeline.
+    :param assemblies: Paths to the assembly files or Assembly objects
+    :param db: Database object
+    :param batch_size: Maximum number of assemblies in a batch
+    :param max_bases: Maximum total length of a batch (0 for no maximum), which bounds the memory used to align it.
+                      map_batch pads every assembly to the length of the largest, so that is the length counted.
+    :param threads: Number of threads to use for alignment
+    :param verbose: Print progress to stderr
+    :param kwargs: Other keyword arguments to pass to the typing_pipeline
+    :return: Generator of the TypingResult (or None if the assembly couldn't be typed) of each assembly, in order
+    """
+    threads = threads if threads else check_cpus(threads, verbose=verbose)
+    batch, max_size = [], 0  # Size of the largest assembly in the batch
+    for assembly in assemblies:
+        if not isinstance(assembly, Assembly):
+            assembly = parse_assembly(assembly, verbose=verbose)
+        size = len(assembly) if assembly else 0
+        if batch and (len(batch) >= batch_size or (  # Each assembly is padded to the largest size (+2), see map_batch
+                max_bases and (len(batch) + 1) * (max(max_size, size) + 2) > max_bases)):
+            yield from _type_batch(batch, db, threads, verbose, kwargs)
+            batch, max_size = [], 0
+        batch.append(assembly)
+        max_size = max(max_size, size)
+    yield from _type_batch(batch, db, threads, verbose, kwargs)
+
+
+def typing_overlapped(assemblies: Iterable[str | PathLike], db: Database, overlap: int = 2, prefetch: int = 2,
+                      outputs: tuple[TextIO | str | PathLike | None, ...] = (), plot: str | PathLike = None,
+                      plot_fmt: str = 'png', score_file: TextIO = None, threads: int = 0, verbose: bool = False,
+                      **kwargs):
+    """
+    Types assemblies in this process with the stages of successive assemblies overlapped, and writes the results in
+    input order. An asyncio event loop passes each assembly through three stages, connected by bounded queues so no
+    stage gets more than a few assemblies ahead of the next:
+        1. Parsing (and decompressing) the next assemblies, in prefetch threads
+        2. Typing, in overlap threads, so one assembly can be aligned by minimap2 (which releases the GIL) while the
+           genes of another are being evaluated in Python
+        3. Writing the results, in one thread, in input order
+    Results are the same as typing the assemblies one at a time with the typing_pipeline.
+    :param assemblies: Paths to the assembly files
+    :param db: Database object
+    :param overlap: Number of assemblies typed at a time
+    :param prefetch: Number of assemblies parsed ahead of typing
+    :param outputs: tsv, json and fna outputs to pass to TypingResult.write
+    :param plot: Directory to write plots to
+    :param plot_fmt: Plot format
+    :param score_file: File handle to write the scores to, will not type the assemblies if provided
+    :param threads: Number of alignment threads for each assembly
+    :param verbose: Print progress to stderr
+    :param kwargs: Other keyword arguments to pass to the typing_pipeline
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    threads = threads if threads else check_cpus(threads, verbose=verbose)
+
+    def type_assembly(assembly: Assembly | None) -> tuple[TypingResult | None, str]:
+        """Types an assembly, returning the result and its scores, as score_file can't be shared between threads"""
+        if not assembly:
+            return None, ''
+        scores = StringIO() if score_file else None
+        with assembly:
+            result = typing_pipeline(assembly, db, threads, score_file=scores, verbose=verbose, **kwargs)
+        return result, scores.getvalue() if scores else ''
+
+    def write(result: TypingResult | None, scores: str):
+        if scores:
+            score_file.write(scores)
+        if result:
+            result.write(*outputs, plot=plot, plot_fmt=plot_fmt)
+
+    async def stages():
+        loop = asyncio.get_running_loop()
+        parsed, typed = asyncio.Queue(prefetch), asyncio.Queue(overlap)  # Futures, in input order
+        slots = asyncio.Semaphore(overlap)  # Assemblies being typed
+
+        async def parse_all():
+            for assembly in assemblies:
+                await parsed.put(loop.run_in_executor(readers, parse_assembly, assembly, verbose))
+            await parsed.put(None)
+
+        async def type_all():
+            while (future := await parsed.get()) is not None:
+                assembly = await future
+                await slots.acquire()
+                (future := loop.run_in_executor(typers, type_assembly, assembly)).add_done_callback(
+                    lambda _: slots.release())
+                await typed.put(future)
+            await typed.put(None)
+
+        async def write_all():
+            while (future := await typed.get()) is not None:
+                await loop.run_in_executor(writer, write, *await future)
+
+        await asyncio.gather(parse_all(), type_all(), write_all())
+
+    log(f'Typing with {overlap} assemblies overlapped and {prefetch} parsed ahead', verbose=verbose)
+    with ThreadPoolExecutor(prefetch, 'kaptive-parse') as readers, \
+            ThreadPoolExecutor(overlap, 'kaptive-type') as typers, ThreadPoolExecutor(1, 'kaptive-write') as writer:
+        asyncio.run(stages())
+
+
+def _init_typing_worker(db: Database, persist_translations: bool, trace_settings: dict | None):
+    """
+    Stores the database in the worker process so it is only sent/copied once per worker, loads the saved
+    translations so the worker starts with them and turns on tracing if it is on in the main process
+    """
+    global _WORKER_DB
+    _WORKER_DB = db
+    if persist_translations:
+        load_translations(db, record_new=True)
+    if trace_settings:
+        trace.enable(process_name='kaptive worker', **trace_settings)
+
+
+def _write_result(result: TypingResult, buffers: list[StringIO | str | PathLike | None], plot: str | PathLike | None,
+                  plot_fmt: str, plot_specs: list[dict] | None):
+    """
+    Writes a result in a pool worker process, adding the plot spec to plot_specs instead of rendering the plot if
+    plot_specs is a list, so the plot can be rendered by the PlotPool of the main process
+    """
+    result.write(*buffers, plot=None if plot_specs is not None else plot, plot_fmt=plot_fmt)
+    if plot and plot_specs is not None:
+        plot_specs.append(result.plot_spec(plot, plot_fmt))
+
+
+def _typing_worker(assemblies: list[str | PathLike], outputs: list[bool | str | PathLike | None],
+                   plot: str | PathLike | None, plot_fmt: str, plot_specs: bool, score_file: bool,
+                   batch: dict | None, kwargs: dict
+                   ) -> tuple[list[list[str]], list[dict], dict, list[tuple[int, int]], list[dict]]:
+    """
+    Types assemblies in a typing pool worker process, as a batch if batch holds the typing_batch arguments. Outputs
+    that are file handles in the main process (True) are written to buffers and returned for each assembly so the
+    main process can write them in order, directories are written to directly. If plot_specs is True, plot specs are
+    returned for the main process to render instead of the plots being rendered here.
+    New translations, the hits and misses of the translation and result caches, and trace events are also returned so
+    the main process can save and report them.
+    """
+    scores = StringIO() if score_file else None
+    results = typing_batch(assemblies, _WORKER_DB, **batch, score_file=scores, **kwargs) if batch else (
+        typing_pipeline(assembly, _WORKER_DB, score_file=scores, **kwargs) for assembly in assemblies)
+    texts, specs = [], [] if plot_specs else None
+    for result in results:
+        buffers = [StringIO() if i is True else i for i in outputs]
+        if result:
+            _write_result(result, buffers, plot, plot_fmt, specs)
+        texts.append([i.getvalue() if isinstance(i, StringIO) else '' for i in buffers + [scores]])
+        if scores:  # Scores are written by the typing_pipeline, so start a new buffer for the next assembly
+            scores.seek(0)
+            scores.truncate()
+    counts = [_TRANSLATIONS.pop_counts()] + ([cache.pop_counts()] if (cache := kwargs.get('cache')) else [])
+    return texts, specs or [], _TRANSLATIONS.pop_new(), counts, trace.pop_events()
+
+
+def typing_pool(assemblies: list[str | PathLike], db: Database, jobs: int, ordered: bool = True,
+                outputs: tuple[TextIO | str | PathLike | None, ...] = (), plot: str | PathLike = None,
+                plot_fmt: str = 'png', score_file: TextIO = None, persist_translations: bool = False,
+                verbose: bool = False, batch_size: int = 1, max_bases: int = 0, **kwargs
+                ) -> Generator[list[str], None, None]:
+    """
+    Types assemblies in parallel with the typing_pipeline in a pool of worker processes.
+    Assemblies are submitted largest first to keep the pool balanced, and the results are yielded in input order
+    unless ordered is False, in which case they are yielded as soon as each assembly is finished.
+    If batch_size is greater than 1, each worker types batches of assemblies with typing_batch.
+    If a PlotPool has been started with start_plots(), plots are rendered by it rather than by the typing workers.
+    :param assemblies: Paths to the assembly files
+    :param db: Database object, copied once to each worker
+    :param jobs: Number of worker processes
+    :param ordered: Yield results in the same order as the assemblies
+    :param outputs: tsv, json, fna, ffn and faa outputs to pass to TypingResult.write
+    :param plot: Directory to write plots to
+    :param plot_fmt: Plot format
+    :param score_file: File handle to write the scores to, will not type the assemblies if provided
+    :param persist_translations: Load saved translations in each worker and merge the new translations from each
+                                 worker into this process so they can be saved with save_translations
+    :param verbose: Print progress to stderr
+    :param batch_size: Number of assemblies submitted to a worker at a time and typed as a batch
+    :param max_bases: Maximum total length of a batch, with each assembly padded to the largest (0 for no maximum)
+    :param kwargs: Other keyword arguments to pass to the typing_pipeline
+    :return: Generator of the text to write to each output file handle, followed by the score file, for each assembly
+    """
+    outputs = [True if isinstance(i, TextIOBase) else i for i in outputs]  # Handles can't be shared with workers
+    order = sorted(range(len(assemblies)), reverse=True,  # Submit the largest assemblies first
+                   key=lambda i: path.getsize(assemblies[i]) if path.isfile(assemblies[i]) else 0)
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    log(f'Typing {len(assemblies)} assemblies with {jobs} jobs', verbose=verbose)
+    with ProcessPoolExecutor(jobs, initializer=_init_typing_worker,
+                             initargs=(db, persist_translations, trace.settings())) as pool:
+        batch, batch_size = ({'batch_size': batch_size, 'max_bases': max_bases} if batch_size > 1 else None,
+                             max(batch_size, 1))
+        plots = plot_pool()
+        futures = {pool.submit(_typing_worker, [assemblies[i] for i in chunk], outputs, plot, plot_fmt,
+                               bool(plots), bool(score_file), batch, kwargs | {'verbose': verbose}): chunk
+                   for chunk in (order[i:i + batch_size] for i in range(0, len(order), batch_size))}
+        finished, n = {}, 0  # Buffer finished results until all previous assemblies are finished
+        for future in as_completed(futures):
+            texts, specs, translations, counts, events = future.result()
+            if persist_translations:
+                _TRANSLATIONS.update(translations.items())
+            for counter, (hits, misses) in zip((_TRANSLATIONS, kwargs.get('cache')), counts):  # Hits in the workers
+                counter.hits, counter.misses = counter.hits + hits, counter.misses + misses
+            trace.add_events(events)
+            [plots.submit(spec) for spec in specs]
+            if not ordered:
+                yield from texts
+                continue
+            finished |= dict(zip(futures[future], texts))
+            while n in finished:
+                yield finished.pop(n)
+                n += 1
+
+
+def _convert_worker(file: str | PathLike, start: int, end: int, outputs: list[bool | str | PathLike | None],
+                    plot: str | PathLike | None, plot_fmt: str, plot_specs: bool, filters: tuple
+                    ) -> tuple[list[str], list[dict], list[dict]]:
+    """
+    Converts the results in the start-end byte range of a JSON lines file in a convert pool worker process. Outputs
+    that are file handles in the main process (True) are written to buffers and returned so the main process can
+    write them in order, directories are written to directly. If plot_specs is True, plot specs are returned for the
+    main process to render instead of the plots being rendered here. Trace events are also returned.
+    """
+    buffers, specs = [StringIO() if i is True else i for i in outputs], [] if plot_specs else None
+    for line in read_lines(file, start, end):
+        if result := parse_result(line, _WORKER_DB, *filters):
+            _write_result(result, buffers, plot, plot_fmt, specs)
+    return [i.getvalue() if isinstance(i, StringIO) else '' for i in buffers], specs or [], trace.pop_events()
+
+
+def convert_pool(file: str | PathLike, db: Database, jobs: int, regex: Pattern = None, samples: set[str] = None,
+                 loci: set[str] = None, outputs: tuple[TextIO | str | PathLike | None, ...] = (),
+                 plot: str | PathLike = None, plot_fmt: str = 'png', verbose: bool = False
+                 ) -> Generator[list[str], None, None]:
+    """
+    Converts a JSON lines file of results in parallel in a pool of worker processes. The file is split into byte
+    ranges on line boundaries, each of which is parsed (with parse_result) and written by a worker, and the text for
+    each range is yielded in the same order as the file. Only a few ranges per worker are in flight at a time, so
+    memory is bounded no matter the size of the file. If a PlotPool has been started with start_plots(), plots are
+    rendered by it rather than by the convert workers.
+    :param file: Path to the JSON lines file
+    :param db: Database object, copied once to each worker
+    :param jobs: Number of worker processes
+    :param regex: Regular expression the JSON lines must match
+    :param samples: Sample names to convert
+    :param loci: Best match locus names to convert
+    :param outputs: tsv, json, fna, ffn and faa outputs to pass to TypingResult.write
+    :param plot: Directory to write plots to
+    :param plot_fmt: Plot format
+    :param verbose: Print progress to stderr
+    :return: Generator of the text to write to each output file handle, for each range of the file
+    """
+    outputs = [True if isinstance(i, TextIOBase) else i for i in outputs]  # Handles can't be shared with workers
+    chunk_size = min(_MAX_CHUNK_SIZE, max(1, path.getsize(file) // (jobs * 4)))  # At least 4 ranges per worker
+    from concurrent.futures import ProcessPoolExecutor
+    log(f'Converting {file} with {jobs} jobs in chunks of {chunk_size} bytes', verbose=verbose)
+    plots = plot_pool()
+    with ProcessPoolExecutor(jobs, initializer=_init_typing_worker, initargs=(db, False, trace.settings())) as pool:
+        pending = deque()
+        for start, end in line_ranges(file, chunk_size):
+            pending.append(pool.submit(_convert_worker, file, start, end, outputs, plot, plot_fmt, bool(plots),
+                                       (regex, samples, loci)))
+            if len(pending) >= jobs * 2:
+                texts, specs, events = pending.popleft().result()
+                trace.add_events(events)
+                [plots.submit(spec) for spec in specs]
+                yield texts
+        while pending:
+            texts, specs, events = pending.popleft().result()
+            trace.add_events(events)
+            [plots.submit(spec) for spec in specs]
+            yield texts
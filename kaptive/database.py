@@ -13,6 +13,8 @@ If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 import os
+import pickle
+from hashlib import sha256
 from os import PathLike, path, listdir
 from functools import cached_property
 from typing import Generator, TextIO
@@ -21,15 +23,14 @@ import re
 from warnings import catch_warnings
 from io import TextIOBase
 
-import numpy as np
-
-from Bio import SeqIO
 from Bio.SeqFeature import SeqFeature
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
+from kaptive.version import __version__
 from kaptive.log import log, quit_with_error, warning
-from kaptive.utils import check_file
+from kaptive.utils import check_file, cache_dir, atomic_write
+from kaptive import trace
 
 # Constants -----------------------------------------------------------------------------------------------------------
 _LOCUS_REGEX = re.compile(r'(?<=locus:)\w+|(?<=locus: ).*')
@@ -64,6 +65,7 @@ class Database:
         self.genes = genes or {}
         self.extra_genes = extra_genes or {}
         self.gene_threshold = gene_threshold or _GENE_THRESHOLDS.get(self.name, 0)
+        self.fingerprint = ''  # Hash of the database files and parsing options, set by load_database
         self._expected_gene_counts = None
 
     def __repr__(self):
@@ -93,9 +95,21 @@ class Database:
     def largest_locus(self) -> Locus:
         return max(self.loci.values(), key=len)
 
+    @cached_property
+    def gene_index(self) -> dict[str, int]:
+        """Position of each gene in self.genes, used to index gene_loci"""
+        return {name: n for n, name in enumerate(self.genes)}
+
+    @cached_property
+    def gene_loci(self) -> 'np.ndarray':
+        """Index of the locus of each gene in self.genes, for adding gene scores to the locus score matrix"""
+        import numpy as np  # Only needed for typing, so not imported by the other subcommands
+        return np.array([gene.locus.index for gene in self.genes.values()], dtype=int)
+
     @property
-    def expected_gene_counts(self) -> np.ndarray:
+    def expected_gene_counts(self) -> 'np.ndarray':
         if self._expected_gene_counts is None:
+            import numpy as np
             self._expected_gene_counts = np.array([len(l.genes) for l in self.loci.values()])
         return self._expected_gene_counts
 
@@ -458,28 +472,69 @@ def get_database(argument: str | PathLike) -> tuple[str, PathLike]:
 def parse_database(db: str | PathLike, locus_filter: re.Pattern = None, load_locus_seqs: bool = True,
                    extract_translations: bool = False, verbose: bool = False, **kwargs) -> Generator[Locus, None, None]:
     """
-    Wrapper around SeqIO.parse to parse a Kaptive database genbank file and return a generator of Locus objects
+    Parses a Kaptive database genbank file and returns a generator of Locus objects. The records are parsed with the
+    GenBank scanner behind SeqIO.parse, as importing SeqIO imports every format it supports.
     """
+    from Bio.GenBank.Scanner import GenBankScanner
     db_name, db_path = get_database(db)
     log(f'Parsing {db_name}', verbose=verbose)
     try:
-        for record in SeqIO.parse(db_path, 'genbank'):
-            locus_name, type_name = name_from_record(record, **kwargs)
-            if not locus_name:
-                quit_with_error(f'Could not parse locus name from {record.id}')
-            if type_name == "unknown" or (not type_name and not locus_name.startswith('Extra')):
-                type_name = f'unknown ({locus_name})'  # Add the locus name to the type name if it is unknown
-            if locus_filter and not locus_filter.search(locus_name):
-                continue
-            yield Locus.from_seqrecord(record, locus_name, type_name, load_locus_seqs, extract_translations)
+        with open(db_path) as handle:
+            for record in GenBankScanner(debug=0).parse_records(handle):
+                locus_name, type_name = name_from_record(record, **kwargs)
+                if not locus_name:
+                    quit_with_error(f'Could not parse locus name from {record.id}')
+                if type_name == "unknown" or (not type_name and not locus_name.startswith('Extra')):
+                    type_name = f'unknown ({locus_name})'  # Add the locus name to the type name if it is unknown
+                if locus_filter and not locus_filter.search(locus_name):
+                    continue
+                yield Locus.from_seqrecord(record, locus_name, type_name, load_locus_seqs, extract_translations)
     except Exception as e:
         quit_with_error(f'Could not parse database {db_name}: {e}')
 
 
-def load_database(argument: str | PathLike, gene_threshold: float = None, **kwargs) -> Database:
+def database_fingerprint(db_path: str | PathLike, **options) -> tuple[str, str]:
+    """
+    Returns a hash of the database genbank and logic files and a hash of the options used to parse them, so a compiled
+    database can be reused as long as neither the files nor the options change.
+    """
+    files, opts = sha256(), sha256()
+    for file in (db_path, f'{path.splitext(db_path)[0]}.logic'):
+        if path.isfile(file):
+            with open(file, 'rb') as f:
+                files.update(f.read())
+    for key, value in sorted(options.items()):  # Regex patterns are hashed by their pattern and flags
+        opts.update(f"{key}={(value.pattern, value.flags) if isinstance(value, re.Pattern) else value};".encode())
+    return files.hexdigest(), opts.hexdigest()
+
+
+@trace.traced('load database')
+def load_database(argument: str | PathLike, gene_threshold: float = None, cache: bool = False,
+                  verbose: bool = False, **kwargs) -> Database:
+    """
+    Loads a Kaptive database into memory. If cache is True, the loaded database (with all genes translated) is
+    stored in the Kaptive cache directory so later runs with the same files and options can skip parsing the genbank
+    file. The cache is rebuilt automatically when the files or options change.
+    The cache is a pickle, which can run code when it is loaded, so it is off by default and must only be used with a
+    cache directory that no one else can write to.
+    """
     db_name, db_path = get_database(argument)
+    files_hash, options_hash = database_fingerprint(db_path, gene_threshold=gene_threshold, version=__version__,
+                                                    **kwargs)
+    cache_prefix, cache_file = f'{db_name}_{options_hash[:8]}_', None  # One cache per database and set of options
+    if cache:
+        try:
+            cache_file = path.join(cache_dir('databases'), f'{cache_prefix}{files_hash[:16]}.pkl')
+            if path.isfile(cache_file):
+                with open(cache_file, 'rb') as f:
+                    db = pickle.load(f)
+                log(f'Loaded {db_name} from cache {cache_file}', verbose=verbose)
+                return db
+        except Exception as e:  # A corrupt or incompatible cache is rebuilt, an unwritable cache is ignored
+            log(f'Could not load {db_name} from cache: {e}', verbose=verbose)
+
     db = Database(db_name, gene_threshold=gene_threshold)
-    for locus in parse_database(db_path, **kwargs):
+    for locus in parse_database(db_path, verbose=verbose, **kwargs):
         db.add_locus(locus)
     if not db.loci:  # Check that loci were properly loaded
         quit_with_error(f'No loci found in database {db.name}')
@@ -487,4 +542,18 @@ def load_database(argument: str | PathLike, gene_threshold: float = None, **kwar
         [db.add_phenotype(*i) for i in parse_logic(logic_file)]
     for n, locus in enumerate(db.loci.values()):
         locus.index = n
+    db.fingerprint = sha256(f'{files_hash}{options_hash}'.encode()).hexdigest()
+
+    if cache_file:
+        try:
+            [gene.extract_translation(table=11, to_stop=True) for gene in chain(db.genes.values(),
+                                                                                 db.extra_genes.values())]
+            with atomic_write(cache_file) as tmp_file, open(tmp_file, 'wb') as f:
+                pickle.dump(db, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for file in listdir(directory := path.dirname(cache_file)):  # Remove caches of outdated database files
+                if file.startswith(cache_prefix) and file.endswith('.pkl') and file != path.basename(cache_file):
+                    os.remove(path.join(directory, file))
+            log(f'Cached {db_name} to {cache_file}', verbose=verbose)
+        except Exception as e:
+            log(f'Could not cache {db_name}: {e}', verbose=verbose)
     return db
@@ -14,7 +14,6 @@ If not, see <https://www.gnu.org/licenses/>.
 """
 from datetime import datetime
 import sys
-from inspect import stack
 
 
 def bold(text: str):
@@ -36,10 +35,12 @@ def bold_cyan(text: str):
 def log(message: str = '', verbose: bool = True, rjust: int = 20, stack_depth: int = 1):
     """
     Simple function for logging messages to stderr. Only runs if verbose == True.
-    Stack depth can be increased if the parent function name needs to be exposed.
+    Stack depth can be increased if the parent function name needs to be exposed. The caller is found with
+    sys._getframe rather than inspect.stack, which is slow to import and reads the source of every frame.
     """
     if verbose:  # Only build log if verbosity is requested; simple way of controlling log
-        sys.stderr.write(f"{datetime.now():%Y-%m-%d %H:%M:%S} {stack()[stack_depth].function:>{rjust}}] {message}\n")
+        caller = sys._getframe(stack_depth).f_code.co_name
+        sys.stderr.write(f"{datetime.now():%Y-%m-%d %H:%M:%S} {caller:>{rjust}}] {message}\n")
 
 
 def warning(message: str):
@@ -0,0 +1,268 @@
+"""
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+
+A long-running typing service: databases are loaded once and assemblies are typed by a pool of worker processes in
+response to requests over a localhost HTTP port or a Unix socket, so each assembly only pays for the typing itself.
+
+Endpoints:
+    POST /type   JSON body with either "assembly" (path to an assembly file) or "fasta" (the assembly as fasta text,
+                 named by "name"), and "db" if more than one database is served. Returns the result as JSON, the same
+                 as TypingResult.format('json').
+    GET  /stats  Queue depth, request counts and latency statistics.
+"""
+from __future__ import annotations
+
+import os
+import json
+import signal
+from time import time
+from threading import Lock, BoundedSemaphore
+from collections import deque
+from statistics import mean, median
+from tempfile import TemporaryDirectory
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from kaptive.assembly import typing_pipeline, parse_assembly
+from kaptive.database import Database
+from kaptive.log import log
+
+# Constants -----------------------------------------------------------------------------------------------------------
+_LATENCY_WINDOW = 1000  # Number of recent requests the latency statistics are calculated from
+_WORKER_DBS = {}  # Databases served, set in each worker process by _init_serve_worker
+
+
+# Classes -------------------------------------------------------------------------------------------------------------
+class ServeError(Exception):
+    """Raised for requests that can't be typed, with the HTTP status to respond with"""
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class TypingService:
+    """
+    Types assemblies with warm databases in a pool of worker processes. At most max_queue requests are accepted at
+    a time (running or waiting for a worker), further requests are rejected until one finishes so the queue can't
+    grow without bound.
+    """
+    def __init__(self, dbs: dict[str, Database], jobs: int = 1, max_queue: int = 0, threads: int = 1,
+                 verbose: bool = False, **kwargs):
+        """
+        :param dbs: Databases to serve, by the name requests can use for them
+        :param jobs: Number of worker processes
+        :param max_queue: Maximum number of requests accepted at a time (default: 4 per job)
+        :param threads: Number of alignment threads per job
+        :param verbose: Print progress to stderr
+        :param kwargs: Other keyword arguments to pass to the typing_pipeline
+        """
+        self.dbs = dbs | {db.name: db for db in dbs.values()}  # Also accept the full database names
+        self.jobs = jobs
+        self.max_queue = max_queue or jobs * 4
+        self.kwargs = kwargs | {'threads': threads, 'verbose': verbose}
+        self.started = time()
+        self.counts = {'requests': 0, 'typed': 0, 'untypeable': 0, 'failed': 0, 'rejected': 0}
+        self.latencies = {i: deque(maxlen=_LATENCY_WINDOW) for i in ('total', 'wait', 'typing')}
+        self._pending = 0  # Requests accepted and not yet finished
+        self._slots = BoundedSemaphore(self.max_queue)
+        self._lock = Lock()
+        self._pool = ProcessPoolExecutor(jobs, initializer=_init_serve_worker, initargs=(dbs,))
+        self._pool.submit(os.getpid).result()  # Start the workers before any server threads so they are forked cleanly
+        log(f'Typing with {jobs} jobs, accepting up to {self.max_queue} requests at a time', verbose=verbose)
+
+    def type(self, request: dict) -> str:
+        """
+        Types the assembly in the request and returns the result as JSON
+        :param request: Request with "assembly" or "fasta" (and "name"), and optionally "db"
+        :raises ServeError: If the request is invalid, the queue is full or the assembly can't be typed
+        """
+        received = time()
+        self._count('requests')
+        db = self._database(request.get('db'))
+        if request.get('assembly'):
+            if not os.path.isfile(assembly := str(request['assembly'])):
+                raise ServeError(f'Assembly not found: {assembly}', 404)
+            fasta, name = None, None
+        elif request.get('fasta'):
+            assembly, fasta, name = None, str(request['fasta']), os.path.basename(str(request.get('name', '')))
+            if not name or name.startswith('.'):
+                raise ServeError('Inline fasta requests need a valid "name"')
+        else:
+            raise ServeError('Request needs an "assembly" path or inline "fasta"')
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise ServeError(f'Queue is full ({self.max_queue} requests), try again later', 503)
+        try:
+            with self._lock:
+                self._pending += 1
+            submitted = time()
+            try:
+                result, start, end = self._pool.submit(_serve_worker, db, assembly, fasta, name, self.kwargs).result()
+            except Exception as e:
+                self._count('failed')
+                raise ServeError(f'Typing failed: {e}', 500)
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+        with self._lock:
+            self.latencies['total'].append(time() - received)
+            self.latencies['wait'].append(start - submitted)
+            self.latencies['typing'].append(end - start)
+        if not result:
+            self._count('untypeable')
+            raise ServeError(f'Could not type {name or assembly}, see the service log', 422)
+        self._count('typed')
+        return result
+
+    def stats(self) -> dict:
+        """Returns the queue depth, request counts and latency statistics (in ms) of the recent requests"""
+        with self._lock:
+            return {
+                'uptime_s': round(time() - self.started, 3), 'databases': sorted({i.name for i in self.dbs.values()}),
+                'jobs': self.jobs, 'max_queue': self.max_queue, 'running': min(self._pending, self.jobs),
+                'queue_depth': max(0, self._pending - self.jobs), **self.counts,
+                'latency_ms': {k: _summarise(v) for k, v in self.latencies.items()}
+            }
+
+    def close(self):
+        """Stops the worker processes, cancelling requests that haven't started"""
+        self._pool.shutdown(cancel_futures=True)
+
+    def _database(self, name: str | None) -> str:
+        if name is None and len({i.name for i in self.dbs.values()}) == 1:
+            return next(iter(self.dbs.values())).name
+        if name is None:
+            raise ServeError(f'Request needs a "db", choose from {", ".join(sorted(self.dbs))}')
+        if name not in self.dbs:
+            raise ServeError(f'Unknown database {name}, choose from {", ".join(sorted(self.dbs))}', 404)
+        return self.dbs[name].name
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Handles the HTTP requests of a server with a TypingService as its service attribute"""
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            return self._respond(200, json.dumps(self.server.service.stats()) + '\n')
+        self._respond(404, json.dumps({'error': f'Unknown endpoint {self.path}'}) + '\n')
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/type':
+            return self._respond(404, json.dumps({'error': f'Unknown endpoint {self.path}'}) + '\n')
+        try:
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as e:
+                raise ServeError(f'Request body is not valid JSON: {e}')
+            if not isinstance(request, dict):
+                raise ServeError('Request body must be a JSON object')
+            self._respond(200, self.server.service.type(request))
+        except ServeError as e:
+            self._respond(e.status, json.dumps({'error': str(e)}) + '\n')
+
+    def _respond(self, status: int, body: str):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    def log_message(self, format, *args):
+        log(f'{self.address_string()} {format % args}', verbose=self.server.verbose)
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """HTTP server on a Unix socket, handling each connection in a new thread"""
+    daemon_threads = True
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def _init_serve_worker(dbs: dict[str, Database]):
+    """Stores the databases in the worker process so they are only copied once per worker"""
+    _WORKER_DBS.update({db.name: db for db in dbs.values()})
+
+
+def _serve_worker(db: str, assembly: str | None, fasta: str | None, name: str | None, kwargs: dict
+                  ) -> tuple[str | None, float, float]:
+    """
+    Types an assembly file, or inline fasta written to a temporary file, in a worker process. Returns the result as
+    JSON (None if the assembly couldn't be typed) and the start and end times.
+    """
+    start, result = time(), None
+    if fasta is None:
+        result = typing_pipeline(assembly, _WORKER_DBS[db], **kwargs)
+    else:
+        with TemporaryDirectory(prefix='kaptive_') as tmpdir:
+            with open(file := os.path.join(tmpdir, 'assembly.fasta'), 'wt') as f:
+                f.write(fasta)
+            if assembly := parse_assembly(file, kwargs.get('verbose', False)):
+                assembly.name = name  # Rather than the name of the temporary file
+                with assembly:  # Close the file before the directory is removed
+                    result = typing_pipeline(assembly, _WORKER_DBS[db], **kwargs)
+    return result.format('json') if result else None, start, time()
+
+
+def _summarise(times: deque[float]) -> dict:
+    """Returns summary statistics of a list of times in seconds, in milliseconds"""
+    if not times:
+        return {'n': 0}
+    ordered = sorted(times)
+    return {'n': len(ordered), 'mean': mean(ordered) * 1000, 'median': median(ordered) * 1000,
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 'max': ordered[-1] * 1000}
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(dbs: dict[str, Database], host: str = '127.0.0.1', port: int = 8000, socket: str | os.PathLike = None,
+          jobs: int = 1, max_queue: int = 0, threads: int = 1, verbose: bool = False, **kwargs):
+    """
+    Serves typing requests until interrupted, see the module docstring for the endpoints
+    :param dbs: Databases to serve, by the name requests can use for them
+    :param host: Host to listen on, ignored if socket is given
+    :param port: Port to listen on, ignored if socket is given
+    :param socket: Path of a Unix socket to listen on instead of a port
+    :param jobs: Number of worker processes
+    :param max_queue: Maximum number of requests accepted at a time (default: 4 per job)
+    :param threads: Number of alignment threads per job
+    :param verbose: Print progress (and each request) to stderr
+    :param kwargs: Other keyword arguments to pass to the typing_pipeline
+    """
+    service = TypingService(dbs, jobs, max_queue, threads, verbose, **kwargs)
+    if socket:
+        if os.path.exists(socket):  # Left behind by a service that didn't shut down cleanly
+            os.remove(socket)
+        server = _UnixHTTPServer(str(socket), _RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.service, server.verbose = service, verbose
+    signal.signal(signal.SIGTERM, _interrupt)  # Shut down cleanly when stopped by a service manager
+    log(f'Serving {", ".join(service.stats()["databases"])} on {socket or f"http://{host}:{port}"}', verbose=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log('Shutting down', verbose=verbose)
+    finally:
+        server.server_close()
+        service.close()
+        if socket and os.path.exists(socket):
+            os.remove(socket)
@@ -0,0 +1,184 @@
+"""
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+
+Records the time (and optionally the peak memory) spent in each stage of Kaptive as Chrome trace events, which can be
+loaded into a trace viewer such as https://ui.perfetto.dev or chrome://tracing. Tracing is off unless enable() is
+called, in which case spans are recorded per thread and events from worker processes are merged with add_events().
+"""
+from __future__ import annotations
+
+import os
+from json import dump
+from time import time_ns, perf_counter_ns
+from threading import get_native_id, local
+from functools import wraps
+from contextlib import contextmanager
+from typing import Callable, Iterable, Generator, TextIO, Any
+
+# Constants -----------------------------------------------------------------------------------------------------------
+_SETTINGS = None  # Settings passed to enable(), None if tracing is off
+_EVENTS = []  # Finished events recorded in this process
+_LOCAL = local()  # Open spans of each thread (_LOCAL.stack, see _stack), innermost last
+
+
+# Classes -------------------------------------------------------------------------------------------------------------
+class _Span:
+    def __init__(self, name: str, stage: bool = False, **args):
+        self.name = name
+        self.stage = stage  # Stages are ended by the next stage or by the traced function they were started in
+        self.args = args
+        self.start = time_ns()
+        self.peak = 0  # Peak traced memory of the nested spans that have finished
+        if _SETTINGS['memory']:
+            import tracemalloc  # Only imported when memory is traced, as it is slow to import
+            if stack := _stack():  # The peak is reset for this span, so keep the parent's peak so far
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+    def end(self):
+        event = {'name': self.name, 'cat': 'kaptive', 'ph': 'X', 'ts': self.start / 1000,
+                 'dur': (time_ns() - self.start) / 1000, 'pid': os.getpid(), 'tid': get_native_id(), 'args': self.args}
+        stack = _stack()
+        if _SETTINGS['memory']:
+            import tracemalloc
+            self.args['peak_memory_bytes'] = (peak := max(self.peak, tracemalloc.get_traced_memory()[1]))
+            if len(stack) > 1:
+                stack[-2].peak = max(stack[-2].peak, peak)
+        stack.pop()
+        _EVENTS.append(event)
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def _stack() -> list[_Span]:
+    """Returns the open spans of the current thread, so threads typing assemblies concurrently are traced separately"""
+    try:
+        return _LOCAL.stack
+    except AttributeError:
+        _LOCAL.stack = []
+        return _LOCAL.stack
+
+
+def enable(memory: bool = False, process_name: str = 'kaptive'):
+    """
+    Turns on tracing in this process
+    :param memory: Also record the peak memory allocated by Python in each span with tracemalloc (slower)
+    :param process_name: Name of this process in the trace
+    """
+    global _SETTINGS
+    _SETTINGS = {'memory': memory}
+    if memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    _EVENTS.append({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': process_name}})
+
+
+def settings() -> dict | None:
+    """Returns the settings passed to enable(), or None if tracing is off, so workers can be traced the same way"""
+    return _SETTINGS
+
+
+def begin(name: str, **args):
+    """Begins a span, which must be closed with end()"""
+    if _SETTINGS:
+        _stack().append(_Span(name, **args))
+
+
+def end(**args):
+    """Ends the innermost span, adding any arguments to it"""
+    if _SETTINGS and (stack := _stack()):
+        stack[-1].args.update(args)
+        stack[-1].end()
+
+
+@contextmanager
+def span(name: str, **args):
+    """Records the time spent in the with block"""
+    if not _SETTINGS:
+        yield
+        return None
+    (stack := _stack()).append(current := _Span(name, **args))
+    try:
+        yield
+    finally:
+        while stack and stack[-1] is not current:  # Close stages left open in the block
+            stack[-1].end()
+        current.end()
+
+
+def traced(name: str) -> Callable:
+    """Decorator that records each call of the function as a span, stages started in the function end with it"""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _SETTINGS:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stage(name: str, **args):
+    """
+    Ends the current stage (if any) and begins the next, so the stages of a traced function can be marked without
+    wrapping each one in a with block. The last stage ends with the function.
+    """
+    if not _SETTINGS:
+        return None
+    if (stack := _stack()) and stack[-1].stage:
+        stack[-1].end()
+    stack.append(_Span(name, stage=True, **args))
+
+
+def annotate(**args):
+    """Adds arguments (e.g. the assembly name or number of alignments) to the innermost span"""
+    if _SETTINGS and (stack := _stack()):
+        stack[-1].args.update(args)
+
+
+def timed(func: Callable, items: Iterable, key: str) -> Generator[Any, None, None]:
+    """
+    Yields func(item) for each item, adding the milliseconds spent in func to the key argument of the innermost span
+    once the items are exhausted. Used for steps too small to record individually, such as parsing each alignment.
+    """
+    if not _SETTINGS:
+        yield from map(func, items)
+        return None
+    total = 0
+    for item in items:
+        start = perf_counter_ns()
+        result = func(item)
+        total += perf_counter_ns() - start
+        yield result
+    if stack := _stack():
+        stack[-1].args[key] = stack[-1].args.get(key, 0) + total / 1e6
+
+
+def pop_events() -> list[dict]:
+    """Returns and forgets the events recorded in this process, e.g. to send them from a worker to the main process"""
+    events = _EVENTS.copy()
+    _EVENTS.clear()
+    return events
+
+
+def add_events(events: Iterable[dict]):
+    """Adds events recorded in another process"""
+    _EVENTS.extend(events)
+
+
+def write(file: TextIO):
+    """Ends any open spans and writes the events as a Chrome trace JSON"""
+    while stack := _stack():
+        stack[-1].end()
+    dump({'traceEvents': _EVENTS, 'displayTimeUnit': 'ms'}, file)
+    file.write('\n')
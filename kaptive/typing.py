@@ -14,23 +14,34 @@ from __future__ import annotations
 
 from itertools import chain
 from warnings import catch_warnings
-from json import dumps
+from json import dumps, loads
 from typing import TextIO
 from io import TextIOBase
 from os import PathLike, path
+from functools import lru_cache
+from hashlib import blake2b
+from collections import deque
+from contextlib import contextmanager
+from re import compile
+import gzip
+import os
 
 from Bio.Seq import Seq
-from Bio.Align import PairwiseAligner
-import matplotlib
-
-matplotlib.use('Agg')  # Prevents the need for a display when plotting
-from dna_features_viewer import GraphicFeature, GraphicRecord
 
 from kaptive.database import Database, Locus, Gene
-from kaptive.log import warning
+from kaptive.log import warning, log
+from kaptive.utils import LRUCache, cache_dir, atomic_write
+from kaptive.version import __version__
+from kaptive import trace
 
 # Constants -----------------------------------------------------------------------------------------------------------
-_PROTEIN_ALIGNER = PairwiseAligner(scoring='blastp', mode='local')
+_TRANSLATIONS = LRUCache(100_000)  # Translations compared by GeneResult.compare_translation, shared by all assemblies
+_TRANSLATION_REGEX = compile(r'([^\t]+)\t([0-9a-f]{32})\t([012])\t([A-Z*]*)\t([0-9.e+-]*)')  # A saved translation
+_GENE_LISTS = ('expected_genes_inside_locus', 'unexpected_genes_inside_locus', 'expected_genes_outside_locus',
+               'unexpected_genes_outside_locus', 'extra_genes')  # TypingResult gene lists, in order of iteration
+_PLOTS = None  # PlotPool started by start_plots(), plots are rendered as they are written if None
+_RESULT_CACHE_SIZE = 'size'  # File in the result cache directory holding the total size of the cached results
+_RESULT_CACHE_LOCK = 'lock'  # File in the result cache directory locked while the size is read or changed
 
 
 # Classes -------------------------------------------------------------------------------------------------------------
@@ -73,6 +84,12 @@ class TypingResult:
     def __repr__(self):
         return f"{self.sample_name} {self.best_match.name}"
 
+    def __getattr__(self, item):  # Only called if item isn't an attribute, i.e. results from_dict not decoded yet
+        if (item == 'pieces' or item in _GENE_LISTS) and '_dict' in self.__dict__:
+            self._decode()
+            return getattr(self, item)
+        raise AttributeError(f"{self.__class__.__name__} object has no attribute {item}")
+
     def __len__(self):
         return sum(len(i) for i in self.pieces) if self.pieces else 0
 
@@ -158,39 +175,74 @@ class TypingResult:
         self._phenotype = d['phenotype']
         self._problems = d['problems']
         self._confidence = d['confidence']
-        # Add the pieces and create the gene results
+        for r in chain.from_iterable(d[i] for i in _GENE_LISTS):  # Check the genes are in the database, see #31
+            if r['gene'] not in db.genes and r['gene'] not in db.extra_genes:
+                raise TypingResultError(f"Gene {r['gene']} not found in database")
+        # The pieces and gene results are only decoded when they are first accessed, see __getattr__
+        del self.pieces, self.expected_genes_inside_locus, self.unexpected_genes_inside_locus, \
+            self.expected_genes_outside_locus, self.unexpected_genes_outside_locus, self.extra_genes
+        self._dict = d
+        return self
+
+    def _decode(self):
+        """Adds the pieces and creates the gene results from the dict the result was created from"""
+        d = self.__dict__.pop('_dict')
         self.pieces = [LocusPiece.from_dict(i, result=self) for i in d['pieces']]
+        for attr in _GENE_LISTS:
+            setattr(self, attr, [])
         pieces = {i.__repr__(): i for i in self.pieces}
-        gene_results = {}  # This was previously a dict comp, but we need to check the gene is in the database, see #31
-        for r in chain(d['expected_genes_inside_locus'], d['unexpected_genes_inside_locus'],
-                       d['expected_genes_outside_locus'], d['unexpected_genes_outside_locus'],
-                       d['extra_genes']):
-            if not (gene := db.genes.get(r['gene'])) and not (gene := db.extra_genes.get(r['gene'])):
-                raise TypingResultError(f"Gene {r['gene']} not found in database")
-            x = GeneResult.from_dict(r, result=self, piece=pieces.get(r['piece']), gene=gene)
+        gene_results = {}
+        for r in chain.from_iterable(d[i] for i in _GENE_LISTS):
+            x = GeneResult.from_dict(r, result=self, piece=pieces.get(r['piece']),
+                                     gene=self.db.genes.get(r['gene']) or self.db.extra_genes.get(r['gene']))
             gene_results[x.__repr__()] = x
 
         for gene_result in gene_results.values():
             self.add_gene_result(gene_result)
-        return self
 
-    def format(self, format_spec) -> str | GraphicRecord | dict:
+    def _tsv_genes(self) -> tuple[dict[str, list[tuple[str, str, str]]], list[int]]:
+        """
+        Returns the name, summary (str) and phenotype of the gene results in each list and the length of each piece,
+        which are all the TSV needs. Results from_dict that haven't been decoded are summarised from the dict
+        directly, giving the same values as decoding them without creating any gene results or sequences.
+        """
+        if '_dict' not in self.__dict__:
+            return ({attr: [(i.gene.name, str(i), i.phenotype) for i in getattr(self, attr)] for attr in _GENE_LISTS},
+                    [len(i) for i in self.pieces])
+        d, genes = self._dict, {attr: [] for attr in _GENE_LISTS}
+        pieces = {f"{i['id'] or ''}:{int(i['start'])}-{int(i['end'])}{i['strand'] or 'unknown'}":
+                  [int(i['start']), int(i['end'])] for i in d['pieces']}
+        gene_results = {}  # Keyed by GeneResult.__repr__ like _decode, so duplicates are dropped the same way
+        for r in chain.from_iterable(d[i] for i in _GENE_LISTS):
+            gene_results[f"{r['gene']} {r['id'] or ''}:{int(r['start'])}-{int(r['end'])}{r['strand']}"] = r
+        for r in gene_results.values():
+            if (piece := pieces.get(r['piece'])) is not None:  # As LocusPiece.add_gene_result
+                piece[0], piece[1] = min(piece[0], int(r['start'])), max(piece[1], int(r['end']))
+            gene_type = r['gene_type'] if not r['gene_type'].startswith(('expected', 'unexpected')) else \
+                f"{r['gene_type']}{'_inside_locus' if piece is not None else '_outside_locus'}"
+            genes[gene_type].append((r['gene'], GeneResult.summary(
+                r['gene'], float(r['percent_identity']), float(r['percent_coverage']), r['partial'] == 'True',
+                r['phenotype'], r['below_threshold'] == 'True'), r['phenotype']))
+        return genes, [end - start for start, end in pieces.values()]
+
+    def format(self, format_spec) -> str | 'GraphicRecord' | dict:
         if format_spec == 'tsv':
+            genes, pieces = self._tsv_genes()
             return '\t'.join(
                 [
                     self.sample_name, self.best_match.name, self.phenotype, self.confidence, self.problems,
                     f"{self.percent_identity:.2f}%", f"{self.percent_coverage:.2f}%",
-                    f"{self.__len__() - len(self.best_match)} bp" if len(self.pieces) == 1 else 'n/a',
-                    f"{(x := len({i.gene.name for i in self.expected_genes_inside_locus}))} / {(y := len(self.best_match.genes))} ({100 * x / y:.2f}%)",
-                    ';'.join(str(i) for i in x) if (x := self.expected_genes_inside_locus) else '',
-                    ';'.join(self.missing_genes), f"{len(x := self.unexpected_genes_inside_locus)}",
-                    ';'.join(str(i) for i in x) if x else '',
-                    f"{len(x := self.expected_genes_outside_locus)} / {(y := len(self.best_match.genes))} ({100 * len(x) / y:.2f}%)",
-                    ';'.join(str(i) for i in x) if x else '',
-                    f"{len(x := self.unexpected_genes_outside_locus)}",
-                    ';'.join(str(i) for i in x) if x else '',
-                    ';'.join(str(i) for i in filter(lambda z: z.phenotype == "truncated", self)),
-                    ';'.join([str(i) for i in self.extra_genes])
+                    f"{sum(pieces) - len(self.best_match)} bp" if len(pieces) == 1 else 'n/a',
+                    f"{(x := len({i[0] for i in genes['expected_genes_inside_locus']}))} / {(y := len(self.best_match.genes))} ({100 * x / y:.2f}%)",
+                    ';'.join(i[1] for i in x) if (x := genes['expected_genes_inside_locus']) else '',
+                    ';'.join(self.missing_genes), f"{len(x := genes['unexpected_genes_inside_locus'])}",
+                    ';'.join(i[1] for i in x) if x else '',
+                    f"{len(x := genes['expected_genes_outside_locus'])} / {(y := len(self.best_match.genes))} ({100 * len(x) / y:.2f}%)",
+                    ';'.join(i[1] for i in x) if x else '',
+                    f"{len(x := genes['unexpected_genes_outside_locus'])}",
+                    ';'.join(i[1] for i in x) if x else '',
+                    ';'.join(i[1] for i in chain.from_iterable(genes.values()) if i[2] == "truncated"),
+                    ';'.join([i[1] for i in genes['extra_genes']])
                 ]
             ) + "\n"
         if format_spec == 'fna':  # Return the nucleotide sequence of the locus
@@ -198,11 +250,9 @@ class TypingResult:
         if format_spec in {'faa', 'ffn'}:  # Return the protein or nucleotide sequence of gene results
             return "".join([i.format(format_spec) for i in self])
         if format_spec in {'png', 'svg'}:
-            features, start = [], 0
-            for piece in self.pieces if self.pieces[0].strand == "+" else reversed(self.pieces):
-                features.extend(piece.format(format_spec, start))
-                start += len(piece)
-            return GraphicRecord(sequence_length=self.__len__(), first_index=0, features=features,
+            GraphicFeature, GraphicRecord = _graphics()
+            return GraphicRecord(sequence_length=self.__len__(), first_index=0,
+                                 features=[GraphicFeature(**i) for i in self.plot_features()],
                                  feature_level_height=1.5, sequence=[p.sequence for p in self.pieces])
         if format_spec == 'json':
             return dumps(
@@ -219,6 +269,25 @@ class TypingResult:
                 }) + "\n"
         raise ValueError(f"Unknown format specifier {format_spec}")
 
+    def plot_features(self) -> list[dict]:
+        """Returns the GraphicFeature arguments of the locus pieces and genes, in the order they are plotted"""
+        features, start = [], 0
+        for piece in self.pieces if self.pieces[0].strand == "+" else reversed(self.pieces):
+            features.extend(piece.plot_features(start))
+            start += len(piece)
+        return features
+
+    def plot_spec(self, plot: str | PathLike, plot_fmt: str = 'png') -> dict:
+        """
+        Returns everything needed to render the plot of the result with render_plot, as plain values that are cheap
+        to send to a PlotPool worker process
+        :param plot: Directory to write the plot to
+        :param plot_fmt: Plot format
+        """
+        return {'length': self.__len__(), 'features': self.plot_features(),
+                'title': f"{self.sample_name} {self.best_match} ({self.phenotype}) - {self.confidence}",
+                'file': path.join(plot, f'{self.sample_name}_kaptive_results.{plot_fmt}')}
+
     def write(self,
               tsv: TextIO = None,
               json: TextIO = None,
@@ -228,19 +297,26 @@ class TypingResult:
               plot: str | PathLike = None,
               plot_fmt: str = 'png'):
         """Write the typing result to files or file handles."""
-        [f.write(self.format(fmt)) for f, fmt in [(tsv, 'tsv'), (json, 'json')] if isinstance(f, TextIOBase)]
+        for f, fmt in [(tsv, 'tsv'), (json, 'json')]:
+            if isinstance(f, TextIOBase):
+                with trace.span(f'write {fmt}', sample=self.sample_name):
+                    f.write(self.format(fmt))
         for f, fmt in [(fna, 'fna'), (ffn, 'ffn'), (faa, 'faa')]:
             if f:
+                trace.begin(f'write {fmt}', sample=self.sample_name)
                 if isinstance(f, TextIOBase):
                     f.write(self.format(fmt))
                 elif isinstance(f, PathLike) or isinstance(f, str):
                     with open(path.join(f, f'{self.sample_name}_kaptive_results.{fmt}'), 'wt') as handle:
                         handle.write(self.format(fmt))
+                trace.end()
         if plot:
-            ax = self.format(plot_fmt).plot(figure_width=18)[0]  # type: 'matplotlib.axes.Axes'
-            ax.set_title(f"{self.sample_name} {self.best_match} ({self.phenotype}) - {self.confidence}")
-            ax.figure.savefig(path.join(plot, f'{self.sample_name}_kaptive_results.{plot_fmt}'), bbox_inches='tight')
-            ax.figure.clear()  # TODO: Check if this is necessary
+            trace.begin('write plot', sample=self.sample_name)
+            if pool := plot_pool():  # Render in the background while typing continues
+                pool.submit(self.plot_spec(plot, plot_fmt))
+            else:
+                render_plot(self.plot_spec(plot, plot_fmt))
+            trace.end()
 
 
 class LocusPieceError(Exception):
@@ -279,18 +355,23 @@ class LocusPiece:
         return cls(id=d['id'], start=int(d['start']), end=int(d['end']), strand=d['strand'],
                    sequence=Seq(d['sequence']), **kwargs)
 
-    def format(self, format_spec, relative_start: int = 0) -> str | dict | list[GraphicFeature]:
+    def format(self, format_spec, relative_start: int = 0) -> str | dict | list['GraphicFeature']:
         if format_spec == 'fna':
             return f">{self.result.sample_name}|{self.id}:{self.start}-{self.end}{self.strand}\n{self.sequence}\n"
         if format_spec == 'json':
             return {'id': self.id, 'start': str(self.start), 'end': str(self.end), 'strand': self.strand,
                     'sequence': str(self.sequence)}
         if format_spec in {'png', 'svg'}:
-            return [GraphicFeature(start=relative_start, end=relative_start + len(self), strand=1, thickness=30,
-                                   color='#762a83', label=str(self), linewidth=0)] + [
-                gene.format(format_spec, gene.start - self.start + relative_start) for gene in self]
+            GraphicFeature = _graphics()[0]
+            return [GraphicFeature(**i) for i in self.plot_features(relative_start)]
         raise ValueError(f"Unknown format specifier {format_spec}")
 
+    def plot_features(self, relative_start: int = 0) -> list[dict]:
+        """Returns the GraphicFeature arguments of the piece followed by its genes"""
+        return [dict(start=relative_start, end=relative_start + len(self), strand=1, thickness=30, color='#762a83',
+                     label=str(self), linewidth=0)] + [
+            gene.plot_features(gene.start - self.start + relative_start) for gene in self]
+
     def add_gene_result(self, gene_result: GeneResult):
         if gene_result.start < self.start:  # Update start and end if necessary
             self.start = gene_result.start
@@ -336,22 +417,38 @@ class GeneResult:
         return self.end - self.start
 
     def __str__(self) -> str:
-        s = f'{self.gene.name},{self.percent_identity:.2f}%,{self.percent_coverage:.2f}%'
-        s += ",partial" if self.partial else ""
-        s += ',truncated' if self.phenotype == "truncated" else ""
-        s += ",below_id_threshold" if self.below_threshold else ""
+        return self.summary(self.gene.name, self.percent_identity, self.percent_coverage, self.partial, self.phenotype,
+                            self.below_threshold)
+
+    def __getattr__(self, item):  # Only called if item isn't an attribute, i.e. sequences from_dict not decoded yet
+        if item in {'dna_seq', 'protein_seq'} and '_seqs' in self.__dict__:
+            self.dna_seq, self.protein_seq = map(Seq, self.__dict__.pop('_seqs'))
+            return getattr(self, item)
+        raise AttributeError(f"{self.__class__.__name__} object has no attribute {item}")
+
+    @staticmethod
+    def summary(gene: str, percent_identity: float, percent_coverage: float, partial: bool, phenotype: str,
+                below_threshold: bool) -> str:
+        """Summary of a gene result as written in the TSV, also used for results from_dict that aren't decoded"""
+        s = f'{gene},{percent_identity:.2f}%,{percent_coverage:.2f}%'
+        s += ",partial" if partial else ""
+        s += ',truncated' if phenotype == "truncated" else ""
+        s += ",below_id_threshold" if below_threshold else ""
         return s
 
     @classmethod
     def from_dict(cls, d: dict, **kwargs) -> GeneResult:
-        return cls(
-            id=d['id'], start=int(d['start']), end=int(d['end']), strand=d['strand'], dna_seq=Seq(d['dna_seq']),
-            protein_seq=Seq(d['protein_seq']), below_threshold=True if d['below_threshold'] == 'True' else False,
+        self = cls(
+            id=d['id'], start=int(d['start']), end=int(d['end']), strand=d['strand'],
+            below_threshold=True if d['below_threshold'] == 'True' else False,
             phenotype=d['phenotype'], gene_type=d['gene_type'], partial=True if d['partial'] == 'True' else False,
             percent_identity=float(d['percent_identity']), percent_coverage=float(d['percent_coverage']), **kwargs
         )
+        del self.dna_seq, self.protein_seq  # Only made into Seqs when first accessed, see __getattr__
+        self._seqs = (d['dna_seq'], d['protein_seq'])
+        return self
 
-    def format(self, format_spec, relative_start: int = 0) -> str | dict | GraphicFeature:
+    def format(self, format_spec, relative_start: int = 0) -> str | dict | 'GraphicFeature':
         if format_spec == 'ffn':
             if len(self.dna_seq) == 0:
                 warning(f'No DNA sequence for {self}')
@@ -373,16 +470,21 @@ class GeneResult:
                 'gene': self.gene.name, 'piece': self.piece.__repr__() if self.piece else '',
             }
         if format_spec in {'png', 'svg'}:
-            strand = self.gene.strand if self.strand == self.gene.strand else self.strand
-            return GraphicFeature(
-                start=relative_start, end=relative_start + len(self), legend_text=self.gene_type, label=str(self),
-                strand=0 if self.phenotype == "truncated" or self.partial else 1 if strand == "+" else -1,
-                thickness=40, linewidth=3,
-                color=('#762a83' if self.gene_type == 'expected_genes' else "orange", self.percent_identity / 100),
-                linecolor='red' if self.below_threshold else "yellow" if self.phenotype == "truncated" else 'black'
-            )
+            return _graphics()[0](**self.plot_features(relative_start))
         raise ValueError(f"Unknown format specifier {format_spec}")
 
+    def plot_features(self, relative_start: int = 0) -> dict:
+        """Returns the GraphicFeature arguments of the gene"""
+        strand = self.gene.strand if self.strand == self.gene.strand else self.strand
+        return dict(
+            start=relative_start, end=relative_start + len(self), legend_text=self.gene_type, label=str(self),
+            strand=0 if self.phenotype == "truncated" or self.partial else 1 if strand == "+" else -1,
+            thickness=40, linewidth=3,
+            color=('#762a83' if self.gene_type == 'expected_genes' else "orange", self.percent_identity / 100),
+            linecolor='red' if self.below_threshold else "yellow" if self.phenotype == "truncated" else 'black'
+        )
+
+    @trace.traced('compare translation')
     def compare_translation(self, truncation_tolerance: float = 95, **kwargs):
         """
         Extracts the translation from the DNA sequence of the gene result.
@@ -391,16 +493,27 @@ class GeneResult:
         self.gene.extract_translation(**kwargs)  # Extract the translation from the gene if it is not already stored
         if len(self.dna_seq) == 0:  # If the DNA sequence is empty, raise an error
             raise GeneResultError(f'No DNA sequence for {self.__repr__()}')
-        with catch_warnings(record=True) as w:  # Catch Biopython warnings
-            protein_seqs = [self.dna_seq[i:].translate(**kwargs) for i in range(3)]  # Translate in all 3 frames
-        frame, self.protein_seq = max(enumerate(protein_seqs), key=lambda x: len(x[1]))  # Get the longest translation
+        # The same allele is often found in many assemblies, so the translation and identity are cached on the gene and
+        # a digest of the reference protein, DNA sequence and translation options
+        key = (self.gene.name, blake2b(f'{self.gene.protein_seq}|{self.dna_seq}|{sorted(kwargs.items())}'.encode(),
+                                       digest_size=16).digest())
+        if (translation := _TRANSLATIONS.get(key)) is None:
+            with catch_warnings(record=True) as w:  # Catch Biopython warnings
+                protein_seqs = [self.dna_seq[i:].translate(**kwargs) for i in range(3)]  # Translate in all 3 frames
+            frame, protein_seq = max(enumerate(protein_seqs), key=lambda x: len(x[1]))  # Get the longest translation
+            identity = None
+            if len(protein_seq) > 1 and len(self.gene.protein_seq) > 1:  # If both sequences are not empty
+                if alignments := _protein_aligner().align(self.gene.protein_seq, protein_seq):  # Align the sequences
+                    alignment = max(alignments, key=lambda x: x.score)  # Get the best alignment
+                    identity = alignment.counts().identities / alignment.length * 100
+            translation = _TRANSLATIONS[key] = (frame, protein_seq, identity)
+        frame, self.protein_seq, identity = translation
         self.start += frame  # Update the start position to the frame with the longest translation
         if len(self.protein_seq) <= 1:  # If the protein sequence is still empty, raise a warning
             warning(f'No protein sequence for {self.__repr__()}')
         elif len(self.gene.protein_seq) > 1:  # If both sequences are not empty
-            if alignments := _PROTEIN_ALIGNER.align(self.gene.protein_seq, self.protein_seq):  # Align the sequences
-                alignment = max(alignments, key=lambda x: x.score)  # Get the best alignment
-                self.percent_identity = alignment.counts().identities / alignment.length * 100
+            if identity is not None:
+                self.percent_identity = identity
                 self.percent_coverage = (len(self.protein_seq) / len(self.gene.protein_seq)) * 100
                 if (self.percent_coverage < truncation_tolerance and  # If the coverage is less than the tolerance
                         # not partial, and not unexpected gene outside locus
@@ -408,3 +521,292 @@ class GeneResult:
                     self.phenotype = "truncated"  # Set the phenotype to truncated
             else:
                 warning(f'Error aligning {self.__repr__()}')
+
+
+class PlotPool:
+    """
+    Renders plots from plot specs (see TypingResult.plot_spec) in a pool of worker processes, so plots are written
+    in the background while typing continues. Only a few plots per worker are in flight at a time; when the pool is
+    busy, submit() waits for the oldest plot to finish, so memory is bounded no matter how many plots are submitted.
+    """
+    def __init__(self, jobs: int = 1, verbose: bool = False):
+        self.jobs = jobs
+        from concurrent.futures import ProcessPoolExecutor
+        self.pid = os.getpid()  # Processes forked from this one can't submit to the pool
+        self._pool = ProcessPoolExecutor(jobs, initializer=_init_plot_worker, initargs=(trace.settings(),))
+        self._pending = deque()  # (file, future) of each plot in flight, oldest first
+        log(f'Rendering plots with {jobs} jobs', verbose=verbose)
+
+    def submit(self, spec: dict):
+        """Submits a plot spec to be rendered, finishing any plots that are done"""
+        self._pending.append((spec['file'], self._pool.submit(_plot_worker, spec)))
+        while self._pending and (len(self._pending) > self.jobs * 4 or self._pending[0][1].done()):
+            self._finish(*self._pending.popleft())
+
+    def close(self):
+        """Waits for all plots to be written and stops the worker processes"""
+        while self._pending:
+            self._finish(*self._pending.popleft())
+        self._pool.shutdown()
+
+    @staticmethod
+    def _finish(file: str, future: 'Future'):
+        try:
+            trace.add_events(future.result())
+        except Exception as e:  # A failed plot shouldn't stop the run
+            warning(f'Could not write plot {file}: {e}')
+
+
+class ResultCache:
+    """
+    On-disk cache of typing results, stored as gzipped JSON under a hash of the assembly contigs (names and sequences),
+    the database fingerprint, the Kaptive version and the typing options, so an assembly typed before with the same
+    database and options isn't aligned again, whatever its file is called. Results are only cached for databases with a
+    fingerprint (see load_database). When the cache is larger than max_size bytes, the least recently used results
+    are removed until it is 10% smaller. The total size is kept in a file in the cache directory that is only changed
+    under a lock, so the limit holds for every process using the cache, such as the workers of a typing pool.
+    Copies of the cache sent to worker processes count their own hits and misses, returned with pop_counts.
+    """
+    def __init__(self, directory: str | PathLike = None, max_size: int = 1_000_000_000, verbose: bool = False):
+        self.directory = directory or cache_dir('results')
+        self.max_size = max_size
+        self.verbose = verbose
+        self.hits, self.misses = 0, 0
+
+    def __getstate__(self):
+        return self.__dict__ | {'hits': 0, 'misses': 0}  # Counted in each process, see pop_counts
+
+    @property
+    def size(self) -> int:
+        """
+        Total size of the cached results in bytes, read from the size file. The cache is only scanned if the file
+        doesn't exist yet, e.g. the first time a result is added.
+        """
+        with self._lock():
+            return self._read_size()
+
+    def __repr__(self):
+        return (f'{self.directory}: {self.size / 1e6:.1f}/{self.max_size / 1e6:.0f} MB, {self.hits} hits, '
+                f'{self.misses} misses')
+
+    def key(self, assembly: 'Assembly', db: Database, **options) -> str | None:
+        """
+        Returns the cache key of the assembly typed with the database and options, or None if the database has no
+        fingerprint. Options are the typing_pipeline arguments that change the result.
+        """
+        if not db.fingerprint:
+            return None
+        digest = blake2b(digest_size=20)
+        for contig in assembly.contigs.values():
+            digest.update(f'>{contig.name}\n{contig.seq}\n'.encode())
+        digest.update(f'{db.fingerprint}|{__version__}|{sorted(options.items())}'.encode())
+        return digest.hexdigest()
+
+    def get(self, key: str, sample_name: str, db: Database) -> TypingResult | None:
+        """Returns the cached result for the key, renamed to the sample name, or None if it isn't cached"""
+        try:
+            with gzip.open(file := self._path(key), 'rt') as f:
+                result = TypingResult.from_dict(loads(f.read()), db)
+            os.utime(file)  # Mark it as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:  # A corrupt result is typed again and replaced
+            self.misses += 1
+            return log(f'Could not read cached result {key}: {e}', verbose=self.verbose)
+        self.hits += 1
+        result.sample_name = sample_name
+        return result
+
+    def put(self, key: str, result: TypingResult):
+        """Caches a result, removing the least recently used results if the cache is full"""
+        try:
+            os.makedirs(path.dirname(file := self._path(key)), exist_ok=True)
+            with self._lock():  # So other processes don't change the size between reading and writing it
+                size = self._read_size()  # Scanned before the result is added, so it is only counted once
+                old_size = path.getsize(file) if path.isfile(file) else 0  # The size of a result being replaced
+                with atomic_write(file) as tmp_file, gzip.open(tmp_file, 'wt', compresslevel=1) as f:
+                    f.write(result.format('json'))
+                self._write_size(size := size + path.getsize(file) - old_size)
+        except Exception as e:
+            return log(f'Could not cache result {key}: {e}', verbose=self.verbose)
+        if size > self.max_size:
+            self.prune(int(self.max_size * 0.9))
+
+    def pop_counts(self) -> tuple[int, int]:
+        """Returns the hits and misses since the last call and resets them"""
+        counts, self.hits, self.misses = (self.hits, self.misses), 0, 0
+        return counts
+
+    def entries(self) -> list[os.DirEntry]:
+        """Returns the cached result files"""
+        return [entry for subdir in os.scandir(self.directory) if subdir.is_dir()
+                for entry in os.scandir(subdir.path) if entry.name.endswith('.json.gz')]
+
+    def prune(self, max_size: int) -> tuple[int, int]:
+        """
+        Removes the least recently used results until the cache is no larger than max_size bytes
+        :return: Number of results and bytes removed
+        """
+        with self._lock():
+            entries = sorted(((i.stat(), i.path) for i in self.entries()), key=lambda i: i[0].st_mtime)
+            size, removed, freed = sum(i[0].st_size for i in entries), 0, 0
+            for stat, file in entries:
+                if size <= max_size:
+                    break
+                try:
+                    os.remove(file)
+                except FileNotFoundError:  # Already removed, e.g. by hand
+                    pass
+                size, removed, freed = size - stat.st_size, removed + 1, freed + stat.st_size
+            self._write_size(size)
+        log(f'Removed {removed} cached results ({freed / 1e6:.1f} MB) from {self.directory}', verbose=self.verbose)
+        return removed, freed
+
+    def _path(self, key: str) -> str:
+        return path.join(self.directory, key[:2], f'{key}.json.gz')
+
+    @contextmanager
+    def _lock(self):
+        """Holds an exclusive lock on the cache, released when the lock file is closed"""
+        from fcntl import flock, LOCK_EX
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path.join(self.directory, _RESULT_CACHE_LOCK), 'a') as f:
+            flock(f, LOCK_EX)
+            yield
+
+    def _read_size(self) -> int:
+        """Returns the size in the size file, scanning the cache and writing the file if it is missing or invalid"""
+        try:
+            with open(path.join(self.directory, _RESULT_CACHE_SIZE), 'rt') as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            self._write_size(size := sum(i.stat().st_size for i in self.entries()))
+            return size
+
+    def _write_size(self, size: int):
+        with atomic_write(path.join(self.directory, _RESULT_CACHE_SIZE)) as tmp_file, open(tmp_file, 'wt') as f:
+            f.write(str(size))
+
+
+# Functions ------------------------------------------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def _protein_aligner() -> 'PairwiseAligner':
+    """Returns the protein aligner, which is created on first use as Bio.Align is slow to import (it imports numpy)"""
+    from Bio.Align import PairwiseAligner
+    return PairwiseAligner(scoring='blastp', mode='local')
+
+
+@lru_cache(maxsize=None)
+def _graphics() -> tuple[type, type]:
+    """
+    Imports matplotlib and dna_features_viewer the first time a plot is made, as they are slow to import and most
+    runs don't make plots. Returns the GraphicFeature and GraphicRecord classes.
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # Prevents the need for a display when plotting
+    from dna_features_viewer import GraphicFeature, GraphicRecord
+    return GraphicFeature, GraphicRecord
+
+
+def render_plot(spec: dict):
+    """Renders a plot spec from TypingResult.plot_spec and writes it to the file in the spec"""
+    GraphicFeature, GraphicRecord = _graphics()
+    from matplotlib import pyplot
+    ax = GraphicRecord(sequence_length=spec['length'], first_index=0, feature_level_height=1.5,
+                       features=[GraphicFeature(**i) for i in spec['features']]).plot(figure_width=18)[0]
+    ax.set_title(spec['title'])
+    ax.figure.savefig(spec['file'], bbox_inches='tight')
+    pyplot.close(ax.figure)  # Figures are kept by pyplot until they are closed
+
+
+def _init_plot_worker(trace_settings: dict | None):
+    """Turns on tracing in the plot worker process if it is on in the main process"""
+    if trace_settings:
+        trace.enable(process_name='kaptive plot worker', **trace_settings)
+
+
+def _plot_worker(spec: dict) -> list[dict]:
+    """Renders a plot spec in a PlotPool worker process and returns the trace events"""
+    with trace.span('render plot', file=spec['file']):
+        render_plot(spec)
+    return trace.pop_events()
+
+
+def start_plots(jobs: int = 1, verbose: bool = False):
+    """
+    Starts a PlotPool so TypingResult.write renders plots in the background in this process, until finish_plots()
+    :param jobs: Number of plot worker processes
+    :param verbose: Print progress to stderr
+    """
+    global _PLOTS
+    _PLOTS = PlotPool(jobs, verbose)
+
+
+def plot_pool() -> PlotPool | None:
+    """Returns the PlotPool started in this process by start_plots(), or None if there isn't one"""
+    return _PLOTS if _PLOTS and _PLOTS.pid == os.getpid() else None
+
+
+def finish_plots():
+    """Waits for the plots submitted to the PlotPool to be written and stops it"""
+    global _PLOTS
+    if pool := plot_pool():
+        pool.close()
+    _PLOTS = None
+
+
+def _translations_file(db: Database) -> str | None:
+    """Returns the path of the persistent translation cache for the database, or None if it has no fingerprint"""
+    return path.join(cache_dir('translations'), f'{db.name}_{db.fingerprint[:16]}.tsv') if db.fingerprint else None
+
+
+def _parse_translation(line: str) -> tuple[tuple[str, bytes], tuple[int, Seq, float | None]]:
+    """
+    Parses a line of a file written by save_translations into a translation cache item
+    :raises ValueError: If the line isn't a valid translation
+    """
+    if not (match := _TRANSLATION_REGEX.fullmatch(line.rstrip('\n'))):
+        raise ValueError(f'Invalid translation: {line[:100]!r}')
+    gene, digest, frame, protein_seq, identity = match.groups()
+    if (identity := float(identity) if identity else None) is not None and not 0 <= identity <= 100:
+        raise ValueError(f'Invalid identity: {identity}')
+    return (gene, bytes.fromhex(digest)), (int(frame), Seq(protein_seq), identity)
+
+
+def load_translations(db: Database, verbose: bool = False, record_new: bool = False):
+    """
+    Loads translations saved by save_translations for the database into the translation cache. The file is plain
+    text and every line is validated, so a cache directory shared with other users can't inject anything other than
+    translations; if any line is invalid, the file is ignored and rebuilt.
+    :param db: Database object
+    :param verbose: Print progress to stderr
+    :param record_new: Record translations added from then on, so a worker process can return them to the main
+                       process to be saved at the end of the run (see LRUCache.pop_new)
+    """
+    _TRANSLATIONS.record_new = record_new
+    try:
+        if (file := _translations_file(db)) and path.isfile(file):
+            with open(file, 'rt') as f:
+                _TRANSLATIONS.update([_parse_translation(line) for line in f])
+            log(f'Loaded {len(_TRANSLATIONS)} translations from {file}', verbose=verbose)
+    except Exception as e:  # A corrupt or incompatible cache is rebuilt
+        log(f'Could not load translations: {e}', verbose=verbose)
+
+
+def save_translations(db: Database, verbose: bool = False):
+    """Saves the translation cache for the database so later runs can reuse it, see load_translations"""
+    try:
+        if not (file := _translations_file(db)):
+            return None
+        with atomic_write(file) as tmp_file, open(tmp_file, 'wt') as f:
+            f.writelines(f'{gene}\t{digest.hex()}\t{frame}\t{protein_seq}\t{"" if identity is None else identity}\n'
+                         for (gene, digest), (frame, protein_seq, identity) in _TRANSLATIONS.items()
+                         if '\t' not in gene and '\n' not in gene)
+        for old_file in os.listdir(directory := path.dirname(file)):  # Remove caches of outdated database files
+            if (old_file.startswith(f'{db.name}_') and len(old_file) == len(path.basename(file)) and
+                    old_file != path.basename(file)):
+                os.remove(path.join(directory, old_file))
+        log(f'Saved {len(_TRANSLATIONS)} translations to {file}', verbose=verbose)
+    except Exception as e:
+        log(f'Could not save translations: {e}', verbose=verbose)
@@ -14,14 +14,25 @@ from __future__ import annotations
 
 import os
 import sys
+from subprocess import Popen, PIPE
+from shutil import which
+from mmap import mmap, ACCESS_READ
+from struct import unpack
+from io import BytesIO, TextIOWrapper
+from threading import Thread, Lock
 from zlib import decompress as gz_decompress
 from gzip import open as gz_open
 from bz2 import (decompress as bz2_decompress, open as bz2_open)
 from lzma import (decompress as xz_decompress, open as xz_open)
-from typing import Generator, TextIO, Any, BinaryIO
+from typing import Generator, TextIO, Any, BinaryIO, Iterable
 from operator import itemgetter
+from collections import OrderedDict
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from weakref import finalize
 
 from kaptive.log import log, quit_with_error, bold_cyan, warning
+from kaptive import trace
 
 # Constants -----------------------------------------------------------------------------------------------------------
 _MAX_CPUS = 32
@@ -29,6 +40,9 @@ _MAGIC_BYTES = {b'\x1f\x8b': 'gz', b'\x42\x5a': 'bz2', b'\xfd7zXZ\x00': 'xz'}
 _OPEN = {'gz': gz_open, 'bz2': bz2_open, 'xz': xz_open}
 _DECOMPRESS = {'gz': gz_decompress, 'bz2': bz2_decompress, 'xz': xz_decompress}
 _MIN_N_BYTES = max(len(i) for i in _MAGIC_BYTES)  # Minimum number of bytes to read in a file to guess the compression)
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'  # gzip magic, deflate and the FEXTRA flag, which holds the BGZF block size
+_COMPLEMENT = bytes.maketrans(b'ACGTURYKMBVDHSWNacgturykmbvdhswn', b'TGCAAYRMKVBHDSWNtgcaayrmkvbhdswn')
+_CACHE_DIR_ENV = 'KAPTIVE_CACHE_DIR'  # Environment variable to override the default cache directory
 _LOGO = r"""  _  __    _    ____ _____ _____     _______ 
  | |/ /   / \  |  _ \_   _|_ _\ \   / / ____|
  | ' /   / _ \ | |_) || |  | | \ \ / /|  _|  
@@ -37,21 +51,396 @@ _LOGO = r"""  _  __    _    ____ _____ _____     _______
 """
 
 
+# Classes -------------------------------------------------------------------------------------------------------------
+class LRUCache:
+    """
+    A mapping that holds at most maxsize items, evicting the least recently used item when full. Hits and misses of
+    get() are counted so the cache can be sized. If record_new is True, items set since the last call to pop_new()
+    are also kept so they can be merged into a cache in another process.
+    """
+
+    def __init__(self, maxsize: int, record_new: bool = False):
+        self.maxsize = maxsize
+        self.record_new = record_new
+        self.hits, self.misses = 0, 0
+        self._items = OrderedDict()
+        self._new = {}
+        self._lock = Lock()  # Items are read and set by the threads of typing_overlapped
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return f'{len(self)}/{self.maxsize} items, {self.hits} hits, {self.misses} misses'
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if self.record_new:
+                self._new[key] = value
+            if len(self._items) > self.maxsize:
+                self._new.pop(self._items.popitem(last=False)[0], None)  # Evicted items aren't kept either
+
+    def get(self, key, default=None):
+        with self._lock:
+            if (value := self._items.get(key, default)) is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return value
+
+    def items(self):
+        return self._items.items()
+
+    def update(self, items: Iterable[tuple[Any, Any]]):
+        for key, value in items:
+            self[key] = value
+
+    def clear(self):
+        """Removes all items and resets the hit and miss counts"""
+        self._items.clear()
+        self._new.clear()
+        self.hits, self.misses = 0, 0
+
+    def pop_new(self) -> dict:
+        """Returns the items set since the last call and forgets them"""
+        new, self._new = self._new, {}
+        return new
+
+    def pop_counts(self) -> tuple[int, int]:
+        """Returns the hits and misses since the last call and resets them"""
+        counts, self.hits, self.misses = (self.hits, self.misses), 0, 0
+        return counts
+
+
+class IntervalIndex:
+    """
+    Finds the intervals that overlap a range, using lists sorted by start and bisect. As the longest interval is
+    tracked, only intervals starting within that distance of the range are checked, so adding and finding intervals
+    takes roughly log n time when they are short compared to the sequence, e.g. alignments on a contig.
+    """
+
+    def __init__(self, intervals: Iterable[tuple[int, int, Any]] = ()):
+        self._starts = []
+        self._intervals = []  # (start, end, value) tuples in the same order as self._starts
+        self._max_length = 0
+        for interval in intervals:
+            self.add(*interval)
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def add(self, start: int, end: int, value: Any = None):
+        """Adds the interval start-end with an optional value"""
+        i = bisect_right(self._starts, start)
+        self._starts.insert(i, start)
+        self._intervals.insert(i, (start, end, value))
+        self._max_length = max(self._max_length, end - start)
+
+    def remove(self, start: int, end: int, value: Any = None):
+        """Removes an interval added with the same start, end and value"""
+        for i in range(bisect_left(self._starts, start), bisect_right(self._starts, start)):
+            if self._intervals[i][1] == end and self._intervals[i][2] == value:
+                del self._starts[i], self._intervals[i]
+                return None
+        raise ValueError(f'Interval {start}-{end} not in index')
+
+    def overlapping(self, start: int, end: int) -> Generator[tuple[int, int, Any], None, None]:
+        """Yields the (start, end, value) of the intervals overlapping start-end by at least 1, ordered by start"""
+        for interval in self._intervals[bisect_right(self._starts, start - self._max_length):
+                                        bisect_left(self._starts, end)]:
+            if min(interval[1], end) > max(interval[0], start):
+                yield interval
+
+
+class FastaIndexError(Exception):
+    pass
+
+
+class FastaIndex:
+    """
+    Random access to the sequences in a fasta file with a faidx-style index of the length, offset, bases per line and
+    bytes per line of each sequence, so regions can be fetched without loading the whole file into memory.
+    Uncompressed files are memory mapped and BGZF-compressed files are decompressed one block at a time, other
+    compressed files are decompressed into memory. A samtools faidx index (file.fai) is reused if it is newer than
+    the file and matches it (see _read_fai). Raises FastaIndexError if the file can't be indexed, e.g. because the
+    line lengths of a sequence are irregular.
+    """
+
+    def __init__(self, file: str | os.PathLike, verbose: bool = False):
+        self.file = file
+        self.descriptions = {}  # name: description
+        self._index = {}  # name: (length, offset, line_bases, line_bytes)
+        with open(file, 'rb') as f:
+            first_bytes = f.read(len(_BGZF_MAGIC))
+        if first_bytes.startswith(_BGZF_MAGIC) and (data := _BgzfReader(file)):
+            log(f"Indexing {os.path.basename(file)} as BGZF", verbose=verbose)
+            self._data = data
+        elif compression := next((v for k, v in _MAGIC_BYTES.items() if first_bytes.startswith(k)), None):
+            log(f"Decompressing {os.path.basename(file)} ({compression}) into memory", verbose=verbose)
+            with _OPEN[compression](file, 'rb') as f:
+                self._data = f.read()
+        else:
+            with open(file, 'rb') as f:
+                self._data = mmap(f.fileno(), 0, access=ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        # Close the memory map or BGZF file when the index is garbage collected, if close() isn't called first
+        self._finalizer = finalize(self, self._data.close) if isinstance(self._data, (mmap, _BgzfReader)) else None
+        if (os.path.isfile(fai := f'{file}.fai') and os.path.getmtime(fai) >= os.path.getmtime(file) and
+                self._read_fai(fai, verbose)):
+            log(f"Reusing {os.path.basename(fai)}", verbose=verbose)
+        elif isinstance(self._data, _BgzfReader):  # Index the decompressed data, which is then released
+            with gz_open(file, 'rb') as f:
+                self._build(f.read())
+        else:
+            self._build(self._data)
+
+    def __repr__(self):
+        return f'{os.path.basename(self.file)}: {len(self._index)} sequences'
+
+    def __len__(self):
+        return len(self._index)
+
+    def _read_fai(self, fai: str | os.PathLike, verbose: bool = False) -> bool:
+        """
+        Reads a samtools faidx index, checking that it matches the data: the header before each sequence has its name,
+        and the last sequence ends where the data does, so an index of another version of the file isn't used just
+        because it is newer. Only the headers are read, which also gives the sequence descriptions.
+        Returns False (leaving the index empty) if the index can't be read or doesn't match.
+        """
+        try:
+            with open(fai, 'rt') as f:
+                index = {name: (int(length), int(offset), int(line_bases), int(line_bytes)) for
+                         name, length, offset, line_bases, line_bytes in (i.split('\t')[:5] for i in f)}
+        except Exception as e:
+            log(f'Could not read {os.path.basename(fai)}: {e}', verbose=verbose)
+            return False
+        end, descriptions, size = 0, {}, len(self._data)  # End of the previous sequence
+        for name, (length, offset, line_bases, line_bytes) in index.items():
+            header = self._data[end:offset].lstrip(b'\r\n')  # Line endings of the previous sequence, then the header
+            fields = header[1:].decode(errors='replace').split(maxsplit=1) or ['']
+            if not (header.startswith(b'>') and header.endswith(b'\n')) or fields[0] != name:
+                break
+            descriptions[name] = fields[1].rstrip() if len(fields) == 2 else ''
+            end = offset + (length - 1) // line_bases * line_bytes + (length - 1) % line_bases + 1 if length else offset
+        else:
+            if size - end <= 2 and not self._data[end:size].strip():  # Only the last line ending can follow
+                self.descriptions, self._index = descriptions, index
+                return True
+        log(f'{os.path.basename(fai)} does not match {os.path.basename(self.file)}', verbose=verbose)
+        return False
+
+    def _build(self, data: bytes | mmap):
+        """Builds the index from the uncompressed data, one sequence at a time"""
+        start = 0 if data[:1] == b'>' else data.find(b'\n>') + 1 or len(data)  # Start of the first header
+        while start < len(data):
+            if (header_end := data.find(b'\n', start)) == -1:
+                header_end = len(data)
+            header = data[start + 1:header_end].decode().split(maxsplit=1)
+            name = header[0] if header else ''
+            self.descriptions[name] = header[1].rstrip() if len(header) == 2 else ''
+            end = data.find(b'\n>', header_end) + 1 or len(data)  # Start of the next header
+            self._index[name] = self._index_sequence(name, data[header_end + 1:end], header_end + 1)
+            start = end
+
+    @staticmethod
+    def _index_sequence(name: str, seq: bytes, offset: int) -> tuple[int, int, int, int]:
+        """
+        Indexes the lines of a sequence, checking that all lines but the last have the same length by slicing every
+        line_bytes-th byte instead of reading each line
+        """
+        if not (seq := seq.rstrip(b'\r\n')):
+            return 0, offset, 0, 0
+        if b' ' in seq or b'\t' in seq:
+            raise FastaIndexError(f'Whitespace in sequence {name}')
+        if (line_bytes := seq.find(b'\n') + 1) == 0:  # Single line sequence
+            return len(seq), offset, len(seq), len(seq) + 1
+        line_bases = line_bytes - 1 - (seq[line_bytes - 2:line_bytes - 1] == b'\r')
+        lines, last_line = divmod(len(seq), line_bytes)  # Number of full lines and bases in the last line
+        if (not line_bases or last_line > line_bases or seq.count(b'\n') != lines or
+                seq[line_bytes - 1::line_bytes] != b'\n' * lines or
+                seq.count(b'\r') != lines * (line_bytes - line_bases - 1) or
+                (line_bytes - line_bases == 2 and seq[line_bytes - 2::line_bytes] != b'\r' * lines)):
+            raise FastaIndexError(f'Irregular line lengths in sequence {name}')
+        return lines * line_bases + last_line, offset, line_bases, line_bytes
+
+    def lengths(self) -> dict[str, int]:
+        """Returns the length of each sequence, in file order"""
+        return {name: record[0] for name, record in self._index.items()}
+
+    def fetch(self, name: str, start: int = 0, end: int = None, reverse_complement: bool = False) -> bytes:
+        """
+        Fetches the start-end region (0-based, end-exclusive) of a sequence, clipped to the sequence
+        :param name: Name of the sequence
+        :param start: Start position
+        :param end: End position, defaults to the end of the sequence
+        :param reverse_complement: Return the reverse complement of the region
+        :return: Bytes of the region
+        """
+        length, offset, line_bases, line_bytes = self._index[name]
+        start, end = max(start, 0), length if end is None else min(end, length)
+        if start >= end:
+            return b''
+        seq = self._data[offset + start // line_bases * line_bytes + start % line_bases:
+                         offset + (end - 1) // line_bases * line_bytes + (end - 1) % line_bases + 1]
+        if line_bytes != line_bases:  # Remove line endings
+            seq = seq.replace(b'\n', b'').replace(b'\r', b'')
+        return seq.translate(_COMPLEMENT)[::-1] if reverse_complement else seq
+
+    def close(self):
+        """Closes the memory map or BGZF file"""
+        if self._finalizer is not None:
+            self._finalizer()  # Only closes them once, even if called again by the garbage collector
+
+
+class _BgzfReader:
+    """
+    Reads byte ranges of the uncompressed data of a BGZF file, only decompressing the blocks that contain them.
+    Blocks are found by reading the block sizes from the header of each block, without decompressing them.
+    """
+
+    def __init__(self, file: str | os.PathLike):
+        self._file = open(file, 'rb')
+        self._offsets, self._starts = [], []  # Offsets of the blocks in the file and in the uncompressed data
+        self._blocks = LRUCache(8)  # Recently decompressed blocks
+        offset, start, size = 0, 0, os.fstat(self._file.fileno()).st_size
+        while offset < size:
+            self._file.seek(offset)
+            if not (header := self._file.read(12)).startswith(_BGZF_MAGIC):
+                self._offsets = []  # Not BGZF, e.g. a plain gzip file with an extra field
+                break
+            extra = self._file.read(unpack('<H', header[10:12])[0])
+            block_size = next((unpack('<H', extra[i + 4:i + 6])[0] + 1 for i in self._subfields(extra)
+                               if extra[i:i + 2] == b'BC'), None)
+            if block_size is None:
+                self._offsets = []
+                break
+            self._file.seek(offset + block_size - 4)
+            self._offsets.append(offset)
+            self._starts.append(start)
+            offset, start = offset + block_size, start + unpack('<I', self._file.read(4))[0]
+        self._offsets.append(size)
+        self._size = start  # Length of the uncompressed data
+        if len(self._offsets) == 1:
+            self._file.close()
+
+    def __bool__(self):
+        return len(self._offsets) > 1
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _subfields(extra: bytes) -> Generator[int, None, None]:
+        i = 0
+        while i + 4 <= len(extra):
+            yield i
+            i += 4 + unpack('<H', extra[i + 2:i + 4])[0]
+
+    def _block(self, i: int) -> bytes:
+        if (block := self._blocks.get(i)) is None:
+            self._file.seek(self._offsets[i])
+            data = self._file.read(self._offsets[i + 1] - self._offsets[i])
+            self._blocks[i] = block = gz_decompress(data[12 + unpack('<H', data[10:12])[0]:-8], -15)
+        return block
+
+    def __getitem__(self, item: slice) -> bytes:
+        first = i = max(bisect_right(self._starts, item.start) - 1, 0)
+        blocks = []
+        while i < len(self._starts) and (self._starts[i] < item.stop or i == first):
+            blocks.append(self._block(i))
+            i += 1
+        return b''.join(blocks)[item.start - self._starts[first]:item.stop - self._starts[first]]
+
+    def close(self):
+        self._file.close()
+
+
 # Functions -----------------------------------------------------------------------------------------------------------
 def check_programs(progs: list[str], verbose: bool = False):
-    """Check if programs are installed and executable"""
-    bins = {  # Adapted from: https://unix.stackexchange.com/a/261971/375975
-        binary: x for path in filter(
-            os.path.isdir, os.environ["PATH"].split(os.path.pathsep)
-        ) for binary in os.listdir(path) if os.access((x := os.path.join(path, binary)), os.X_OK)
-    }
+    """
+    Check if programs are installed and executable. Each program is looked up directly in the PATH directories (in
+    order, stopping at the first match) rather than listing every directory, which is slow on network filesystems.
+    """
     for program in progs:
-        if program in bins:
-            log(f'{program}: {bins[program]}', verbose=verbose)
+        if binary := which(program):
+            log(f'{program}: {binary}', verbose=verbose)
         else:
             quit_with_error(f'{program} not found')
 
 
+def stream_command(cmd: str, stdin: str | Iterable[str] = '', verbose: bool = False) -> Generator[str, None, None]:
+    """
+    Runs a shell command and yields lines of stdout as soon as they are written, without the trailing newline.
+    The stdin text is written on a background thread and stderr is collected on another so neither can block the
+    command; stderr is only reported (as a warning) if the command exits with a non-zero status.
+    :param cmd: Command to run with the shell
+    :param stdin: Text to write to the command's stdin, or an iterable of text chunks
+    :param verbose: Print log messages to stderr
+    :return: Generator of stdout lines
+    """
+    log(f"{cmd=}", verbose=verbose, stack_depth=2)
+    trace.begin('spawn', cmd=cmd)
+    process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
+    trace.end()
+    stderr = []
+    threads = [Thread(target=_write_stdin, args=(process.stdin, [stdin] if isinstance(stdin, str) else stdin),
+                      daemon=True), Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)]
+    [t.start() for t in threads]
+    try:
+        for line in process.stdout:
+            yield line.rstrip('\n')
+    finally:  # Make sure the command doesn't outlive the generator, e.g. if it isn't fully consumed
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        [t.join() for t in threads]
+    if process.wait():
+        warning(f"{cmd} exited with status {process.returncode}\n{''.join(stderr)}")
+
+
+def _write_stdin(handle: TextIO, chunks: Iterable[str]):
+    """Writes text chunks to a process's stdin, then closes it so the process knows the input has finished"""
+    try:
+        for chunk in chunks:
+            handle.write(chunk)
+    except BrokenPipeError:  # The process has exited early, the error will be reported from its exit status
+        pass
+    finally:
+        try:
+            handle.close()
+        except BrokenPipeError:
+            pass
+
+
+def cache_dir(*subdirs: str) -> str:
+    """
+    Returns the Kaptive cache directory (or a subdirectory of it), creating it if it doesn't exist.
+    Uses $KAPTIVE_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/kaptive or ~/.cache/kaptive.
+    """
+    directory = os.path.join(os.environ.get(_CACHE_DIR_ENV) or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'kaptive'), *subdirs)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+@contextmanager
+def atomic_write(file: str | os.PathLike) -> Generator[str, None, None]:
+    """
+    Yields a temporary path next to the file to write to, which is then renamed to the file in one step. Processes
+    reading the file (e.g. concurrent runs sharing the cache directory) never see it partly written, only the old or
+    the new file. The temporary file is removed if writing it fails.
+    """
+    tmp_file = f'{file}.{os.getpid()}.tmp'
+    try:
+        yield tmp_file
+        os.replace(tmp_file, file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
 def check_file(file: str | os.PathLike, panic: bool = False) -> os.PathLike | None:
     """Checks a file exists and is non-empty and returns the absolute path"""
     func = quit_with_error if panic else warning
@@ -124,6 +513,39 @@ def opener(file: str | os.PathLike, verbose: bool = False, *args, **kwargs) -> T
     return open(file, *args, **kwargs)
 
 
+def line_ranges(file: str | os.PathLike, chunk_size: int) -> Generator[tuple[int, int], None, None]:
+    """
+    Splits a file into byte ranges of about chunk_size bytes that start and end on line boundaries, so each range can
+    be read independently, e.g. by a worker process
+    :param file: File to split
+    :param chunk_size: Approximate size of each range in bytes
+    :return: Generator of (start, end) byte offsets
+    """
+    with open(file, 'rb') as f:
+        start, size = 0, os.fstat(f.fileno()).st_size
+        while start < size:
+            f.seek(min(start + max(chunk_size, 1), size) - 1)
+            f.readline()  # Move to the end of the line
+            yield start, (start := f.tell())
+
+
+def read_lines(file: str | os.PathLike, start: int, end: int) -> TextIO:
+    """Returns the lines in the start-end byte range of a file (from line_ranges) as a text stream"""
+    with open(file, 'rb') as f:
+        f.seek(start)
+        return TextIOWrapper(BytesIO(f.read(end - start)))
+
+
+def parse_fasta(text: str) -> Generator[tuple[str, str], None, None]:
+    """
+    Yields the header and sequence of each record in a fasta string, the same as Bio.SeqIO.FastaIO.SimpleFastaParser
+    but without importing SeqIO (which imports every format it supports)
+    """
+    for record in f'\n{text}'.split('\n>')[1:]:  # Anything before the first record is ignored
+        header, _, seq = record.partition('\n')
+        yield header.rstrip(), seq.replace('\n', '').replace('\r', '').replace(' ', '')
+
+
 def get_logo(message: str, width: int = 43) -> str:  # 43 is the width of the logo
     return bold_cyan(f'{_LOGO}\n{message.center(width)}')
 
@@ -0,0 +1,78 @@
+"""
+Shared fixtures for the Kaptive tests: a bundled database and small synthetic assemblies built from its loci.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import random
+
+import pytest
+
+from kaptive.database import load_database
+from kaptive.assembly import minimap2_installed
+
+# Constants -----------------------------------------------------------------------------------------------------------
+N_ASSEMBLIES = 6
+requires_minimap2 = pytest.mark.skipif(not minimap2_installed(), reason='needs the minimap2 executable')
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def mutate(seq: str, rate: float, rng: random.Random) -> str:
+    """Substitutes each base with a random different base at the given rate"""
+    return ''.join(rng.choice('ACGT'.replace(i, '')) if rng.random() < rate else i for i in seq)
+
+
+def synthetic_genome(db, locus, rng: random.Random) -> str:
+    """
+    Returns a mutated copy of the locus embedded in diverged fragments of the other loci, so the genes shared between
+    loci have several hits as in real genomes
+    """
+    others, seq = [i for i in db.loci.values() if i.name != locus.name], []
+    while sum(map(len, seq)) < 60_000:
+        other = str(rng.choice(others).seq)
+        start = rng.randrange(0, max(1, len(other) - 2000))
+        seq += [mutate(other[start:start + rng.randint(500, 2000)], 0.15, rng),
+                ''.join(rng.choices('ACGT', k=rng.randint(1000, 5000)))]
+    seq.insert(rng.randrange(len(seq)), mutate(str(locus.seq), rng.uniform(0, 0.03), rng))
+    return ''.join(seq)
+
+
+def write_assembly(file, genome: str, contigs: int, rng: random.Random):
+    """Writes the genome to a fasta file, split into contigs at random positions"""
+    cuts = sorted(rng.sample(range(1, len(genome)), contigs - 1))
+    with open(file, 'wt') as f:
+        for n, (start, end) in enumerate(zip([0] + cuts, cuts + [len(genome)])):
+            f.write(f'>contig_{n + 1} length={end - start}\n{genome[start:end]}\n')
+
+
+@pytest.fixture(autouse=True)
+def kaptive_cache(tmp_path, monkeypatch) -> str:
+    """Keeps the Kaptive cache directory of each test apart from the user's"""
+    monkeypatch.setenv('KAPTIVE_CACHE_DIR', cache := str(tmp_path / 'cache'))
+    return cache
+
+
+@pytest.fixture(scope='session')
+def db():
+    return load_database('kp_o')
+
+
+@pytest.fixture(scope='session')
+def assemblies(db, tmp_path_factory) -> list[str]:
+    """Paths to synthetic assemblies, each with a random locus of the database"""
+    rng, outdir = random.Random(3), tmp_path_factory.mktemp('assemblies')
+    loci = [i for i in db.loci.values() if not i.name.startswith('Extra')]
+    files = []
+    for n in range(N_ASSEMBLIES):
+        write_assembly(file := str(outdir / f'assembly_{n}.fasta'), synthetic_genome(db, rng.choice(loci), rng),
+                       rng.randint(1, 8), rng)
+        files.append(file)
+    return files
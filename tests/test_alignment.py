@@ -0,0 +1,62 @@
+"""
+Tests that alignments from mappy are the same as those parsed from the minimap2 executable's PAF output.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import random
+from re import findall
+
+import pytest
+
+from kaptive.assembly import parse_assembly, mappy
+from kaptive.alignment import Alignment
+from kaptive.utils import stream_command
+
+from conftest import requires_minimap2, mutate, write_assembly
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def edit(seq: str, rng: random.Random) -> str:
+    """Adds short and long insertions and deletions and runs of Ns to the sequence, about one every 300bp"""
+    edited, i = [], 0
+    while i < len(seq):
+        step, size = rng.randint(100, 500), rng.choice([rng.randint(1, 5), rng.randint(25, 60)])
+        edited.append(seq[i:i + step])
+        if (kind := rng.randrange(3)) == 0:
+            edited.append(''.join(rng.choices('ACGT', k=size)))  # Insertion
+        elif kind == 1:
+            step += size  # Deletion
+        else:
+            edited.append('N' * size)
+            step += size
+        i += step
+    return ''.join(edited)
+
+
+# Tests ---------------------------------------------------------------------------------------------------------------
+@requires_minimap2
+@pytest.mark.skipif(not mappy, reason='needs mappy')
+def test_mappy(db, tmp_path):
+    """
+    Alignments from mappy, with the alignment score recalculated from the CIGAR, are the same as minimap2 -c output,
+    including alignments with mismatches, ambiguous bases and short and long gaps
+    """
+    rng, query = random.Random(7), db.format('ffn')
+    genome = ''.join(''.join(rng.choices('ACGT', k=2000)) + edit(mutate(str(i.seq), 0.02, rng), rng)
+                     for i in list(db.loci.values())[:4])
+    write_assembly(file := str(tmp_path / 'edited.fasta'), genome, 3, rng)
+    expected = [Alignment.from_paf_line(i) for i in stream_command(f'minimap2 -c -t 1 "{file}" -', query)]
+    assert any(int(i) > 20 for a in expected for i in findall(r'(\d+)[ID]', a.tag('cg')))  # Long gaps are aligned
+    assert any(a.tag('NM') > a.blen - a.mlen for a in expected)  # So are Ns
+    key = lambda a: (a.q, a.q_len, a.q_st, a.q_en, a.strand, a.ctg, a.r_st, a.r_en, a.mlen, a.blen, a.mapq,
+                     a.tag('NM'), a.tag('AS'), a.tag('tp'), a.tag('cg'))
+    assert [key(i) for i in parse_assembly(file).map(query, 1)] == [key(i) for i in expected]
@@ -0,0 +1,60 @@
+"""
+Tests that the Typer gives the same results as kaptive assembly, whether assemblies are files or in memory.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import pytest
+
+import kaptive.api
+from kaptive.api import Typer, TyperError
+from kaptive.assembly import typing_pipeline, assembly_name
+from kaptive.utils import parse_fasta
+
+from conftest import requires_minimap2
+
+
+# Fixtures ------------------------------------------------------------------------------------------------------------
+@pytest.fixture(scope='module')
+def expected(db, assemblies) -> list[str]:
+    return [typing_pipeline(i, db, 1).format('tsv') for i in assemblies]
+
+
+def records(file: str) -> tuple[str, list[tuple[str, str]]]:
+    with open(file) as f:
+        return assembly_name(file), list(parse_fasta(f.read()))
+
+
+# Tests ---------------------------------------------------------------------------------------------------------------
+def test_files(db, assemblies, expected):
+    """Files are typed as with kaptive assembly"""
+    with Typer(db, threads=1) as typer:
+        assert [typer.type(i).format('tsv') for i in assemblies] == expected
+
+
+@requires_minimap2
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_in_memory(db, assemblies, expected, jobs):
+    """In-memory contigs are typed as if they were read from their files, in input order with a worker pool"""
+    with Typer(db, jobs=jobs, threads=1, max_pending=1) as typer:
+        assert [i.format('tsv') for i in typer.type_all(map(records, assemblies))] == expected
+
+
+def test_bad_input(db):
+    with Typer(db, threads=1) as typer, pytest.raises(TyperError):
+        typer.type(42)
+
+
+def test_in_memory_without_minimap2(db, assemblies, monkeypatch):
+    """In-memory contigs can't be typed without the minimap2 executable, even with mappy, so an error is raised"""
+    monkeypatch.setattr(kaptive.api, 'minimap2_installed', lambda: False)
+    with Typer(db, threads=1) as typer, pytest.raises(TyperError):
+        typer.type(records(assemblies[0]))
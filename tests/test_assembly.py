@@ -0,0 +1,134 @@
+"""
+Tests that the ways of typing assemblies give the same results as typing each assembly file on its own.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import sys
+import random
+from json import loads
+from shutil import copyfile
+
+import pytest
+
+import kaptive.assembly
+from kaptive.assembly import (typing_pipeline, typing_batch, map_batch, parse_assembly, assembly_from_records,
+                              assembly_name, _ASSEMBLY_HEADER)
+from kaptive.typing import ResultCache
+from kaptive.__main__ import main
+from kaptive.utils import parse_fasta
+
+from conftest import N_ASSEMBLIES, requires_minimap2, synthetic_genome, write_assembly
+
+
+# Fixtures ------------------------------------------------------------------------------------------------------------
+@pytest.fixture(scope='module')
+def expected(db, assemblies) -> list[str]:
+    """TSV results of typing each assembly file with the typing_pipeline defaults"""
+    return [typing_pipeline(i, db, 1).format('tsv') for i in assemblies]
+
+
+def run_kaptive(monkeypatch, *args: str):
+    """Runs the kaptive command line with the arguments"""
+    monkeypatch.setattr(sys, 'argv', ['kaptive', *map(str, args)])
+    main()
+
+
+# Tests ---------------------------------------------------------------------------------------------------------------
+@requires_minimap2
+def test_in_memory(db, assemblies, expected):
+    """In-memory assemblies are aligned as if they were read from their files"""
+    for file, tsv in zip(assemblies, expected):
+        with open(file) as f:
+            assembly = assembly_from_records(assembly_name(file), parse_fasta(f.read()))
+        assert typing_pipeline(assembly, db, 1).format('tsv') == tsv
+
+
+def test_in_memory_without_minimap2(db, assemblies, monkeypatch):
+    """In-memory assemblies aren't typed without the minimap2 executable, rather than typed differently"""
+    monkeypatch.setattr(kaptive.assembly, 'minimap2_installed', lambda: False)
+    with open(assemblies[0]) as f:
+        assert typing_pipeline(assembly_from_records('sample', parse_fasta(f.read())), db, 1) is None
+
+
+@requires_minimap2
+def test_batch(db, assemblies, expected, tmp_path):
+    """Batches are typed as each assembly on its own, including assemblies too repetitive to align in the batch"""
+    rng, locus = random.Random(5), db['O1/O2v1']
+    repeat = str(locus.seq)[2000:3000]  # Part of a gene, repeated so its minimizers are filtered by minimap2
+    write_assembly(repetitive := str(tmp_path / 'repetitive.fasta'),
+                   synthetic_genome(db, locus, rng) + repeat * 20, 3, rng)
+    assert [i is None for i in map_batch([parse_assembly(i) for i in [repetitive] + assemblies[:2]],
+                                         db.format('ffn'), 1)] == [True, False, False]
+    files = assemblies[:3] + [repetitive] + assemblies[3:]
+    tsvs = expected[:3] + [typing_pipeline(repetitive, db, 1).format('tsv')] + expected[3:]
+    for batch_size in (2, len(files)):
+        assert [i.format('tsv') for i in typing_batch(files, db, batch_size, threads=1)] == tsvs
+
+
+def test_batch_memory(monkeypatch):
+    """Batches are split so that their assemblies, each padded to the size of the largest, fit in max_bases"""
+    monkeypatch.setattr(kaptive.assembly, '_type_batch', lambda batch, *args: [len(batch)])
+    assemblies = [assembly_from_records(str(n), [('contig', 'A' * size)]) for n, size in enumerate([10, 100, 10, 10])]
+    assert list(typing_batch(assemblies, None, 4, 250, threads=1)) == [2, 2]
+    assert list(typing_batch(assemblies, None, 4, 0, threads=1)) == [4]
+
+
+def test_result_cache(db, assemblies, expected, tmp_path):
+    """Results are typed once, then read from the result cache whatever the assembly file is called"""
+    cache = ResultCache(tmp_path)
+    assert [typing_pipeline(i, db, 1, cache=cache).format('tsv') for i in assemblies] == expected
+    assert (cache.hits, cache.misses) == (0, N_ASSEMBLIES)
+    copies = [copyfile(i, tmp_path / f'copy_{n}.fasta') for n, i in enumerate(assemblies)]
+    assert [typing_pipeline(i, db, 1, cache=cache).format('tsv') for i in copies] == [
+        tsv.replace(assembly_name(i), assembly_name(copy), 1) for i, copy, tsv in zip(assemblies, copies, expected)]
+    assert (cache.hits, cache.misses) == (N_ASSEMBLIES, N_ASSEMBLIES)
+
+
+@requires_minimap2
+def test_resume(assemblies, expected, tmp_path, monkeypatch):
+    """Resuming after an interrupted run writes every result once, even if the -o and -j files disagree"""
+    tsv, json = tmp_path / 'results.tsv', tmp_path / 'results.json'
+    run_kaptive(monkeypatch, 'assembly', 'kp_o', *assemblies[:3], '-o', tsv, '-j', json, '-t', 1)
+    run_kaptive(monkeypatch, 'assembly', 'kp_o', assemblies[3], '-o', tsv, '-t', 1)  # Only in the TSV
+    with open(json, 'at') as f:  # Interrupted while writing the JSON result
+        f.write('{"sample_name": "assembly_3", "best_match": ')
+    with open(tsv, 'at') as f:  # And the next TSV result
+        f.write('assembly_4\tO1')
+    run_kaptive(monkeypatch, 'assembly', 'kp_o', *assemblies, '-o', tsv, '-j', json, '-t', 1, '--resume')
+    assert tsv.read_text() == _ASSEMBLY_HEADER + ''.join(expected)
+    assert [loads(i)['sample_name'] for i in json.read_text().splitlines()] == list(map(assembly_name, assemblies))
+
+
+def test_index_failure(assemblies, monkeypatch):
+    """An assembly that minimap2 can't index is only tried once, then aligned from its path"""
+    calls = []
+
+    class Failed:
+        returncode = 1
+
+        def __init__(self, cmd, **kwargs):
+            calls.append(cmd)
+
+        def communicate(self):
+            return '', 'failed'
+
+    monkeypatch.setattr(kaptive.assembly, 'Popen', Failed)
+    assembly = parse_assembly(assemblies[0])
+    assert assembly.index(1) == assembly.index(1) == assembly.path and len(calls) == 1
+
+
+@requires_minimap2
+@pytest.mark.parametrize('args', [('--jobs', 2), ('--batch', 3), ('--jobs', 2, '--batch', 2), ('--overlap', 3)])
+def test_parallel(args, assemblies, expected, tmp_path, monkeypatch):
+    """Typing assemblies in parallel, overlapped or in batches writes the same results in the same order"""
+    run_kaptive(monkeypatch, 'assembly', 'kp_o', *assemblies, '-o', tsv := tmp_path / 'results.tsv', '-t', 1, *args)
+    assert tsv.read_text() == _ASSEMBLY_HEADER + ''.join(expected)
@@ -0,0 +1,30 @@
+"""
+Tests of loading databases, with and without the database cache.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from os import path, listdir
+
+from kaptive.database import load_database
+
+
+# Tests ---------------------------------------------------------------------------------------------------------------
+def test_cache(kaptive_cache):
+    """The database is only cached when asked to, and the cached database is the same as the parsed one"""
+    db = load_database('kp_o')
+    assert not path.exists(path.join(kaptive_cache, 'databases'))
+    load_database('kp_o', cache=True)
+    assert len(listdir(path.join(kaptive_cache, 'databases'))) == 1
+    cached = load_database('kp_o', cache=True)
+    assert cached.fingerprint == db.fingerprint
+    assert [(i.name, i.type_label, str(i.seq), list(i.genes)) for i in cached.loci.values()] == [
+        (i.name, i.type_label, str(i.seq), list(i.genes)) for i in db.loci.values()]
@@ -0,0 +1,75 @@
+"""
+Tests of the translation and result caches shared by the assemblies of a run and saved between runs.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from os import path
+
+from kaptive.assembly import typing_pipeline, typing_pool, parse_assembly
+from kaptive.typing import (ResultCache, load_translations, save_translations, _translations_file, _TRANSLATIONS,
+                            _RESULT_CACHE_SIZE)
+from kaptive.utils import LRUCache
+
+from conftest import N_ASSEMBLIES
+
+
+# Tests ---------------------------------------------------------------------------------------------------------------
+def test_saved_translations(db, assemblies):
+    """Saved translations are loaded as they were cached, and files with anything else in them are ignored"""
+    _TRANSLATIONS.clear()
+    typing_pipeline(assemblies[0], db, 1)
+    save_translations(db)
+    saved = dict(_TRANSLATIONS.items())
+    _TRANSLATIONS.clear()
+    load_translations(db)
+    assert saved and dict(_TRANSLATIONS.items()) == saved
+    with open(_translations_file(db), 'at') as f:
+        f.write('cos\nsystem\n(S\'echo\'\ntR.\n')  # Not a translation
+    _TRANSLATIONS.clear()
+    load_translations(db)
+    assert len(_TRANSLATIONS) == 0 and path.isfile(_translations_file(db))
+
+
+def test_new_translations():
+    """Only new items that are still in the cache are recorded, so the record is bounded by the cache size"""
+    cache = LRUCache(2, record_new=True)
+    cache.update((i, i) for i in range(5))
+    assert cache.pop_new() == {3: 3, 4: 4} and cache.pop_new() == {}
+    cache = LRUCache(2)
+    cache.update((i, i) for i in range(5))
+    assert cache.pop_new() == {}
+
+
+def test_translation_counts(db, assemblies):
+    """Translation cache hits and misses in the workers of a typing pool are added to the counts of this process"""
+    _TRANSLATIONS.clear()
+    list(typing_pool(assemblies[:2], db, 2))
+    assert len(_TRANSLATIONS) == 0 and _TRANSLATIONS.misses > 0
+
+
+def test_result_cache_size(db, assemblies, tmp_path):
+    """The result cache is only scanned when a result is added, and replaced results are only counted once"""
+    cache, result = ResultCache(tmp_path), typing_pipeline(assemblies[0], db, 1)
+    assert not path.isfile(path.join(tmp_path, _RESULT_CACHE_SIZE))
+    for _ in range(2):
+        cache.put(key := cache.key(parse_assembly(assemblies[0]), db), result)
+        assert cache.size == sum(i.stat().st_size for i in cache.entries())
+    assert cache.get(key, 'renamed', db).sample_name == 'renamed' and cache.hits == 1
+
+
+def test_result_cache_pool(db, assemblies, tmp_path):
+    """Typing pool workers share the size of the result cache, and their hits and misses are added to this process"""
+    cache = ResultCache(tmp_path)
+    for _ in range(2):
+        list(typing_pool(assemblies, db, 2, cache=cache))
+    assert (cache.hits, cache.misses) == (N_ASSEMBLIES, N_ASSEMBLIES)
+    assert cache.size == sum(i.stat().st_size for i in cache.entries())
@@ -0,0 +1,91 @@
+"""
+Tests of the file utilities: indexed access to the contigs of fasta files (plain and BGZF) and atomic writes.
+
+Copyright 2023 Tom Stanton (tomdstanton@gmail.com)
+https://github.com/klebgenomics/Kaptive
+
+This file is part of Kaptive. Kaptive is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Kaptive is distributed
+in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Kaptive.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import gc
+import os
+import random
+
+import pytest
+from Bio import bgzf
+
+from kaptive.utils import FastaIndex, atomic_write
+
+
+# Functions -----------------------------------------------------------------------------------------------------------
+def write_fasta(file: str, contigs: dict[str, tuple[str, str]], line_length: int = 60):
+    """Writes (description, sequence) contigs wrapped at line_length, BGZF-compressed if the file ends with .gz"""
+    text = ''.join(f'>{name}{" " + desc if desc else ""}\n' + ''.join(
+        seq[i:i + line_length] + '\n' for i in range(0, len(seq), line_length))
+        for name, (desc, seq) in contigs.items())
+    with bgzf.BgzfWriter(file, 'wb') if file.endswith('.gz') else open(file, 'wb') as f:
+        f.write(text.encode())
+
+
+def write_fai(fasta: FastaIndex):
+    """Writes the index as samtools faidx would"""
+    with open(f'{fasta.file}.fai', 'wt') as f:
+        f.writelines(f'{name}\t' + '\t'.join(map(str, entry)) + '\n' for name, entry in fasta._index.items())
+
+
+def contigs(rng: random.Random) -> dict[str, tuple[str, str]]:
+    return {f'contig_{n}': (f'length={length} circular' if n % 2 else '', ''.join(rng.choices('ACGTN', k=length)))
+            for n, length in enumerate(rng.randint(1, 200_000) for _ in range(5))}
+
+
+# Tests ---------------------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize('suffix', ['.fasta', '.fasta.gz'])
+def test_fasta_index(suffix, tmp_path):
+    """Contigs and their descriptions are read from the file, or from a samtools index if it matches the file"""
+    rng = random.Random(suffix)
+    write_fasta(file := str(tmp_path / f'assembly{suffix}'), expected := contigs(rng))
+    fasta = FastaIndex(file)
+    assert fasta.lengths() == {name: len(seq) for name, (_, seq) in expected.items()}
+    assert fasta.descriptions == {name: desc for name, (desc, _) in expected.items()}
+    for name, (_, seq) in expected.items():
+        start, end = sorted(rng.choices(range(len(seq) + 1), k=2))
+        assert fasta.fetch(name).decode() == seq and fasta.fetch(name, start, end).decode() == seq[start:end]
+    write_fai(fasta)
+    fasta.close()
+    reused = FastaIndex(file)
+    assert reused._index == fasta._index and reused.descriptions == fasta.descriptions
+    reused.close()
+
+    write_fasta(file, expected := contigs(rng))  # A new version of the file, with an older index
+    os.utime(f'{file}.fai')
+    fasta = FastaIndex(file)
+    assert fasta.lengths() == {name: len(seq) for name, (_, seq) in expected.items()}
+    assert all(fasta.fetch(name).decode() == seq for name, (_, seq) in expected.items())
+    fasta.close()
+
+
+@pytest.mark.parametrize('suffix', ['.fasta', '.fasta.gz'])
+def test_fasta_index_closed(suffix, tmp_path):
+    """The memory map or BGZF file is closed when the index is garbage collected without being closed"""
+    write_fasta(file := str(tmp_path / f'assembly{suffix}'), contigs(random.Random(suffix)))
+    data = FastaIndex(file)._data
+    gc.collect()
+    assert data._file.closed if suffix == '.fasta.gz' else data.closed
+
+
+def test_atomic_write(tmp_path):
+    """The file is only replaced once it is fully written, and a failed write leaves no temporary file"""
+    (file := tmp_path / 'cache.txt').write_text('old')
+    with pytest.raises(ValueError):
+        with atomic_write(file) as tmp_file, open(tmp_file, 'wt') as f:
+            f.write('partial')
+            raise ValueError
+    assert file.read_text() == 'old' and os.listdir(tmp_path) == ['cache.txt']
+    with atomic_write(file) as tmp_file, open(tmp_file, 'wt') as f:
+        f.write('new')
+    assert file.read_text() == 'new' and os.listdir(tmp_path) == ['cache.txt']